@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import os
+
 from INI_Configuration import INIMixin
+from Resampling import DEFAULT_GRID
 
 from ast import literal_eval
 
@@ -11,7 +14,25 @@ class ASAbstraction(INIMixin):
         ini_defaults = {'device_alias': '',
                         'current_directory': '',
                         'current_file': '',
-                        'red_farred': "[[635, 685], [710, 760]]"}
+                        'red_farred': "[[635, 685], [710, 760]]",
+                        'wavelength_grid': DEFAULT_GRID,
+                        # read the sensor temperature every N scans or T
+                        # seconds, 0 disables either
+                        'temperature_policy': "[100, 10.0]",
+                        # continuous readings take the next scan while the
+                        # last one is processed, see Pipeline.POLICIES
+                        'pipelined_acquisition': "True",
+                        'pipeline_policy': 'keep latest',
+                        # seconds the plot waits for every sensor's scan
+                        'frame_timeout': "1.0",
+                        # raw scans kept per sensor for saving afterwards
+                        'scan_buffer_size': "3000",
+                        # scans a data capture queues for writing at most,
+                        # flushed every N scans or T seconds and synced to
+                        # disk as in Capture_Writer.FSYNC_POLICIES
+                        'writer_queue_size': "1000",
+                        'writer_batch': "[50, 1.0]",
+                        'writer_fsync': 'per batch'}
         super(ASAbstraction, self).__init__(ini_defaults=ini_defaults)
         self.x_data_range = [340, 820]
         self.y_data = []
@@ -59,3 +80,81 @@ class ASAbstraction(INIMixin):
     @red_farred.setter
     def red_farred(self, new_ranges):
         self.ini.red_farred = new_ranges
+
+    @property
+    def wavelength_grid(self):
+        return self.ini.wavelength_grid
+
+    @wavelength_grid.setter
+    def wavelength_grid(self, new_grid):
+        self.ini.wavelength_grid = new_grid
+
+    @property
+    def device_cache_path(self):
+        # kept next to the ini file
+        return os.path.join(os.path.dirname(self.ini.ini_file_name),
+                            'device_cache.json')
+
+    @property
+    def temperature_policy(self):
+        return literal_eval(self.ini.temperature_policy)
+
+    @temperature_policy.setter
+    def temperature_policy(self, policy):
+        self.ini.temperature_policy = policy
+
+    @property
+    def pipelined_acquisition(self):
+        return literal_eval(self.ini.pipelined_acquisition)
+
+    @pipelined_acquisition.setter
+    def pipelined_acquisition(self, pipelined):
+        self.ini.pipelined_acquisition = pipelined
+
+    @property
+    def pipeline_policy(self):
+        return self.ini.pipeline_policy
+
+    @pipeline_policy.setter
+    def pipeline_policy(self, policy):
+        self.ini.pipeline_policy = policy
+
+    @property
+    def frame_timeout(self):
+        return literal_eval(self.ini.frame_timeout)
+
+    @frame_timeout.setter
+    def frame_timeout(self, timeout):
+        self.ini.frame_timeout = timeout
+
+    @property
+    def scan_buffer_size(self):
+        return literal_eval(self.ini.scan_buffer_size)
+
+    @scan_buffer_size.setter
+    def scan_buffer_size(self, size):
+        self.ini.scan_buffer_size = size
+
+    @property
+    def writer_queue_size(self):
+        return literal_eval(self.ini.writer_queue_size)
+
+    @writer_queue_size.setter
+    def writer_queue_size(self, size):
+        self.ini.writer_queue_size = size
+
+    @property
+    def writer_batch(self):
+        return literal_eval(self.ini.writer_batch)
+
+    @writer_batch.setter
+    def writer_batch(self, batch):
+        self.ini.writer_batch = batch
+
+    @property
+    def writer_fsync(self):
+        return self.ini.writer_fsync
+
+    @writer_fsync.setter
+    def writer_fsync(self, policy):
+        self.ini.writer_fsync = policy
@@ -5,31 +5,36 @@ import gc
 import itertools
 import multiprocessing
 import os
-import sys
 import time
 import urllib2
 from Queue import Queue, Empty
 from tempfile import gettempdir
-from threading import Event, Thread
+from threading import Event, Thread, Lock, current_thread
 from time import sleep
 
 from serial.tools.list_ports import comports
-import usb.util
-import usb.core
-import usb.backend.libusb1
-if sys.platform != 'darwin':
-    backend = usb.backend.libusb1.get_backend(
-        find_library=lambda x: (os.path.join(os.getcwd(), 'libusb-1.0.dll')))
-else:
-    backend = usb.backend.libusb1.get_backend(
-        find_library=lambda x: (os.path.join(os.getcwd(), 'libusb-1.0.dylib')))
 
 import wx
 import wx.lib.newevent
 from wx import PostEvent, Yield
 
 from constants import *
-from USB_Instrument import Instrument, DeviceCommunicationError, ALIAS, AT, BT, CT
+from USB_Instrument import DeviceCommunicationError, AcquisitionCancelled, \
+     find_devices, open_instrument, open_instruments, probe_devices, \
+     release_device, same_device, READ_SLICE
+from Resampling import bin_widths, DEFAULT_GRID, NUM_PIXELS
+from Device_Cache import DeviceCache
+from Device_Monitor import DeviceMonitor
+from Acquisition_Scheduler import AcquisitionScheduler
+from Pipeline import AcquisitionPipeline, FrameAssembler, QueueClosed
+from Acquisition_Settings import SettingsPublisher, changed
+from Scan_Buffer import write_scans
+from Capture_Writer import CaptureWriter, WriterThread, FSYNC_POLICIES, \
+     LEGACY_DATA_ROWS, TRAILING_ROWS, TEMP_LABEL, TEMP_TIME_LABEL, \
+     align_rows, capture_path, column_layout, export_columns, \
+     timestamp_label, units_label
+from Capture_Format import CapturedScan, CaptureReader, capture_header
+from Capture_Journal import JournalError, atomic_write
 
 event_error, EVT_ERROR = wx.lib.newevent.NewEvent()
 plot_event, PLOT_EVT = wx.lib.newevent.NewEvent()
@@ -37,6 +42,12 @@ status_event, STATUS_EVT = wx.lib.newevent.NewEvent()
 toolbar_event, TOOLBAR_EVT = wx.lib.newevent.NewEvent()
 
 
+# seconds stop_all_threads waits for the reading threads to finish
+STOP_TIMEOUT = 2.0
+# the settings that have to be sent to the devices
+DEVICE_SETTINGS = ('integ_time', 'auto_integrate', 'average_scans')
+
+
 class InvalidCommandError(Exception):
     """This exception is thrown when the command cannot be carried out for
     various reasons"""
@@ -47,18 +58,37 @@ class ASControl(object):
         self.abstr = abstraction
         self.prsnt = presentation
         self.data_capture_queue = Queue()
-        self.plot_data_queue = Queue()
+        # frames of scans from the data retrieval threads to the plot thread
+        self.frames = None
+        # device: CaptureWriter of the data capture running
+        self.capture_writers = {}
+        # writes the scans of the data capture running in the background
+        self.writer_thread = None
         self.start_thread = Event()
         self.start_thread.clear()
         self.stop_thread = Event()
         self.pause_thread = Event()
         self.hold_thread = Event()
         self.devices = []
+        self.device_cache = DeviceCache(self.abstr.device_cache_path)
         self.active_threads = []
         self.data_collection = False
         interaction.install(self, presentation)
         self.red_farred = ([635, 685], [710,760])
         self.active_mode = COUNTS
+        # the grid the devices resample to, the one saved in the settings
+        # except while calibrating
+        self.wavelength_grid = self.abstr.wavelength_grid
+        self.prsnt.check_wavelength_grid(self.wavelength_grid)
+        # what the worker threads see of the gui, see publish_settings
+        self.settings = SettingsPublisher(**self.gui_settings())
+        self.prsnt.device_toggled = self.publish_settings
+        # held while the Connect menu or the device monitor have devices
+        # open, so they never open the same one
+        self.connect_lock = Lock()
+        self.monitor = DeviceMonitor(self.on_device_attached,
+                                     self.on_device_detached)
+        self.monitor.start()
         self.check_for_updates()
 
     @property
@@ -78,7 +108,8 @@ class ASControl(object):
         parses file of csv format and plots each line as a seperate measurement
         uses the timestamp as a label for the legend. only accomadates a max of
         ten seperate plots as we don't know how much memory the system using the
-        software is going to have
+        software is going to have. binary captures are read lazily and their
+        plots spread over the whole capture, see capture_plot_data
         """
         if not file_paths:
             file_paths = self.prsnt.open_data_file_dialog(
@@ -92,6 +123,19 @@ class ASControl(object):
         total_plots = 0
         temperature = False
         for file_path in file_paths:
+            if os.path.splitext(file_path)[1] == '.capture':
+                try:
+                    dictionary = self.capture_plot_data(file_path,
+                                                        10 - total_plots)
+                except (IOError, JournalError, KeyError), data:
+                    self.prsnt.give_error("Could not open capture",
+                                          "%s" % data)
+                    return
+                file_contents.append(dictionary)
+                total_plots += len(dictionary['labels'])
+                if total_plots == 10:
+                    break
+                continue
             dictionary = {}
             dictionary['labels'] = []
             with open(file_path, 'r') as data_file:
@@ -106,7 +150,11 @@ class ASControl(object):
                 line = line.split(',')
                 rows.append(line)
             data = list(itertools.izip_longest(*rows))
-            x_data = list(data[0][2:-8])
+            # older files have no row for the time the temperature was read
+            trailing = TRAILING_ROWS
+            if data[0][-1] == TEMP_LABEL:
+                trailing -= 1
+            x_data = list(data[0][2:-trailing])
             while True:
                 try:
                     x_data.remove('-')
@@ -126,12 +174,13 @@ class ASControl(object):
                     dictionary = {}
                     dictionary['labels'] = []
                     dictionary['x_data'] = map(lambda x: float(x),
-                                               elements[2:-8])
+                                               elements[2:-trailing])
                     dictionary['y_data'] = []
                     j += 1
                     elements = data[j]
                 dictionary['labels'].append(elements[0])
-                y_data = list(elements[2:-1]) # exclude temperature
+                # exclude the temperature rows
+                y_data = list(elements[2:len(elements) - trailing + 7])
                 try:
                     y_data.remove('')
                 except ValueError:
@@ -154,6 +203,25 @@ class ASControl(object):
         self.prsnt.show_average_button.Enable()
         self.prsnt.plot_multiline(file_contents)
 
+    def capture_plot_data(self, file_path, plots):
+        """returns the multiplot data of up to plots scans spread evenly over
+        the binary capture file_path. Only the scans plotted are read from
+        disk, however long the capture."""
+        reader = CaptureReader(file_path)
+        try:
+            picked = reader.spread(plots)
+            scans = reader[picked]
+            spectra = reader.spectra(picked)
+        finally:
+            reader.close()
+        y_data = []
+        for spectrum, scan in zip(spectra, scans):
+            extras = scan['extras'][:scan['extra_count']]
+            y_data.append(spectrum.tolist() + extras.tolist())
+        return {'labels': [timestamp_label(timestamp, reader.name)
+                           for timestamp in scans['timestamp']],
+                'x_data': reader.wavelengths.tolist(), 'y_data': y_data}
+
     def save_spectrum(self):
         """
         saves the current spectrum as an image file with filetype of the users
@@ -168,6 +236,37 @@ class ASControl(object):
         self.abstr.current_directory = os.path.dirname(file_path)
         self.prsnt.save_graph(file_path)
 
+    def save_buffered_scans(self):
+        """saves the raw scans of the last few seconds, kept by every device
+        whether or not they were saved at the time. readings carry on
+        meanwhile"""
+        if not self.devices:
+            msg = "Please connect a device before attempting this function."
+            self.prsnt.give_error("No Device Connected", msg)
+            return
+        seconds = self.prsnt.buffer_seconds_dialog()
+        if not seconds:
+            return
+        # the scans are taken out of the buffers before asking for file names
+        start = time.time() - seconds
+        buffered = [(device, device.scan_buffer.since(start))
+                    for device in self.devices]
+        for device, scans in buffered:
+            if not len(scans.trigger_time):
+                continue
+            file_path = self.prsnt.save_data_dialog(
+                self.abstr.current_directory,
+                "%s last %d s" % (device.name, seconds))
+            if not file_path:
+                continue
+            self.abstr.current_directory = os.path.dirname(file_path)
+            wavelengths = [device.pixel_to_wavelength(pixel)
+                           for pixel in range(NUM_PIXELS)]
+            try:
+                write_scans(file_path, device.name, wavelengths, scans)
+            except IOError, data:
+                self.prsnt.give_error("Could Not Save Scans", str(data))
+
     def setup_data_capture(self):
         """
         intializes/prompts user for data capture settings and begins data
@@ -180,6 +279,12 @@ class ASControl(object):
             self.connect_to_device()
             if not self.abstr.connected:
                 return
+        # checked here, WriterThread raises inside the progress dialog
+        if self.abstr.writer_fsync not in FSYNC_POLICIES:
+            self.prsnt.give_error(
+                "Invalid Setting", "writer_fsync is '%s', it must be one of: "
+                "%s" % (self.abstr.writer_fsync, ', '.join(FSYNC_POLICIES)))
+            return
         settings = self.prsnt.data_capture_settings_dlg()
         if not settings:
             return
@@ -221,6 +326,8 @@ class ASControl(object):
                     device.auto_integration = False
                     device.set_integration_period(self.prsnt.integ_time)
                 device.set_scans_to_avg(int(self.prsnt.average_scans))
+                # set outside of the settings snapshots, resend them later
+                device.settings = None
             except DeviceCommunicationError, data:
                 self.prsnt.give_error("Connection Error %s" % device.name,
                                              data.message)
@@ -248,20 +355,35 @@ class ASControl(object):
             settings, self.collect_raw_data)
         if not proceed:
             self.stop_thread.set()
+        self.export_capture()
         if settings['plot_to_screen']:
             plot_files = []
             for device in self.devices:
-                plot_files.append(device.file_path)
+                # the capture is read far quicker than the exported columns
+                if os.path.exists(capture_path(device.file_path)):
+                    plot_files.append(capture_path(device.file_path))
+                else:
+                    plot_files.append(device.file_path)
             self.plot_from_file(plot_files)
 
     def collect_raw_data(self, total_scans, time_between_scans, log_temp,
                          active_mode=0, active_unit=0):
         """
-        collects data during data capture process and writes it to a file after
-        each scan. if no file is chosen, data is written to a temp file. This
-        function is a generator for the progress dialog.
+        collects data during data capture process and appends every scan to
+        the capture file of its device as a row. if no file is chosen, data is
+        written to a temp file. This function is a generator for the progress
+        dialog.
         """
         self.data_collection = True
+        for dev in self.devices:
+            self.capture_writers[dev] = CaptureWriter(
+                capture_path(dev.file_path),
+                capture_header(dev, active_mode, active_unit))
+        batch_scans, batch_interval = self.abstr.writer_batch
+        self.writer_thread = WriterThread(self.abstr.writer_queue_size,
+                                          batch_scans, batch_interval,
+                                          self.abstr.writer_fsync)
+        self.writer_thread.start()
         scan_data = []
         self.abstr.y_data = []
         # float("inf") wasn't working correctly for XP users
@@ -269,34 +391,43 @@ class ASControl(object):
         # Should be sufficient yah?
         if total_scans == 0:
             total_scans = 8000000
-        i = 1
         if not time_between_scans:
             time_between_scans = 0
-        # if total scans is infinite, data collection will proceed until user
-        # hits cancel on the generator controlled progress dialog. the dialog
-        # sets the self.stop_thread Event which is checked here before every
-        # scan
-        while i < total_scans+1:
-            wx.YieldIfNeeded()
-            scan_time = time.time()
-            # now collect the data from the devices and save them to their 
-            # respective files
-            for dev in self.devices:
-                dev.start_measurement()
-            wx.YieldIfNeeded()
-            inc = (self.devices[0].prev_integ/1000000.0*self.devices[0].avg_scans + 0.01)/10
-            for i in range(10):
-                sleep(inc)
-                wx.YieldIfNeeded()
-            for dev in self.devices:
-                yield i
+        # the scans every sensor saved, the progress is that of the slowest
+        taken = dict((dev, 0) for dev in self.devices)
+        i = 1
+        scheduler = AcquisitionScheduler(self.devices, self.prsnt.yield_to_gui)
+        try:
+            # every sensor is triggered at once and then measures on its own
+            # thread as fast as it can or every time_between_scans seconds,
+            # so a slow sensor does not hold up the others. sensors that were
+            # unplugged wait until they return, their files carry on from
+            # where they stopped. if total scans is infinite, data collection
+            # will proceed until user hits cancel on the generator controlled
+            # progress dialog, which closes this generator
+            scheduler.start(scans=total_scans, interval=time_between_scans)
+            while True:
+                attached = [dev for dev in self.devices
+                            if dev.attached.is_set()]
+                # if every sensor is unplugged, wait for one to return
+                if attached and all(taken[dev] >= total_scans
+                                    for dev in attached):
+                    break
                 try:
-                    dev.acquire_measurement()
+                    measurement = scheduler.get(READ_SLICE)
+                except Empty:
                     wx.YieldIfNeeded()
-                except DeviceCommunicationError, data:
-                    print data
-                else:
-                    y = dev.y_data
+                    yield i
+                    continue
+                dev = measurement.device
+                yield i
+                if measurement.error is not None:
+                    print measurement.error
+                    if not dev.is_attached():
+                        self.device_lost(dev)
+                    # there is no scan to save, last_scan is an older one
+                    continue
+                y = measurement.y_data
                 if active_mode in [ENERGY_FLUX, ILLUMINANCE]:
                     y = self.integrate_range(dev.x_data, y)
                 elif active_mode == PHOTON_FLUX:
@@ -306,39 +437,84 @@ class ASControl(object):
                 elif active_unit == FOOTCANDLE:
                     y = self.calculate_lux(y, dev.x_data, fc=True)
                 self.abstr.y_data = [y]
-                temp = None
+                temp = temp_time = float('nan')
                 if log_temp:
-                    temp = dev.prev_temp
+                    # the temperature is not read every scan, log when it
+                    # was
+                    temp, temp_time = measurement.temperature, \
+                        measurement.temp_time
                 wx.YieldIfNeeded()
-                self.save_data_to_file(dev.file_path, 'r+',
-                                       [dev.x_data[0], dev.x_data[-1]],
-                                       temp, active_mode, active_unit)
-            # if there is a time_between_scans parameter, make sure we hit that
-            # point before continuing. otherwise, time_between_scans is roughly
-            # the amount of time it takes to pull the data off the registers
-            # and save it to the file
-            while time.time() - time_between_scans < scan_time:
-                try:
-                    wx.Yield()
-                except Exception:
-                    # this exception is a wx._core.PyAssertionError which for some
-                    # reason I can't explicitly catch so I'm using a catch all here.
-                    # this error is raised when wx.Yield is called recursively
-                    pass
-                if (i) == total_scans:
-                    break
-                sleep(0.01)
-                yield i
-            i += 1
+                # stamped with the time the scan was triggered, written in
+                # the background
+                n = len(dev.x_data)
+                scan = CapturedScan(measurement.trigger_time,
+                                    measurement.scan.integ, dev.avg_scans,
+                                    temp, temp_time, measurement.scan.pixels,
+                                    y[n:], y[:n])
+                self.writer_thread.append(self.capture_writers[dev], scan)
+                taken[dev] += 1
+                i = min(total_scans, min(taken[other] for other in
+                                         attached or [dev]) + 1)
+                stats = self.writer_thread.stats()
+                if self.writer_thread.error is not None:
+                    evt = status_event(
+                        status="Writing the data capture failed: %s"
+                        % self.writer_thread.error)
+                    PostEvent(self.prsnt.frame, evt)
+                elif stats.queued >= batch_scans:
+                    evt = status_event(
+                        status="Writing %d scans behind, last write took %d ms"
+                        % (stats.queued, stats.latency * 1000))
+                    PostEvent(self.prsnt.frame, evt)
+        finally:
+            scheduler.close()
         self.data_collection = False
 
+    def export_capture(self):
+        """closes the capture files and adds the scans in them to the column
+        data file of their device, done once at the end of a data capture"""
+        writers, self.capture_writers = self.capture_writers, {}
+        if self.writer_thread is not None:
+            error = self.writer_thread.close()
+            stats = self.writer_thread.stats()
+            self.writer_thread = None
+            if error is not None:
+                self.prsnt.give_error(
+                    "File IO Error", "Writing the data capture failed, only "
+                    "%d scans were saved\n\n%s" % (stats.written, error))
+            evt = status_event(
+                status="%d scans written, at most %d queued, slowest write "
+                "%d ms" % (stats.written, stats.max_queued,
+                           stats.max_latency * 1000))
+            PostEvent(self.prsnt.frame, evt)
+        for dev, writer in writers.items():
+            writer.close()
+            if not writer.scans:
+                continue
+            file_type = '%s %s' % (dev.sensor_type, dev.grid)
+            labels = None
+            # a new column of wavelengths is started if the grid changed
+            if not os.path.exists(dev.file_path) or \
+               file_type != self.abstr.last_file_type:
+                labels = self.label_column(dev.x_data)
+            try:
+                export_columns(writer.file_path, dev.file_path, labels)
+            except (IOError, OSError), data:
+                self.prsnt.give_error(
+                    "File IO Error", "Could not write %s, the scans are in "
+                    "%s\n\n%s" % (dev.file_path, writer.file_path, data))
+            else:
+                self.abstr.last_file_type = file_type
+
     def save_data_to_file(self, file_path='', mode='r+', x_data=[],
-                          sensor_temp=None, active_mode=-1, active_unit=-1):
+                          sensor_temp=None, active_mode=-1, active_unit=-1,
+                          timestamp=None):
         """
         takes the data of the current graph and saves it to a file. If the
         file exists and append=True, data is appended to end of file
         if the file is already open it cannot be written too. in this case
-        the data is simply thrown away
+        the data is simply thrown away. timestamp is the time.time() the data
+        was taken at, now if not given
         """
         if not (self.abstr.y_data or self.abstr.multi_plot_data):
             msg = "Please take a reading before attempting this function."
@@ -368,63 +544,48 @@ class ASControl(object):
             # data.
             if self.abstr.y_data[0] is None:
                 return
-            self.abstr.current_file_type = self.devices[0].sensor_type
+            self.abstr.current_file_type = '%s %s' % (
+                self.devices[0].sensor_type, self.devices[0].grid)
             non_matching = self.abstr.current_file_type != \
                 self.abstr.last_file_type
+            x_data = self.devices[0].x_data
             column1 = []
             if not path_exists or non_matching:
-                column1 = ['Timestamp', 'Units'] + self.devices[0].x_data
-                column1 += ['-'] * (483-len(column1))
-                column1 += ['Integration Time (ms)','Integrated Total', 'PPF',
-                            'YPF', 'PPE', 'Fraction of Total', 'R/FR', 'Sensor Temp']
+                column1 = self.label_column(x_data)
                 if not non_matching:
                     mode = 'w'
-            content = ['%s %s' % (
-                datetime.datetime.now().strftime("%H:%M:%S %Y/%m/%d"),
-                self.devices[0].name), MODE_TO_UNITS[active_mode]]
-            if self.abstr.current_file_type == 'NIR':
-                content += self.abstr.y_data[0][:466] + ['-'] * 15 + \
-                    self.abstr.y_data[0][466:]
-            else:
-                content += self.abstr.y_data[0]
-            if active_mode == ENERGY_FLUX:
-                content.insert(-2, '-')
-                content.insert(-2, '-')
-                content.insert(-2, '-')
-            elif active_mode == ILLUMINANCE:
-                content.insert(-1, '-')
-                content.insert(-1, '-')
-                content.insert(-1, '-')
-            content += ["-"] * (491 - len(content))
-            if sensor_temp is not None:
-                content[-1] = sensor_temp
-            if active_mode == 4: #lux or fc
-                content[1] = content[1] % UNITS_TO_STR[active_unit]
+            content = self.data_column(self.devices[0], self.abstr.y_data[0],
+                                       active_mode, active_unit, sensor_temp,
+                                       timestamp)
             if column1:
                 content = ["%s,%s" % (column1[i], content[i])
                            for i in range(len(column1))]
         # create multiplot data
         else:
-            content = [""] * 491
+            data_rows = max([LEGACY_DATA_ROWS] + [
+                len(scan_data['x_data'])
+                for scan_data in self.abstr.multi_plot_data])
+            rows = data_rows + 2 + TRAILING_ROWS
+            content = [""] * rows
             for scan_data in self.abstr.multi_plot_data:
+                n = len(scan_data['x_data'])
                 new_col = ['Timestamp', 'Units'] + list(scan_data['x_data'])
-                new_col += ['-'] * (483 - len(new_col))
+                new_col += ['-'] * (data_rows + 2 - len(new_col))
                 new_col += ['Integration Time (ms)', 'Integrated Total', 'PPF',
-                           'YPF', 'PPE', 'Fraction of Total', 'R/FR', 'Sensor Temp']
+                           'YPF', 'PPE', 'Fraction of Total', 'R/FR', TEMP_LABEL,
+                           TEMP_TIME_LABEL]
                 i = 0
                 if content[0]:
                     content = ["%s,%s" % (content[i], new_col[i])
-                               for i in range(491)]
+                               for i in range(rows)]
                 else:
-                    content = ["%s" % new_col[i] for i in range(491)]
+                    content = ["%s" % new_col[i] for i in range(rows)]
                 for y_data in scan_data['y_data']:
                     new_col =['%s %s' % (
                         datetime.datetime.now().strftime("%H:%M:%S %Y/%m/%d"),
                         scan_data['labels'][0]), MODE_TO_UNITS[active_mode]]
-                    if len(y_data) < 480:
-                        new_col += y_data[:466] + ['-'] * 15 + y_data[466:]
-                    else:
-                        new_col += y_data
+                    new_col += y_data[:n] + ['-'] * (data_rows - n) + \
+                        y_data[n:]
                     if active_mode == ENERGY_FLUX:
                         new_col.insert(-2, '-')
                         new_col.insert(-2, '-')
@@ -433,11 +594,11 @@ class ASControl(object):
                         new_col.insert(-1, '-')
                         new_col.insert(-1, '-')
                         new_col.insert(-1, '-')
-                    new_col += ["-"] * (491 - len(new_col))
+                    new_col += ["-"] * (rows - len(new_col))
                     if active_mode == 4:
                         new_col[1] = new_col[1] % UNITS_TO_STR[active_unit]
                     content = ["%s,%s" % (content[i], new_col[i])
-                               for i in range(491)]
+                               for i in range(rows)]
                     i += 1
         try:
             if mode == 'r+' and path_exists:
@@ -452,16 +613,17 @@ class ASControl(object):
                     file_content.remove("")
                 except Exception:
                     pass
+                # files written on a different wavelength grid have a
+                # different number of rows
+                file_content = align_rows(file_content, len(content))
+                content = align_rows(content, len(file_content))
                 file_content = ["%s,%s" % (file_content[i], content[i])
-                                for i in range(491)]
+                                for i in range(len(content))]
             else:
                 file_content = content
-            with open(file_path + '_Backup', 'w') as data_file:
+            with atomic_write(file_path) as data_file:
                 data_file.write("\n".join(file_content))
-            with open(file_path, 'w') as data_file:
-                data_file.write("\n".join(file_content))
-            os.remove(file_path + "_Backup")
-        except IOError, data:
+        except (IOError, OSError), data:
             if not self.data_collection:
                 evt = event_error(title="File IO Error",
                                   msg="Could not open file %s\n\n Make sure its " \
@@ -470,103 +632,166 @@ class ASControl(object):
         else:
             self.abstr.last_file_type = self.abstr.current_file_type
 
+    def label_column(self, x_data):
+        """the first column of a column data file, labelling the rows"""
+        data_rows = max(LEGACY_DATA_ROWS, len(x_data))
+        column = ['Timestamp', 'Units'] + list(x_data)
+        column += ['-'] * (data_rows + 2 - len(column))
+        column += ['Integration Time (ms)', 'Integrated Total', 'PPF', 'YPF',
+                   'PPE', 'Fraction of Total', 'R/FR', TEMP_LABEL,
+                   TEMP_TIME_LABEL]
+        return column
+
+    def data_column(self, device, y_data, active_mode, active_unit,
+                    sensor_temp=None, timestamp=None):
+        """the column of a column data file holding y_data, a scan of device
+        and the totals that follow it. timestamp is the time.time() the data
+        was taken at, now if not given"""
+        n = len(device.x_data)
+        values = {'timestamp': timestamp_label(timestamp, device.name),
+                  'units': units_label(active_mode, active_unit),
+                  'spectrum': y_data[:n], 'extras': y_data[n:]}
+        content = []
+        for source in column_layout(n, len(y_data) - n, active_mode):
+            if source is None:
+                content.append('-')
+            elif source == 'temperature':
+                content.append('-' if sensor_temp is None else sensor_temp)
+            elif source == 'temp_time':
+                content.append('-')
+            elif isinstance(source, tuple):
+                content.append(values[source[0]][source[1]])
+            else:
+                content.append(values[source])
+        return content
+
     def connect_to_device(self):
         """connects to device, updates the spectrum, sets wavelength for the
         device, and updates prsnt to reflect new settings"""
         self.stop_all_threads()
-        possible = usb.core.find(find_all=True,
-                                 idVendor=0x2457,
-                                 idProduct=0x4000,
-                                 backend=backend)
-        possible = [dev for dev in possible]
+        possible = find_devices()
         if not possible:
             self.prsnt.give_error(
                 'Device Not Connected',
                 'There is no spectroradiometer connected to the Mesa.')
             return
-        devices = []
-        #sleep(0.5)
-        for dev in possible:
-            try:
-                dev.set_configuration()
-                cfg = dev.get_active_configuration()
-                intf = cfg[(0, 0)]
-                endpoint_out = usb.util.find_descriptor(
-                    intf, custom_match= \
-                    lambda e: \
-                    usb.util.endpoint_direction(e.bEndpointAddress) == \
-                    usb.util.ENDPOINT_OUT)
-                endpoint_in = usb.util.find_descriptor(
-                    intf, custom_match= \
-                    lambda e: \
-                    usb.util.endpoint_direction(e.bEndpointAddress) == \
-                    usb.util.ENDPOINT_IN)
-                try:
-                    try:
-                        # flush buffer of any previous data
-                        endpoint_in.read(3000, 10)
-                    except usb.core.USBError:
-                        pass
-                    endpoint_out.write(ALIAS)
-                    response = endpoint_in.read(64)
-                    try:
-                        device_alias = ''.join([chr(i) for i in \
-                                                response[24:24+response[23]]])
-                    except UnicodeDecodeError:
-                        # clear garbage from buffer and try again
-                        try:
-                            endpoint_in.read(3000, 10)
-                        except usb.core.USBError:
-                            pass
-                        endpoint_out.write(ALIAS)
-                        response = endpoint_in.read(64)
-                        device_alias = ''.join([chr(i) for i in \
-                                                response[24:24+response[23]]])
-                    if device_alias or device_alias == '':
-                        devices.append((dev, device_alias))
-                except usb.core.USBError, data:
-                    print data
-                finally:
-                    usb.util.release_interface(dev, 0)
-                    usb.util.dispose_resources(dev)
-            except (usb.core.USBError, NotImplementedError), data:
-                print data
-        for a in devices:
-            if a[1] in self.abstr.connected_devices:
-                devices.remove(a)
-        if len(devices) == 1:
-            try:
-                self.devices.append(Instrument(devices[0][0]))
-                alias = devices[0][1]
-            except usb.core.USBError, data:
-                print data
-        elif devices:
-            alias = self.prsnt.connection_settings_query(
-                self.abstr.device_alias, [a[1] for a in devices])
-            if alias is None:
-                return
-            self.abstr.device_alias = alias
-            for a in devices:
-                try:
-                    if a[1] == alias:
-                        self.devices.append(Instrument(a[0]))
-                        break
-                except Exception:
-                    pass
+        # the device monitor leaves the devices alone until they are added
+        with self.connect_lock:
+            self.connect_devices(possible)
+
+    def connect_devices(self, possible):
+        """lets the user choose which of the attached devices possible to
+        connect and adds them. only the alias of every device is read, the
+        ones chosen are then opened at once on the same handles and the
+        others released"""
+        # leave the devices that are already connected alone
+        possible = [dev for dev in possible
+                    if not any(same_device(dev, device.dev)
+                               for device in self.devices)]
+        probed = probe_devices(possible)
+        named = [device for device in probed
+                 if device.alias not in self.abstr.connected_devices]
+        if len(named) == 1:
+            chosen = named
+        elif named:
+            aliases = self.prsnt.connection_settings_query(
+                self.abstr.device_alias, [device.alias for device in named])
+            if not aliases:
+                aliases = []
+            elif len(aliases) == 1:
+                self.abstr.device_alias = aliases[0]
+            chosen = [device for device in named if device.alias in aliases]
         else:
+            chosen = []
+        for device in probed:
+            if device not in chosen:
+                release_device(device.dev)
+        if not named:
             self.prsnt.give_error(
                 'Device Not Connected',
                 'There is no spectroradiometer connected to this computer.')
+        if not chosen:
             return
-        self.abstr.connected_devices.append(alias)
-        device = self.devices[-1]
+        for device in open_instruments(chosen, self.device_cache):
+            self.add_device(device)
+
+    def add_device(self, device):
+        """adds an opened Instrument to the application"""
+        self.devices.append(device)
+        self.abstr.connected_devices.append(device.name)
+        device.idle_callback = self.prsnt.yield_to_gui
+        device.set_wavelength_grid(self.wavelength_grid)
+        device.set_temperature_policy(*self.abstr.temperature_policy)
+        device.scan_buffer.resize(self.abstr.scan_buffer_size)
         self.abstr.x_data_range = [device.x_data[0], device.x_data[-1]]
         self.prsnt.x_axis_limits = (device.x_data[0], device.x_data[-1])
         self.prsnt.x_data = device.x_data
         self.abstr.connected = True
         self.prsnt.enable_disconnect()
         self.prsnt.add_sensor_to_toolbar(device.name, self.right_click_menu)
-        return
+
+    def busy(self):
+        """True while continuous readings or a data capture are running"""
+        return self.data_collection or self.start_thread.is_set()
+
+    def on_device_attached(self, dev):
+        """Called by the device monitor thread when a sensor is plugged in. A
+        sensor that was lost is resumed where it left off. Any other sensor is
+        only opened once the user chooses it from the Connect menu, like the
+        sensors attached at start up. Returns False to be asked again on the
+        next poll."""
+        lost = [device for device in self.devices
+                if not device.attached.is_set()]
+        if lost:
+            # the Connect menu may have it open, look again once it is done
+            if not self.connect_lock.acquire(False):
+                return False
+            try:
+                if any(same_device(dev, device.dev)
+                       for device in self.devices):
+                    return True
+                instrument = open_instrument(dev, self.device_cache)
+                if instrument is None:
+                    return False
+                for device in lost:
+                    # the alias can be shared by several sensors, the serial
+                    # is not
+                    if device.serial == instrument.serial:
+                        device.take_over(instrument)
+                        if self.frames is not None:
+                            self.frames.add(device)
+                        evt = status_event(
+                            status="%s reconnected" % device.name)
+                        PostEvent(self.prsnt.frame, evt)
+                        return True
+                instrument.disconnect_spec()
+            finally:
+                self.connect_lock.release()
+        evt = status_event(status="A spectroradiometer was plugged in, use "
+                           "Connect to add it")
+        PostEvent(self.prsnt.frame, evt)
+        return True
+
+    def on_device_detached(self, dev):
+        """Called by the device monitor thread when a sensor is unplugged.
+        While readings are running the sensor is kept so it can be resumed
+        when it returns, otherwise it is disconnected."""
+        for device in self.devices:
+            if same_device(dev, device.dev) and device.attached.is_set():
+                self.device_lost(device)
+                if not self.busy():
+                    wx.CallAfter(self.disconnect, device)
+
+    def device_lost(self, device):
+        """stops waiting on a sensor that is no longer attached. the other
+        sensors carry on without it"""
+        device.attached.clear()
+        device.cancel()
+        if self.frames is not None:
+            self.frames.remove(device)
+        evt = status_event(
+            status="%s disconnected, waiting for it to return" % device.name)
+        PostEvent(self.prsnt.frame, evt)
 
     def disconnect_device(self):
         """disconnects a device from the application. if no other devices are
@@ -608,8 +833,6 @@ class ASControl(object):
             for dev in self.devices:
                 if dev.name == paired:
                     dev.paired = False
-        while not self.plot_data_queue.empty():
-            self.plot_data_queue.get()
         if len(self.devices) == 1:
             self.prsnt.x_data = self.devices[0].x_data
 
@@ -631,124 +854,164 @@ class ASControl(object):
         self.prsnt.color_map.Disable()
         if self.start_thread.is_set():
             return
+        self.publish_settings()
         self.start_thread.set()
         for device in self.devices:
-            device.change_units.set()
+            device.units = None
         self.abstr.multi_plot_data = {}
-        plot_thread = Thread(target=self.plot_data, name="Plot Thread")
+        self.frames = FrameAssembler(self.devices, self.abstr.frame_timeout,
+                                     self.abstr.pipeline_policy)
+        plot_thread = Thread(target=self.plot_data,
+                             kwargs={'frames': self.frames},
+                             name="Plot Thread")
         plot_thread.start()
         self.active_threads.append(plot_thread)
         for device in self.devices:
             thread = Thread(target=self.retrieve_data,
-                            kwargs={'device': device},
+                            kwargs={'device': device, 'frames': self.frames},
                             name="Data Retrieval Thread %s"
                             % device.name[-1])
             thread.start()
             self.active_threads.append(thread)
 
-    def plot_data(self):
-        """waits for plot data to be thrown on a thread safe queue by the data
-        retrieval thread and plots it. data comes in as a tuple of the form
-        (y_data, label, x_data)"""
+    def plot_data(self, frames):
+        """waits for the data retrieval threads to fill a frame and plots it.
+        frames is a FrameAssembler holding the y_data of every device"""
         multiplot = False
         if len(self.devices) > 1:
             multiplot = True
-            plot_data = []
-        while not self.plot_data_queue.empty():
-            self.plot_data_queue.get()
+            # the last scan of every device, a frame that timed out only
+            # holds the devices that were in time
+            latest = {}
         while not self.stop_thread.is_set():
-            if not self.devices:
-                return
             try:
+                frame = frames.get()
+            except QueueClosed:
+                return
+            if multiplot:
+                latest.update(frame)
+                plot_data = []
+                for dev, y_data in latest.items():
+                    # unplugged sensors are left out until they return
+                    if not dev.attached.is_set():
+                        continue
+                    scan = {}
+                    scan['y_data'] = [y_data]
+                    scan['labels'] = [dev.name]
+                    scan['x_data'] = dev.x_data
+                    plot_data.append(scan)
+                # sort the scans according to label/device.name so they
+                # are the same color from plot to plot and in the same
+                # position in the legend. legend position is used to 
+                # determine which data belongs to the active device
+                # in calibrated modes to display integrated totals
+                plot_data = sorted(plot_data,
+                                   key=lambda scan: scan['labels'][0])
+                paired = []
                 for dev in self.devices:
-                    if not dev.data_ready.is_set():
-                        raise Exception("Data not ready")
-            except Exception:
-                sleep(0.1)
-            else:
-                if multiplot:
-                    for dev in self.devices:
-                        scan = {}
-                        scan['y_data'] = [dev.y_data]
-                        scan['labels'] = [dev.name]
-                        scan['x_data'] = dev.x_data
-                        dev.data_ready.clear()
-                        plot_data.append(scan)
-                    if len(plot_data) == len(self.devices):
-                        # sort the scans according to label/device.name so they
-                        # are the same color from plot to plot and in the same
-                        # position in the legend. legend position is used to 
-                        # determine which data belongs to the active device
-                        # in calibrated modes to display integrated totals
-                        plot_data = sorted(plot_data,
-                                           key=lambda scan: scan['labels'][0])
-                        paired = []
-                        for dev in self.devices:
-                            if dev.paired:
-                                already_paired = False
-                                for p in paired:
-                                    if dev.name in p:
-                                        already_paired = True
-                                if not already_paired:
-                                    paired.append((dev.name, dev.paired))
-                        evt = plot_event(multiline=True,
-                                         plot_data=plot_data,
-                                         average=False,
-                                         active_device=self.active_device.name,
-                                         paired=paired)
-                        try:
-                            PostEvent(self.prsnt.frame, evt)
-                        except Exception:
-                            pass
-                        self.abstr.multi_plot_data = plot_data
-                        plot_data = []
-                else:
-                    evt = plot_event(plot_data=self.devices[0].y_data,
-                                     label=self.devices[0].name)
-                    self.devices[0].data_ready.clear()
-                    try:
-                        PostEvent(self.prsnt.frame, evt)
-                    except Exception:
-                        pass
-
-    def retrieve_data(self, device):
-        """the intent is that the data retrieval thread stays in this loop while
-        taking continuous readings"""
-        while not self.stop_thread.is_set():
-            while (self.pause_thread.is_set()):
-                evt = toolbar_event(enable=True)
+                    if dev.paired:
+                        already_paired = False
+                        for p in paired:
+                            if dev.name in p:
+                                already_paired = True
+                        if not already_paired:
+                            paired.append((dev.name, dev.paired))
+                active_device = self.settings.current.active_device
+                evt = plot_event(multiline=True,
+                                 plot_data=plot_data,
+                                 average=False,
+                                 active_device=active_device,
+                                 paired=paired)
                 try:
                     PostEvent(self.prsnt.frame, evt)
                 except Exception:
                     pass
-                if self.stop_thread.is_set():
+                self.abstr.multi_plot_data = plot_data
+            else:
+                for dev, y_data in frame.items():
+                    evt = plot_event(plot_data=y_data, label=dev.name)
                     try:
-                        evt = toolbar_event(enable=True)
-                        PostEvent(self.prsnt.frame, evt)
-                        evt = status_event(status="")
                         PostEvent(self.prsnt.frame, evt)
                     except Exception:
                         pass
-                    return
-                sleep(0.005)
-            try:
-                while device.data_ready.is_set():
-                    sleep(0.05)
-                self.get_active_signal_data(device)
-            except DeviceCommunicationError, data:
-                evt = event_error(title="Connection Error", msg=data.message)
-                PostEvent(self.prsnt.frame, evt)
-                self.stop_all_threads()
-            except InvalidCommandError:
-                self.stop_all_threads()
-            else:
-                self.abstr.y_data = [device.y_data]
-                if self.active_device.name == device.name:
-                    evt = status_event(integ_time=device.prev_integ)
+
+    def retrieve_data(self, device, frames):
+        """the intent is that the data retrieval thread stays in this loop while
+        taking continuous readings. with pipelined acquisition the next scan is
+        taken by an AcquisitionPipeline while this thread corrects and plots
+        the previous one. the results are put in frames for the plot thread"""
+        pipeline = None
+        try:
+            while not self.stop_thread.is_set():
+                if self.pause_thread.is_set() and pipeline is not None:
+                    pipeline.stop()
+                    pipeline = None
+                while (self.pause_thread.is_set()):
+                    evt = toolbar_event(enable=True)
                     try:
                         PostEvent(self.prsnt.frame, evt)
                     except Exception:
                         pass
+                    if self.stop_thread.is_set():
+                        try:
+                            evt = toolbar_event(enable=True)
+                            PostEvent(self.prsnt.frame, evt)
+                            evt = status_event(status="")
+                            PostEvent(self.prsnt.frame, evt)
+                        except Exception:
+                            pass
+                        return
+                    sleep(0.005)
+                if not device.attached.is_set():
+                    # unplugged, wait for the device monitor to bring it back
+                    device.attached.wait(0.5)
+                    continue
+                try:
+                    if self.abstr.pipelined_acquisition:
+                        if pipeline is None:
+                            pipeline = AcquisitionPipeline(
+                                device,
+                                lambda: self.apply_device_settings(
+                                    device, self.settings.current),
+                                self.abstr.pipeline_policy)
+                            pipeline.start()
+                        try:
+                            scan = pipeline.get()
+                        except (DeviceCommunicationError, QueueClosed):
+                            # the acquisition thread has stopped
+                            pipeline = None
+                            raise
+                        self.process_scan(device, scan,
+                                          self.settings.current)
+                    else:
+                        self.get_active_signal_data(device,
+                                                    self.settings.current)
+                except (AcquisitionCancelled, QueueClosed):
+                    # stop_all_threads cancelled the scan, stop_thread is set,
+                    # or the device was unplugged
+                    pass
+                except DeviceCommunicationError, data:
+                    if not device.is_attached():
+                        self.device_lost(device)
+                        continue
+                    evt = event_error(title="Connection Error",
+                                      msg=data.message)
+                    PostEvent(self.prsnt.frame, evt)
+                    self.stop_all_threads()
+                except InvalidCommandError:
+                    self.stop_all_threads()
+                else:
+                    self.abstr.y_data = [device.y_data]
+                    frames.put(device, device.y_data)
+                    if self.settings.current.active_device == device.name:
+                        evt = status_event(integ_time=device.prev_integ)
+                        try:
+                            PostEvent(self.prsnt.frame, evt)
+                        except Exception:
+                            pass
+        finally:
+            if pipeline is not None:
+                pipeline.stop()
         try:
             evt = toolbar_event(enable=True)
             PostEvent(self.prsnt.frame, evt)
@@ -757,119 +1020,185 @@ class ASControl(object):
         except Exception:
             pass
 
-    def get_active_signal_data(self, device):
-        """determines which plot mode is active and returns the data
-        accordingly"""
-        active_mode = self.prsnt.active_mode
-        if device.update_integ.is_set():
-            device.auto_integration = self.abstr.auto_integrate
+    def gui_settings(self):
+        """reads the settings the worker threads need from the gui"""
+        return dict(mode=self.prsnt.active_mode,
+                    unit=self.prsnt.active_unit,
+                    integ_time=self.abstr.integ_time,
+                    auto_integrate=self.abstr.auto_integrate,
+                    average_scans=self.abstr.average_scans,
+                    integ_lines=tuple(self.prsnt.integ_lines),
+                    fractional_lines=tuple(self.prsnt.fractional_lines),
+                    active_device=self.prsnt.active_device)
+
+    def publish_settings(self):
+        """takes a new snapshot of the gui for the worker threads, they pick
+        it up before their next scan. main thread only. scans under way with
+        device settings that changed are abandoned, so a long integration
+        does not hold up the change"""
+        previous = self.settings.current
+        settings = self.settings.publish(**self.gui_settings())
+        if self.start_thread.is_set() and \
+           changed(previous, settings, *DEVICE_SETTINGS):
+            for device in self.devices:
+                device.cancel()
+        return settings
+
+    def apply_device_settings(self, device, settings):
+        """sends the integration and averaging changes in settings that the
+        device does not have yet"""
+        previous = device.settings
+        if changed(previous, settings, 'auto_integrate', 'integ_time'):
+            device.auto_integration = settings.auto_integrate
             if not device.auto_integration:
-                device.set_integration_period(self.abstr.integ_time)
-            device.update_integ.clear()
-        if device.update_average_scans.is_set():
-            device.set_scans_to_avg(self.abstr.average_scans)
-            device.update_average_scans.clear()
-        if active_mode == RELATIVE:
-            self.get_relative_signal(device)
-        elif active_mode == RT:
-            if not (device.dark_reference and device.light_reference):
-                msg = "Please take a Dark and Light Reference point for %s" \
-                    "\n before attempting to plot Reflectance/Transmittance"
-                self.prsnt.give_error("No Light/Dark Reference",
-                                             msg % device.name)
-                raise InvalidCommandError
-            self.get_reflectance_transmittance(device)
-        else:
-            self.get_irradiance(device)
+                device.set_integration_period(settings.integ_time)
+            elif changed(previous, settings, 'auto_integrate'):
+                device.seed_exposure()
+        if changed(previous, settings, 'average_scans'):
+            device.set_scans_to_avg(settings.average_scans)
+        device.settings = settings
+        if previous is not None and self.start_thread.is_set() and \
+           changed(previous, settings, *DEVICE_SETTINGS):
+            latency = time.time() - settings.published
+            evt = status_event(status="%s settings applied in %d ms"
+                               % (device.name, latency * 1000))
+            PostEvent(self.prsnt.frame, evt)
 
-    def get_relative_signal(self, device):
-        """returns the raw singal as digital counts"""
-        if device.change_units.is_set():
+    def apply_units(self, device, settings):
+        """sets the units of the mode in settings if the device is not in it
+        already. the graph label is set on the main thread"""
+        units = (settings.mode, settings.unit)
+        if device.units == units:
+            return
+        if settings.mode in [ENERGY_FLUX, ILLUMINANCE]:
+            device.irrad_unit = WATTS_PER_METER_SQUARED
+            if settings.unit == LUX:
+                label = LUX_LABEL
+            elif settings.unit == FOOTCANDLE:
+                label = FC_LABEL
+            else:
+                label = WM2_LABEL
+        elif settings.mode == PHOTON_FLUX:
+            device.irrad_unit = MICRO_MOLES
+            label = MICROMOL_LABEL
+        elif settings.mode == RT:
             device.irrad_unit = COUNTS
-            device.change_units.clear()
-            self.prsnt.label = r'Counts'
-        device.get_spectrum()
+            label = r'Reflectance/Transmittance [$\%$]'
+        else:
+            device.irrad_unit = COUNTS
+            label = r'Counts'
+        device.units = units
+        wx.CallAfter(self.set_label, label)
+
+    def set_label(self, label):
+        self.prsnt.label = label
+
+    def check_references(self, device):
+        if not (device.dark_reference and device.light_reference):
+            msg = "Please take a Dark and Light Reference point for %s" \
+                "\n before attempting to plot Reflectance/Transmittance"
+            self.prsnt.give_error("No Light/Dark Reference",
+                                         msg % device.name)
+            raise InvalidCommandError
+
+    def process_scan(self, device, scan, settings):
+        """the processing stage of pipelined readings, corrects a Scan taken
+        by an AcquisitionPipeline and computes the totals for the mode in
+        settings"""
+        rt = settings.mode == RT
+        if rt:
+            self.check_references(device)
+        self.apply_units(device, settings)
+        # corrected at the integration time the scan was taken at, later
+        # scans may already use another one
+        device.y_data = device.correct_data(scan.pixels, rt, scan.integ) + \
+            [scan.integ]
+        if settings.mode not in [RELATIVE, RT]:
+            self.compute_totals(device, settings)
+
+    def get_active_signal_data(self, device, settings):
+        """takes a reading in the mode in settings"""
+        self.apply_device_settings(device, settings)
+        self.apply_units(device, settings)
+        if settings.mode == RELATIVE:
+            device.get_spectrum()
+        elif settings.mode == RT:
+            self.check_references(device)
+            device.get_spectrum(rt=True)
+        else:
+            self.get_irradiance(device, settings)
 
-    def get_irradiance(self, device):
+    def get_irradiance(self, device, settings):
         """returns irradiance signal in either micromol or W/m^2"""
-        active_mode = self.prsnt.active_mode
-        active_unit = self.prsnt.active_unit
-        if device.change_units.is_set():
-            if active_mode == ENERGY_FLUX or active_mode == ILLUMINANCE:
-                device.irrad_unit = WATTS_PER_METER_SQUARED
-                if active_unit == LUX:
-                    self.prsnt.label = LUX_LABEL
-                elif active_unit == FOOTCANDLE:
-                    self.prsnt.label = FC_LABEL
-                else:
-                    self.prsnt.label = WM2_LABEL
-            elif active_mode == PHOTON_FLUX:
-                device.irrad_unit = MICRO_MOLES
-                self.prsnt.label = MICROMOL_LABEL
-            device.change_units.clear()
         device.start_measurement()
-        inc = (device.prev_integ/1000000.0 * device.avg_scans + 0.01)/10
-        for i in range(10):
-            sleep(inc)
-            wx.YieldIfNeeded()
         device.acquire_measurement()
-        if active_unit == LUX:
+        self.compute_totals(device, settings)
+
+    def compute_totals(self, device, settings):
+        """converts y_data to the unit in settings and appends the integrated
+        totals of its mode"""
+        if settings.unit == LUX:
             device.y_data = self.calculate_lux(device.y_data, device.x_data)
-        elif active_unit == FOOTCANDLE:
+        elif settings.unit == FOOTCANDLE:
             device.y_data = self.calculate_lux(device.y_data, device.x_data,
                                                fc=True)
-        if active_mode in [ENERGY_FLUX, ILLUMINANCE]:
-            device.y_data = self.integrate_range(device.x_data, device.y_data)
-        if active_mode == ILLUMINANCE:
+        if settings.mode in [ENERGY_FLUX, ILLUMINANCE]:
+            device.y_data = self.integrate_range(device.x_data, device.y_data,
+                                                 settings)
+        if settings.mode == ILLUMINANCE:
             del device.y_data[-2:]
-        elif active_mode == PHOTON_FLUX:
-            device.y_data = self.calculate_ypf(device.x_data, device.y_data)
-        device.data_ready.set()
-
-    def integrate_range(self, x_range, y):
-        """calculates an integrated total"""
+        elif settings.mode == PHOTON_FLUX:
+            device.y_data = self.calculate_ypf(device.x_data, device.y_data,
+                                               settings)
+
+    def integrate_range(self, x_range, y, settings=None):
+        """calculates an integrated total. each point is weighted by the width
+        of the wavelength bin it represents. worker threads pass the settings
+        with the integration range, otherwise it is read from the gui"""
         total = fraction = i = r = fr = 0
-        integ_range = self.prsnt.integ_lines
-        fractional_range = self.prsnt.fractional_lines
+        widths = bin_widths(x_range)
+        integ_range, fractional_range = self.integration_ranges(settings)
         red, far_red = RED_FARRED
         for x in x_range:
+            area = y[i] * widths[i]
             if integ_range[0] <= x <= integ_range[1]:
-                total += y[i]
+                total += area
             if fractional_range[0] <= x <= fractional_range[1]:
-                fraction += y[i]
+                fraction += area
             if red[0] <= x <= red[1]:
-                r += y[i]
+                r += area
             if far_red[0] <= x <= far_red[1]:
-                fr += y[i]
+                fr += area
             i += 1
         return y + [total, fraction/total, r/fr]
 
-    def calculate_ypf(self, x_range, y):
+    def calculate_ypf(self, x_range, y, settings=None):
         """calculates an integrated total, ypf, ppf, and ppe, fraction/total"""
         if not y:
             return
         total = fraction = ypf = ppf = ppe_r = ppe_fr = i = r = fr = 0
-        integ_range = self.prsnt.integ_lines
-        fractional_range = self.prsnt.fractional_lines
+        widths = bin_widths(x_range)
+        integ_range, fractional_range = self.integration_ranges(settings)
         red, far_red = RED_FARRED
         for x in x_range:
             x = int(x)
             yp = 0
+            area = y[i] * widths[i]
             if 300 <= x <= 800:
-                yp = y[i] * RQE[x - 300]
+                yp = area * RQE[x - 300]
                 ypf += yp
-                ppe_r += y[i] * SIGMA_R[x - 300]
-                ppe_fr += y[i] * SIGMA_FR[x - 300]
+                ppe_r += area * SIGMA_R[x - 300]
+                ppe_fr += area * SIGMA_FR[x - 300]
             if 400 <= x <= 700:
-                ppf += y[i]
+                ppf += area
             if integ_range[0] <= x <= integ_range[1]:
-                total += y[i]
+                total += area
             if fractional_range[0] <= x <= fractional_range[1]:
-                fraction += y[i]
+                fraction += area
             if red[0] <= x <= red[1]:
-                r += y[i]
+                r += area
             if far_red[0] <= x <= far_red[1]:
-                fr += y[i]
+                fr += area
             i += 1
         if ppe_r:
             ppe = ppe_r/(ppe_r + ppe_fr)
@@ -879,6 +1208,11 @@ class ASControl(object):
             total = 1 # avoid division by zero
         return y + [total, ppf, ypf, ppe, fraction/total, r/fr]
 
+    def integration_ranges(self, settings=None):
+        if settings is None:
+            return self.prsnt.integ_lines, self.prsnt.fractional_lines
+        return settings.integ_lines, settings.fractional_lines
+
     def calculate_lux(self, data, x_data, fc = False):
         if not data: return
         y = []
@@ -893,14 +1227,6 @@ class ASControl(object):
             i += 1
         return y + data[-1:]
 
-    def get_reflectance_transmittance(self, device):
-        """plots reflactance/transmittance as a percentage"""
-        if device.change_units.is_set():
-            device.irrad_unit = COUNTS
-            device.change_units.clear()
-            self.prsnt.label = r'Reflectance/Transmittance [$\%$]'
-        device.get_spectrum(rt=True)
-
     def calculate_r_t(self, data, device):
         """calculates the reflectance/transmittance percentage based on the
         saved dark and light reference"""
@@ -939,10 +1265,10 @@ class ASControl(object):
         busy = self.prsnt.busy("Taking Dark Reference Scan")
         try:
             data = device.get_pixel_data()
-            temp = device.get_internal_temp()
-            temperature_compensation = AT * temp ** 3 + \
-                BT * temp ** 2 + CT * temp
-            device.dark_reference = [i - 1500 - temperature_compensation for i in data]
+            # references always get a fresh temperature reading
+            device.sample_temperature()
+            device.dark_reference = device.engine.remove_offset(
+                data, device.temp_compensation).tolist()
             device.dark_integ = device.prev_integ
         except DeviceCommunicationError, data:
             busy.Destroy()
@@ -996,10 +1322,9 @@ class ASControl(object):
         busy = self.prsnt.busy("Taking Light Reference Scan")
         try:
             data = device.get_pixel_data()
-            temp = device.get_internal_temp()
-            temperature_compensation = AT * temp ** 3 + \
-                BT * temp ** 2 + CT * temp
-            device.light_reference = [i - 1500 - temperature_compensation for i in data]
+            device.sample_temperature()
+            device.light_reference = device.engine.remove_offset(
+                data, device.temp_compensation).tolist()
         except DeviceCommunicationError, data:
             busy = None
             del(busy)
@@ -1034,12 +1359,13 @@ class ASControl(object):
         self.prsnt.confirmation_message(msg, "Success!")
 
     def compute_derivative(self, data):
-        """performs a very rudimentary numerical derivative of the data set.
-        because our steps in the x axis are one, no division is necessary"""
+        """performs a very rudimentary numerical derivative of the data set
+        over the wavelength grid currently plotted"""
+        x_data = self.prsnt.x_data
         i = 1
         derivative = []
-        while i < self.abstr.x_data_range[1] - self.abstr.x_data_range[0] + 1:
-            derivative.append((data[i] - data[i-1]))
+        while i < len(x_data):
+            derivative.append((data[i] - data[i-1]) / (x_data[i] - x_data[i-1]))
             i += 1
         derivative.append(0.0)
         return derivative
@@ -1067,21 +1393,19 @@ class ASControl(object):
         """lets the thread know a new user specified integration time needs to
         be set"""
         self.abstr.integ_time = self.prsnt.integ_time
-        for device in self.devices:
-            device.update_integ.set()
+        self.publish_settings()
 
     def set_auto_integration(self, auto_on):
         """resets the device to auto-integration and lets the thread know a new
         integration time needs to be set"""
         self.abstr.auto_integrate = auto_on
-        for device in self.devices:
-            device.update_integ.set()
         self.prsnt.integration_time.Enable(not auto_on)
         if not auto_on:
             if self.abstr.connected:
                 self.prsnt.integration_time.SetValue(
                     self.active_device.prev_integ/1000)
                 self.abstr.integ_time = self.active_device.prev_integ
+        self.publish_settings()
 
     def set_auto_scale(self, auto_on):
         self.prsnt.set_auto_scale(not auto_on)
@@ -1089,8 +1413,7 @@ class ASControl(object):
     def update_number_of_scans_to_average(self):
         """lets the thread know a new number of average scans needs to be set"""
         self.abstr.average_scans = self.prsnt.average_scans
-        for device in self.devices:
-            device.update_average_scans.set()
+        self.publish_settings()
 
     def update_mode_and_units(self):
         """since plot signal checks the graph mode before each plot, this method
@@ -1098,9 +1421,7 @@ class ASControl(object):
         self.prsnt.enable_units()
         self.active_mode = self.prsnt.active_mode
         self.active_unit = self.prsnt.active_unit
-        d = False
-        for device in self.devices:
-            device.change_units.set()
+        self.publish_settings()
 
     def validate_and_update_y_axis(self):
         """make sure miniminum value is less than maximum value and update
@@ -1156,14 +1477,13 @@ class ASControl(object):
             self.prsnt.refresh_plot_defaults(
                 multi_plot=self.abstr.multi_plot_data)
         else:
+            x_data = self.prsnt.x_data
             if self.active_mode == PHOTON_FLUX:
                 self.abstr.y_data[0] = self.calculate_ypf(
-                    range(self.abstr.x_data_range[0], self.abstr.x_data_range[1] + 1),
-                    self.abstr.y_data[0][:self.abstr.x_data_range[1] + 1 - self.abstr.x_data_range[0]])
+                    x_data, self.abstr.y_data[0][:len(x_data)])
             elif self.active_mode in [ENERGY_FLUX]:
                 self.abstr.y_data[0] = self.integrate_range(
-                    range(self.abstr.x_data_range[0], self.abstr.x_data_range[1] + 1),
-                    self.abstr.y_data[0][:self.abstr.x_data_range[1] + 1 - self.abstr.x_data_range[0]])
+                    x_data, self.abstr.y_data[0][:len(x_data)])
             self.prsnt.refresh_plot_defaults(
                 self.abstr.x_data_range, self.abstr.y_data)
 
@@ -1180,9 +1500,7 @@ class ASControl(object):
         if units is not None:
             self.prsnt.active_unit = units
         self.prsnt.enable_units()
-        d = False
-        for device in self.devices:
-            device.change_units.set()
+        self.publish_settings()
         try:
             if self.active_threads:
                 return
@@ -1190,6 +1508,27 @@ class ASControl(object):
             pass
         self.take_and_plot_snapshot()
 
+    def change_wavelength_grid(self, grid):
+        """handles the menu -> view -> wavelength grid selection. takes a new
+        snapshot on the new grid if a device is connected"""
+        self.stop_all_threads()
+        self.abstr.wavelength_grid = grid
+        self.apply_wavelength_grid(grid)
+        if self.devices:
+            self.take_and_plot_snapshot()
+
+    def apply_wavelength_grid(self, grid):
+        """switches every connected device to the given output grid, without
+        saving it in the settings"""
+        self.wavelength_grid = grid
+        self.prsnt.check_wavelength_grid(grid)
+        for device in self.devices:
+            device.set_wavelength_grid(grid)
+        if self.devices:
+            device = self.active_device or self.devices[-1]
+            self.abstr.x_data_range = [device.x_data[0], device.x_data[-1]]
+            self.prsnt.x_data = device.x_data
+
     def set_calibrate_mode(self):
         """adds a few extra buttons and allows pixel picker event"""
         self.stop_all_threads()
@@ -1197,6 +1536,14 @@ class ASControl(object):
             self.connect_to_device()
             if not self.abstr.connected:
                 return
+        # irradiance calibrations are always taken on the 1 nm grid, the
+        # grid chosen is back once calibration mode is left
+        if self.prsnt.calibrate_mode:
+            grid = self.abstr.wavelength_grid
+        else:
+            grid = DEFAULT_GRID
+        if self.wavelength_grid != grid:
+            self.apply_wavelength_grid(grid)
         self.prsnt.set_calibration_mode(len(self.devices),
                                         self.light_reference_cal,
                                         self.set_hot_pixel,
@@ -1247,7 +1594,9 @@ class ASControl(object):
     def calibrate(self, device, lock_code):
         self.prsnt.active_mode = RELATIVE
         self.prsnt.enable_units()
+        self.publish_settings()
         device.irrad_unit = COUNTS
+        device.units = None
         try:
             device.get_spectrum()
             device.calibration_scan = device.y_data
@@ -1297,16 +1646,17 @@ class ASControl(object):
         self.prsnt.active_mode = RELATIVE
         self.prsnt.enable_units()
         device = self.active_device
+        # we want at least a 5 scan average of all devices
+        self.prsnt.average_scans = 5
+        self.abstr.average_scans = 5
+        settings = self.publish_settings()
         for dev in self.devices:
             if dev == device:
                 dev.irrad_unit = COUNTS
             else:
                 dev.irrad_unit = MICRO_MOLES
-            dev.change_units.clear()
-            # we want at least a 5 scan average of all devices
-            self.prsnt.average_scans = 5
-            self.abstr.average_scans = 5
-            dev.update_average_scans.set()
+            # keep these units rather than the ones of relative mode
+            dev.units = (settings.mode, settings.unit)
         for dev in self.devices:
             try:
                 self.spectrum_snapshot(dev)
@@ -1416,42 +1766,11 @@ class ASControl(object):
             # reason I can't explicitly catch so I'm using a catch all here.
             # this error is raised when wx.Yield is called recursively
             pass
+        settings = self.publish_settings()
         for dev in self.devices:
-            if dev.change_units.is_set():
-                if self.prsnt.active_mode in [ENERGY_FLUX, ILLUMINANCE]:
-                    dev.irrad_unit = WATTS_PER_METER_SQUARED
-                    if self.prsnt.active_unit == LUX:
-                        self.prsnt.label = LUX_LABEL
-                    elif self.prsnt.active_unit == FOOTCANDLE:
-                        self.prsnt.label = FC_LABEL
-                    else:
-                        self.prsnt.label = WM2_LABEL
-                elif self.prsnt.active_mode == PHOTON_FLUX:
-                    dev.irrad_unit = MICRO_MOLES
-                    self.prsnt.label = MICROMOL_LABEL
-                elif self.prsnt.active_mode == RT:
-                    dev.irrad_unit = COUNTS
-                    self.prsnt.label = r'Reflectance/Transmittance [$\%$]'
-                else:
-                    dev.irrad_unit = COUNTS
-                    self.prsnt.label = r'Counts'
-                dev.change_units.clear()
-            if dev.update_integ.is_set():
-                dev.auto_integration = self.abstr.auto_integrate
-                if not dev.auto_integration:
-                    dev.set_integration_period(self.abstr.integ_time)
-                dev.update_integ.clear()
-            if dev.update_average_scans.is_set():
-                dev.set_scans_to_avg(self.abstr.average_scans)
-                dev.update_average_scans.clear()
+            self.apply_units(dev, settings)
+            self.apply_device_settings(dev, settings)
         if len(self.devices) > 1:
-            for dev in self.devices:
-                dev.start_measurement()
-            inc = ((self.devices[-1].prev_integ/1000000.0 + 0.01) * \
-                   self.devices[-1].avg_scans)/10
-            for i in range(10):
-                sleep(inc)
-                wx.YieldIfNeeded()
             self.pull_multi_device_data()
             self.prsnt.integ_time = self.abstr.integ_time = \
                 self.active_device.prev_integ
@@ -1464,7 +1783,7 @@ class ASControl(object):
             self.prsnt.current_process("")
             return
         try:
-            self.get_active_signal_data(device)
+            self.get_active_signal_data(device, settings)
         except DeviceCommunicationError, data:
             self.prsnt.current_process("")
             self.prsnt.give_error("Connection Error", data.message)
@@ -1473,18 +1792,25 @@ class ASControl(object):
         self.prsnt.plot_signal(device.y_data, device.name)
         self.prsnt.integ_time = self.abstr.integ_time = device.prev_integ
         self.prsnt.current_process("")
-        device.data_ready.clear()
         busy = None
         del(busy)
 
     def pull_multi_device_data(self):
+        """measures on every device at once and plots the results"""
         plot_data = []
-        for device in self.devices:
+        scheduler = AcquisitionScheduler(self.devices, self.prsnt.yield_to_gui)
+        try:
+            measurements = scheduler.measure(rt=self.prsnt.active_mode == RT)
+        finally:
+            scheduler.close()
+        for measurement in measurements:
+            device = measurement.device
             try:
                 scan_data = {}
                 scan_data['x_data'] = device.x_data
                 scan_data['labels'] = [device.name]
-                device.acquire_measurement(self.prsnt.active_mode == RT)
+                if measurement.error is not None:
+                    raise measurement.error
                 if self.prsnt.active_unit == LUX:
                     device.y_data = self.calculate_lux(device.y_data, device.x_data)
                 elif self.prsnt.active_unit == FOOTCANDLE:
@@ -1521,6 +1847,7 @@ class ASControl(object):
 
     def update_vlines(self):
         self.prsnt.update_vlines()
+        self.publish_settings()
         self.reset_original_plot()
 
     # close apogee spectrovision
@@ -1532,37 +1859,68 @@ class ASControl(object):
         self.prsnt.current_process("")
         self.start_thread.clear()
         self.stop_thread.set()
-        self.active_threads = []
+        if self.frames is not None:
+            self.frames.close()
+        # wake up any data retrieval thread waiting on a spectrum
+        for device in self.devices:
+            device.cancel()
+        threads, self.active_threads = self.active_threads, []
+        if threads:
+            self.wait_for_threads(threads)
         if shutdown:
+            self.monitor.stop()
             from threading import active_count
             while active_count() < 1:
                 sleep(0.1)
 
+    def wait_for_threads(self, threads):
+        """waits up to STOP_TIMEOUT seconds for the reading threads to finish
+        and reports how long they took and how long the slowest device took
+        to abandon its scan"""
+        start = time.time()
+        for thread in threads:
+            if thread is not current_thread():
+                thread.join(max(0, start + STOP_TIMEOUT - time.time()))
+        elapsed = time.time() - start
+        if any(thread.is_alive() for thread in threads
+               if thread is not current_thread()):
+            status = "Still stopping after %.1f s" % elapsed
+        else:
+            status = "Stopped in %d ms" % (elapsed * 1000)
+        latencies = [device.stop_latency for device in self.devices
+                     if device.stop_latency is not None]
+        if latencies:
+            status += ", scan abandoned in %d ms" % (max(latencies) * 1000)
+        PostEvent(self.prsnt.frame, status_event(status=status))
+
     def pause_all_threads(self):
         self.prsnt.color_map.Enable()
         self.prsnt.current_process("Paused...")
         self.pause_thread.set()
+        # the scans under way are abandoned rather than waited for
+        for device in self.devices:
+            device.cancel()
 
     def right_click_menu(self, event):
         self.old_name = event.GetEventObject().GetLabel()
         v = n = paired = False
         for dev in self.devices:
             if dev.name == self.old_name:
-                if dev.x_data[0] == 340 and dev.paired == False:
+                if dev.sensor_type == 'VIS' and dev.paired == False:
                     v = True
-                elif dev.x_data[0] == 635 and dev.paired == False:
+                elif dev.sensor_type == 'NIR' and dev.paired == False:
                     n = True
                 if dev.paired:
                     paired = True
                 break
         if v:
             for dev in self.devices:
-                if dev.x_data[0] == 635 and dev.paired == False:
+                if dev.sensor_type == 'NIR' and dev.paired == False:
                     n = True
                     break
         elif n:
             for dev in self.devices:
-                if dev.x_data[0] == 340 and dev.paired == False:
+                if dev.sensor_type == 'VIS' and dev.paired == False:
                     v = True
                     break
         self.prsnt.pop_up_menu(self.process_choice, v and n, paired)
@@ -1586,6 +1944,7 @@ class ASControl(object):
                     sensor.Refresh()
                     break
             self.prsnt.tool_bar.Realize()
+            self.publish_settings()
         elif choice == 1:
             # disconnect sensor
             dev = [i for i in self.devices if i.name == self.old_name][0]
@@ -1598,15 +1957,15 @@ class ASControl(object):
                 if self.old_name == dev.name:
                     selected = dev
                     break
-            if selected.x_data[0] == 340:
+            if selected.sensor_type == 'VIS':
                 find_nir = True
             else:
                 find_nir = False
             choices = []
             for dev in self.devices:
-                if find_nir == True and dev.x_data[0] == 635 and dev.paired is False:
+                if find_nir == True and dev.sensor_type == 'NIR' and dev.paired is False:
                     choices.append(dev.name)
-                elif find_nir == False and dev.x_data[0] == 340 and dev.paired is False:
+                elif find_nir == False and dev.sensor_type == 'VIS' and dev.paired is False:
                     choices.append(dev.name)
             if len(choices) == 1:
                 pair_with = choices[0]
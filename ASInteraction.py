@@ -5,6 +5,8 @@ import wx
 
 from constants import RELATIVE, RT, PHOTON_FLUX, ILLUMINANCE, ENERGY_FLUX,\
      LUX, FOOTCANDLE
+from ASPresentation import GRID_MENU_ID
+from Resampling import WAVELENGTH_GRIDS
 
 
 class ASInteraction(object):
@@ -21,6 +23,8 @@ class ASInteraction(object):
                                 id=102)
         presentation.frame.Bind(wx.EVT_MENU, self.on_menu_red_farred,
                                 id=103)
+        presentation.frame.Bind(wx.EVT_MENU, self.on_menu_save_buffer,
+                                id=104)
         presentation.frame.Bind(wx.EVT_MENU, self.on_menu_exit, id=wx.ID_EXIT)
 
         # view menu
@@ -36,6 +40,10 @@ class ASInteraction(object):
                                 self.on_view_menu(event, lx=True), id=204)
         presentation.frame.Bind(wx.EVT_MENU, lambda event:
                                 self.on_view_menu(event, fc=True), id=205)
+        for i, (grid, step) in enumerate(WAVELENGTH_GRIDS):
+            presentation.frame.Bind(wx.EVT_MENU, lambda event, grid=grid:
+                                    self.on_grid_menu(event, grid),
+                                    id=GRID_MENU_ID + i)
 
         # help menu
         presentation.frame.Bind(wx.EVT_MENU, self.on_menu_leftpanel_help, id=300)
@@ -203,6 +211,9 @@ class ASInteraction(object):
     def on_menu_red_farred(self, event):
         self.control.update_red_farred()
 
+    def on_menu_save_buffer(self, event):
+        self.control.save_buffered_scans()
+
     def on_menu_exit(self, event):
         self.control.shutdown_application()
 
@@ -229,6 +240,9 @@ class ASInteraction(object):
             units = FOOTCANDLE
         self.control.change_plot_view(mode, units)
 
+    def on_grid_menu(self, event, grid):
+        self.control.change_wavelength_grid(grid)
+
     def on_menu_leftpanel_help(self, event):
         self.control.show_help_menu(0)
 
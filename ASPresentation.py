@@ -17,9 +17,13 @@ from constants import VERSION, IS_GTK, IS_WIN, IS_MAC, RELATIVE, PHOTON_FLUX, \
      TOOLBAR_HELP, PLOTVIEW_HELP, ABOUT_TEXT, SERVICED
 from ASControl import EVT_ERROR, PLOT_EVT, STATUS_EVT, TOOLBAR_EVT
 from GraphPanel import GraphPanel, CUSTOM_EVT
+from Resampling import WAVELENGTH_GRIDS
 from Messages import ok_cancel, give_error, confirmation_message, time_control, \
      progress_dialog, save_file_dialog, open_file_dialog
 
+# menu ids of the wavelength grid radio items, one per WAVELENGTH_GRIDS entry
+GRID_MENU_ID = 220
+
 def resource_path(relative):
     try:
         base_path = sys._MEIPASS
@@ -43,6 +47,8 @@ class ASPresentation(object):
         application and handles all the calls to the gui, some of which
         are rerouted to the GraphPanel class in GraphPanel.py"""
         self.sensors = []
+        # called whenever another device becomes the active one
+        self.device_toggled = None
         self.calibrate_mode = False
         self.create_widgets(red_farred)
         self.enable_units()
@@ -133,8 +139,8 @@ class ASPresentation(object):
     @property
     def x_data(self):
         """returns the currently displayed x-values which is dependent on the
-        device connected. It will be a list from 340-820, or from 635-1100. Both
-        in increments of 1"""
+        device connected and the selected wavelength grid. It spans 340-820 or
+        635-1100, in increments of 1 on the default grid"""
         return self.graph_panel.x_data
 
     @x_data.setter
@@ -340,7 +346,7 @@ class ASPresentation(object):
     def open_data_file_dialog(self, current_directory):
         """prompts the user for a data file to open for plotting. can select
         multiple files so long as they are saved in the correct format."""
-        wildcard = "(*.csv)|*.csv|(*.dat)|*.dat"
+        wildcard = "(*.csv)|*.csv|(*.dat)|*.dat|(*.capture)|*.capture"
         dlg = wx.FileDialog(self.frame, "Open data file for plotting...",
                             current_directory, wildcard=wildcard,
                             style=wx.FD_OPEN | wx.FD_MULTIPLE)
@@ -366,6 +372,13 @@ class ASPresentation(object):
         return save_file_dialog(self.frame, title, wildcard, current_directory, 
                                suggested_file, overwrite_prompt=False)
 
+    def buffer_seconds_dialog(self):
+        """asks how many seconds of buffered scans to save, 0 if cancelled"""
+        seconds = wx.GetNumberFromUser(
+            "Raw scans are kept for a while after they are plotted.",
+            "Seconds", "Save Last Seconds", 60, 1, 3600, self.frame)
+        return max(seconds, 0)
+
     def calibration_file_dialog(self, current_directory):
         """returns the file path of the chosen calibration file of type .icd"""
         wildcard="(*.icd)|*.icd"
@@ -450,8 +463,10 @@ class ASPresentation(object):
         self.graph_panel.save_graph(file_path)
 
     def connection_settings_query(self, previous, device_serials):
-        """this is the connection settings dialog to get the slave_address and the
-        com-port from the user. baud rate is hardcoded for now"""
+        """this is the connection settings dialog to choose which of the
+        attached spectroradiometers to connect. returns a list of the chosen
+        aliases, every one of them if the user picks 'Connect All', or None if
+        the dialog is cancelled"""
         dlg = wx.Dialog(self.frame, -1, "Connection Settings")
         dlg.SetBackgroundColour("white")
         dlg.CenterOnScreen()
@@ -461,21 +476,28 @@ class ASPresentation(object):
             serial.SetValue(previous)
         ok_button = wx.Button(dlg, wx.ID_OK)
         ok_button.SetFocus()
+        all_button = wx.Button(dlg, wx.ID_YESTOALL, "Connect All")
+        all_button.Bind(wx.EVT_BUTTON,
+                        lambda evt: dlg.EndModal(wx.ID_YESTOALL))
         cancel_button = wx.Button(dlg, wx.ID_CANCEL)
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(serial_label, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         sizer.Add(serial, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         button_sizer = wx.StdDialogButtonSizer()
         button_sizer.Add(ok_button, 0, wx.ALIGN_CENTER | wx.ALL, 5)
+        button_sizer.Add(all_button, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         button_sizer.Add(cancel_button, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         sizer.Add(button_sizer, 0, wx.ALIGN_CENTER | wx.ALL, 5)
         dlg.SetSizer(sizer)
         dlg.Fit()
-        serial_num = None
-        if dlg.ShowModal() == wx.ID_OK:
-            serial_num = serial.GetValue()
+        serial_nums = None
+        result = dlg.ShowModal()
+        if result == wx.ID_OK:
+            serial_nums = [serial.GetValue()]
+        elif result == wx.ID_YESTOALL:
+            serial_nums = list(device_serials)
         dlg.Destroy()
-        return serial_num
+        return serial_nums
 
     def disconnect_dialog(self, current_devices):
         """the disconnect dialog displays a combox box (drop down menu) of 
@@ -708,6 +730,12 @@ class ASPresentation(object):
         such) to prevent user from clicking buttons when it's hazardous to do so"""
         return wx.BusyInfo(msg, self.frame)
 
+    def yield_to_gui(self):
+        """lets wx process pending events while the gui thread waits on a
+        device. does nothing when a data retrieval thread is the one waiting"""
+        if wx.Thread_IsMain():
+            wx.YieldIfNeeded()
+
     def get_hot_wavelength(self, active_device):
         return self.graph_panel.get_selected_wavelength(active_device)
 
@@ -761,6 +789,12 @@ class ASPresentation(object):
         self.left_panel.FitInside()
         self.frame.Layout()
 
+    def check_wavelength_grid(self, grid):
+        """checks the given grid in the view -> wavelength grid menu"""
+        for i, (name, step) in enumerate(WAVELENGTH_GRIDS):
+            if name == grid:
+                self.grid_menu.Check(GRID_MENU_ID + i, True)
+
     def confirmation_message(self, title, msg):
         """comfirmation message shown to give the user the satisfaction of knowing
         something happened when they clicked a button"""
@@ -841,6 +875,8 @@ class ASPresentation(object):
                 sensor.SetValue(True)
             else:
                 sensor.SetValue(False)
+        if self.device_toggled is not None:
+            self.device_toggled()
 
     def remove_device(self, dev_name):
         """removes the toggle button with the name == dev_name. it requires
@@ -858,6 +894,8 @@ class ASPresentation(object):
                 self.sensors[0].SetValue(True)
         self.tool_bar.DeleteTool(device_toggle.GetId())
         self.tool_bar.Realize()
+        if self.device_toggled is not None:
+            self.device_toggled()
 
     def rename_device(self, old_name):
         """renames the device to pretty much whatever the user wants to name
@@ -1163,6 +1201,8 @@ class ASPresentation(object):
         self.file_menu.Append(101, "&Connect", "Connect to a device")
         self.file_menu.Append(102, "D&isconnect", "Disconnect a device")
         self.file_menu.Append(103, "&Red/Far Red Setup")
+        self.file_menu.Append(104, "Save &Last Seconds...",
+                              "Save the raw scans of the last seconds")
         self.file_menu.Enable(102, False)
         self.file_menu.AppendSeparator()
         self.file_menu.Append(wx.ID_EXIT, "&Exit")
@@ -1182,6 +1222,13 @@ class ASPresentation(object):
         submenu.Append(205, "&Footcandle",
                        "Plot in calibrated unit Footcandle: %s" % WX_FC_LABEL)
         view_menu.AppendMenu(211, "&Illuminance", submenu)
+        view_menu.AppendSeparator()
+        self.grid_menu = wx.Menu()
+        for i, (grid, step) in enumerate(WAVELENGTH_GRIDS):
+            self.grid_menu.AppendRadioItem(
+                GRID_MENU_ID + i, grid,
+                "Resample measurements on to a %s wavelength grid" % grid)
+        view_menu.AppendMenu(212, "Wavelength &Grid", self.grid_menu)
         menu_bar.Append(view_menu, "&View")
 
         help_menu = wx.Menu()
@@ -0,0 +1,144 @@
+# -*- coding: ascii -*-
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+from threading import Event, Thread
+from time import time
+
+from USB_Instrument import DeviceCommunicationError, READ_SLICE
+
+# seconds between two looks at whether an unplugged device is back
+ATTACH_POLL = 0.5
+
+# error is the DeviceCommunicationError the device failed with or None, the
+# times are the time.time() its final scan was triggered and received at.
+# scan, y_data and the temperature are those of the measurement, kept apart
+# from the device which takes the next one meanwhile
+Measurement = namedtuple('Measurement',
+                         'device trigger_time complete_time error scan '
+                         'y_data temperature temp_time')
+
+
+class AcquisitionScheduler(object):
+    """Takes measurements on several devices at once. get_spectrum is queued
+    on every device first and then released on all of them together, so the
+    scans start within a fraction of a millisecond of each other. Each device
+    is then collected on a thread of its own, including any auto integration
+    rescans and the correction.
+
+    measure takes a single measurement on every device and takes as long as
+    the slowest of them. start keeps every device measuring at its own pace
+    instead, a device is never held up by a slower one and its Measurements
+    are handed out by get as they complete."""
+    def __init__(self, devices, idle_callback=None):
+        self.devices = list(devices)
+        self.idle_callback = idle_callback
+        self.pool = ThreadPool(max(1, len(self.devices)))
+        self.results = Queue()
+        self.stop_event = Event()
+        self.threads = []
+
+    def measure(self, devices=None, rt=False):
+        """triggers and collects devices (all of them by default) and returns a
+        Measurement for each, in the same order"""
+        if devices is None:
+            devices = self.devices
+        self.trigger(devices)
+        result = self.pool.map_async(lambda device: self.collect(device, rt),
+                                     devices)
+        while not result.ready():
+            result.wait(READ_SLICE)
+            if self.idle_callback is not None:
+                self.idle_callback()
+        return result.get()
+
+    def trigger(self, devices):
+        start = Event()
+        try:
+            for device in devices:
+                device.start_measurement(start)
+        finally:
+            start.set()
+
+    def start(self, rt=False, scans=None, interval=0):
+        """Keeps every device measuring on a thread of its own until close is
+        called or it took scans measurements. A device starts a measurement
+        interval seconds after it started the one before, or as soon as that
+        one is done if it took longer. The first one is started on every
+        attached device at once. A device that is unplugged waits until it
+        is attached again."""
+        self.stop_event.clear()
+        attached = [device for device in self.devices
+                    if device.attached.is_set()]
+        self.trigger(attached)
+        for device in self.devices:
+            thread = Thread(target=self.run,
+                            args=(device, rt, scans, interval,
+                                  device in attached),
+                            name="Acquire %s" % device.name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def get(self, timeout=None):
+        """returns the next Measurement to complete on any device. Raises
+        Queue.Empty if there is none within timeout seconds."""
+        return self.results.get(True, timeout)
+
+    def run(self, device, rt, scans, interval, triggered):
+        taken = 0
+        failed = not triggered
+        while not self.stop_event.is_set():
+            if failed and not self.wait_for_attach(device):
+                return
+            measurement = self.collect(device, rt, not triggered)
+            triggered = False
+            self.results.put(measurement)
+            failed = measurement.error is not None
+            if not failed:
+                taken += 1
+                if scans is not None and taken >= scans:
+                    return
+                wait = measurement.trigger_time + interval - time()
+            else:
+                # a device that keeps failing is not asked again straight away
+                wait = max(READ_SLICE, interval)
+            if wait > 0 and self.stop_event.wait(wait):
+                return
+
+    def wait_for_attach(self, device):
+        """waits while device is unplugged, the device monitor takes it over
+        when it returns. Returns False if close was called meanwhile."""
+        while not (device.attached.is_set() and device.is_attached()):
+            if self.stop_event.wait(ATTACH_POLL):
+                return False
+        return True
+
+    def collect(self, device, rt, trigger=False):
+        """collects device, after starting its measurement if trigger"""
+        error = None
+        try:
+            if trigger:
+                device.start_measurement()
+            device.acquire_measurement(rt)
+        except DeviceCommunicationError, data:
+            error = data
+        scan = device.last_scan
+        if error is None and scan is not None:
+            # the raw counts are overwritten by the next scan
+            scan = scan._replace(pixels=scan.pixels.copy())
+        return Measurement(device, device.trigger_time, device.complete_time,
+                           error, scan, device.y_data, device.prev_temp,
+                           device.temp_time)
+
+    def close(self):
+        """stops the devices measuring, a measurement under way is
+        abandoned"""
+        self.stop_event.set()
+        for device, thread in zip(self.devices, self.threads):
+            if thread.is_alive():
+                device.cancel()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.pool.close()
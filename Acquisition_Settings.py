@@ -0,0 +1,44 @@
+# -*- coding: ascii -*-
+from collections import namedtuple
+from threading import Lock
+from time import time
+
+# the gui state the worker threads need. version goes up by one every time
+# something in it changes and published is the time.time() it did. the line
+# ranges are tuples so a snapshot can not be changed after it was published.
+# active_device is the name of the device toggled in the toolbar, or None
+AcquisitionSettings = namedtuple('AcquisitionSettings',
+                                 'version published mode unit integ_time '
+                                 'auto_integrate average_scans integ_lines '
+                                 'fractional_lines active_device')
+
+
+def changed(old, new, *fields):
+    """True if any of fields differs between two AcquisitionSettings or there
+    is no old one"""
+    if old is None:
+        return True
+    return any(getattr(old, field) != getattr(new, field) for field in fields)
+
+
+class SettingsPublisher(object):
+    """Hands the settings made in the gui to the worker threads. The main
+    thread publishes a new AcquisitionSettings whenever something changes and
+    workers take the current one between scans. Snapshots are never changed
+    once published, so a worker sees either all of a change or none of it and
+    never has to touch wx."""
+    def __init__(self, **settings):
+        self.lock = Lock()
+        self.current = AcquisitionSettings(version=0, published=time(),
+                                           **settings)
+
+    def publish(self, **changes):
+        """replaces the given fields and returns the current snapshot. The
+        version only goes up if something actually changed."""
+        with self.lock:
+            current = self.current
+            if any(getattr(current, field) != value
+                   for field, value in changes.items()):
+                self.current = current._replace(version=current.version + 1,
+                                                published=time(), **changes)
+            return self.current
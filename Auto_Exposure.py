@@ -0,0 +1,138 @@
+# -*- coding: ascii -*-
+from math import log
+
+import numpy as np
+
+from Correction_Engine import DARK_OFFSET
+
+# raw counts the peak of a scan is steered to, anything between TARGET_LOW
+# and TARGET_HIGH is left alone
+TARGET_HIGH = 16000
+TARGET = 14500
+TARGET_LOW = 13000
+MAX_AUTO_INTEG = 2000000
+MIN_AUTO_INTEG = 5000
+# the spec's 14 bit converter reads this on a saturated pixel
+SATURATION = 16383
+# a peak this close to the dark offset is mostly noise, the light level can
+# not be measured from it
+NOISE_FLOOR = 50
+# how fast the linearity exponent is learned and the limits it is kept in
+LEARNING_RATE = 0.2
+MIN_GAMMA = 0.8
+MAX_GAMMA = 1.2
+# steps smaller than this factor teach nothing about linearity, and a scan
+# further off its prediction than this factor means the light changed
+MIN_LEARNING_STEP = 1.5
+MAX_PREDICTION_ERROR = 1.4
+# light levels are remembered in steps of this factor
+LIGHT_LEVEL_STEP = 2.0
+
+
+def light_level(rate):
+    return int(np.floor(log(rate) / log(LIGHT_LEVEL_STEP)))
+
+
+class AutoExposure(object):
+    """Picks the integration time that puts the peak of the next scan on
+    TARGET in one step, every rescan costs a whole integration. Above the dark
+    offset the peak follows signal = rate * integ ** gamma, where rate is the
+    light level and gamma the linearity of the device, learned from every
+    prediction the following scan confirms.
+
+    A saturated or all dark scan has no peak to measure. The light level is
+    then worked out from the number of saturated pixels and the shape of the
+    last stable scan, or the integration time that was stable at a matching
+    light level before is used. The old fixed steps are the fallback when
+    neither is known. One AutoExposure belongs to one device."""
+    def __init__(self):
+        self.gamma = 1.0
+        # the last stable scan above the dark offset scaled to a peak of 1
+        self.shape = None
+        # light level: integration time that was stable at that level
+        self.stable = {}
+        self.last_stable = None
+        # (integration time, predicted integration time, predicted signal)
+        self.prediction = None
+
+    def next_integration(self, pixels, integ):
+        """returns the integration time (microseconds) to take the next scan
+        at, or None if the scan in pixels, taken at integ, is on target or the
+        integration time is at its limit already"""
+        peak = int(pixels.max())
+        saturated = int((pixels >= SATURATION).sum())
+        signal = peak - DARK_OFFSET
+        self.learn(integ, signal, saturated)
+        if saturated:
+            if integ <= MIN_AUTO_INTEG:
+                return None
+            return self.desaturate(integ, saturated)
+        if TARGET_LOW <= peak <= TARGET_HIGH:
+            self.remember(pixels, integ, signal)
+            return None
+        if peak > TARGET_HIGH and integ <= MIN_AUTO_INTEG:
+            return None
+        if peak < TARGET_LOW and integ >= MAX_AUTO_INTEG:
+            return None
+        if signal < NOISE_FLOOR:
+            return self.brighten(integ)
+        return self.predict(integ, signal / float(integ) ** self.gamma)
+
+    def predict(self, integ, rate):
+        """the integration time that gives a peak of TARGET at rate"""
+        new_integ = ((TARGET - DARK_OFFSET) / rate) ** (1 / self.gamma)
+        new_integ = int(min(max(new_integ, MIN_AUTO_INTEG), MAX_AUTO_INTEG))
+        self.prediction = (integ, new_integ, rate * new_integ ** self.gamma)
+        return new_integ
+
+    def desaturate(self, integ, saturated):
+        top = (SATURATION - DARK_OFFSET) / float(integ) ** self.gamma
+        if self.shape is not None and saturated < len(self.shape):
+            # with the spectrum shaped like the last stable one, exactly this
+            # many pixels saturate when the peak is this high
+            level = np.partition(self.shape, -saturated)[-saturated]
+            if level > 0:
+                return self.predict(integ, top / level)
+        # the light is at least this bright
+        levels = [l for l in self.stable if l >= light_level(top)]
+        if levels:
+            return self.stable[min(levels)]
+        if saturated >= 600:
+            return 3000
+        elif saturated >= 100:
+            return int(integ * 0.25)
+        return int(integ * 0.8)
+
+    def brighten(self, integ):
+        bottom = NOISE_FLOOR / float(integ) ** self.gamma
+        # the light is at most this bright
+        levels = [l for l in self.stable if l <= light_level(bottom)]
+        if levels:
+            return self.stable[max(levels)]
+        return self.predict(integ, bottom)
+
+    def learn(self, integ, signal, saturated):
+        """corrects gamma by how far the scan taken at the predicted
+        integration time is off its predicted signal"""
+        prediction, self.prediction = self.prediction, None
+        if prediction is None or saturated or signal < NOISE_FLOOR:
+            return
+        previous, predicted, expected = prediction
+        if integ != predicted:
+            return
+        step = integ / float(previous)
+        error = signal / expected
+        if max(step, 1 / step) < MIN_LEARNING_STEP or \
+           max(error, 1 / error) > MAX_PREDICTION_ERROR:
+            return
+        # signal / expected = step ** (true gamma - gamma)
+        gamma = self.gamma + log(error) / log(step)
+        self.gamma += LEARNING_RATE * (gamma - self.gamma)
+        self.gamma = min(max(self.gamma, MIN_GAMMA), MAX_GAMMA)
+
+    def remember(self, pixels, integ, signal):
+        self.shape = np.clip(pixels.astype(np.float64) - DARK_OFFSET, 0,
+                             None) / signal
+        rate = signal / float(integ) ** self.gamma
+        self.stable[light_level(rate)] = integ
+        self.last_stable = integ
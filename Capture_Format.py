@@ -0,0 +1,213 @@
+# -*- coding: ascii -*-
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+import numpy as np
+
+from Capture_Journal import FIRST_RECORD, RECORD, JournalError, JournalReader
+from Resampling import NUM_PIXELS
+
+# the spec stores up to 58 hot pixels
+MAX_HOT_PIXELS = 58
+# the integration time and totals that follow a spectrum, see
+# ASControl.calculate_ypf
+MAX_EXTRAS = 7
+
+# the first record of a binary capture describes the device and how the
+# scans were processed. lists shorter than their field are padded and the
+# number of entries is kept alongside
+CAPTURE_HEADER = np.dtype([('name', 'S32'),
+                           ('serial', 'S32'),
+                           ('sensor_type', 'S4'),
+                           ('grid', 'S16'),
+                           ('mode', '<u1'),
+                           ('unit', '<u1'),
+                           ('irrad_unit', '<u1'),
+                           ('calib_coeff', '<f8', (4,)),
+                           ('irradiance_count', '<u2'),
+                           ('irradiance', '<f4', (NUM_PIXELS,)),
+                           ('hot_pixel_count', '<u2'),
+                           ('hot_pixels', '<u2', (MAX_HOT_PIXELS,)),
+                           ('spectrum_length', '<u2'),
+                           ('wavelengths', '<f8', (NUM_PIXELS,))])
+
+# a scan as it is handed to Capture_Writer.CaptureWriter. the times are
+# time.time() values, temperature and temp_time are nan if the temperature
+# was not logged and spectrum is None if the capture keeps no spectra
+CapturedScan = namedtuple('CapturedScan',
+                          'timestamp integ avg_scans temperature temp_time '
+                          'pixels extras spectrum')
+
+
+def scan_dtype(spectrum_length):
+    """the fields of every scan record of a capture, raw counts first and the
+    processed spectrum, if kept, last. the spectrum is kept as doubles so
+    that it is exported exactly as it would have been saved"""
+    fields = [('timestamp', '<f8'),
+              ('integ', '<u4'),
+              ('avg_scans', '<u2'),
+              ('temperature', '<f4'),
+              ('temp_time', '<f8'),
+              ('pixels', '<u2', (NUM_PIXELS,)),
+              ('extra_count', '<u1'),
+              ('extras', '<f8', (MAX_EXTRAS,))]
+    if spectrum_length:
+        fields.append(('spectrum', '<f8', (spectrum_length,)))
+    return np.dtype(fields)
+
+
+def record_dtype(spectrum_length):
+    """a scan record as it is laid out in the file, after the length and
+    checksum of Capture_Journal"""
+    return np.dtype([('length', '<u4'), ('checksum', '<u4')] +
+                    scan_dtype(spectrum_length).descr)
+
+
+def capture_header(device, mode, unit, spectra=True):
+    """the CAPTURE_HEADER of a capture of device. spectra is False if only
+    the raw counts are kept"""
+    header = np.zeros((), dtype=CAPTURE_HEADER)
+    header['name'] = device.name.encode('utf-8')[:32]
+    header['serial'] = ("%s" % device.serial).encode('utf-8')[:32]
+    header['sensor_type'] = device.sensor_type.encode('utf-8')
+    header['grid'] = device.grid.encode('utf-8')[:16]
+    header['mode'] = mode
+    header['unit'] = unit
+    header['irrad_unit'] = device.irrad_unit
+    header['calib_coeff'] = device.calib_coeff[:4]
+    irradiance = device.irradiance_data[:NUM_PIXELS]
+    header['irradiance_count'] = len(irradiance)
+    header['irradiance'][:len(irradiance)] = irradiance
+    hot_pixels = device.dark_pixels[:MAX_HOT_PIXELS]
+    header['hot_pixel_count'] = len(hot_pixels)
+    header['hot_pixels'][:len(hot_pixels)] = hot_pixels
+    if spectra:
+        wavelengths = device.x_data[:NUM_PIXELS]
+        header['spectrum_length'] = len(wavelengths)
+        header['wavelengths'][:len(wavelengths)] = wavelengths
+    return header
+
+
+def encode_scan(scan, dtype):
+    """packs a CapturedScan in to the payload of a scan record"""
+    record = np.zeros((), dtype=dtype)
+    record['timestamp'] = scan.timestamp
+    record['integ'] = scan.integ
+    record['avg_scans'] = scan.avg_scans
+    record['temperature'] = scan.temperature
+    record['temp_time'] = scan.temp_time
+    pixels = scan.pixels[:NUM_PIXELS]
+    record['pixels'][:len(pixels)] = pixels
+    extras = scan.extras[:MAX_EXTRAS]
+    record['extra_count'] = len(extras)
+    record['extras'][:len(extras)] = extras
+    if 'spectrum' in dtype.names and scan.spectrum is not None:
+        record['spectrum'] = scan.spectrum
+    return record.tostring()
+
+
+def open_capture(file_path):
+    """maps the binary capture file_path in to memory. Returns its header and
+    a numpy.memmap of its scan records, a scan is read from disk only when it
+    is used. The scans are found with the index of a Capture_Journal
+    JournalReader. A capture that was never closed has no index, as every
+    scan record has the same size the scans are counted from the file size
+    and scans at the end cut short by a crash are left out."""
+    reader = JournalReader(file_path)
+    try:
+        try:
+            payload, first = reader.read_record(FIRST_RECORD)
+        except JournalError:
+            raise JournalError("%s has no capture header" % file_path)
+        if len(payload) != CAPTURE_HEADER.itemsize:
+            raise JournalError("%s has no valid capture header" % file_path)
+        header = np.frombuffer(payload, dtype=CAPTURE_HEADER)[0]
+        dtype = record_dtype(int(header['spectrum_length']))
+        if reader.indexed:
+            offsets = reader.offsets[1:]
+            count = len(offsets)
+            # every scan record follows the one before it
+            if count and (int(offsets[0]) != first or
+                          int(offsets[-1]) - first !=
+                          (count - 1) * dtype.itemsize):
+                raise JournalError("%s holds scans of another size"
+                                   % file_path)
+        else:
+            # a crash only cuts short the scans written last, the ones
+            # before them are not read. a file system can leave zeros where
+            # they were, which read as an empty record
+            count = (reader.size - first) // dtype.itemsize
+            while count:
+                try:
+                    payload = reader.read_record(
+                        first + (count - 1) * dtype.itemsize)[0]
+                except JournalError:
+                    payload = None
+                if payload is not None and \
+                   len(payload) == dtype.itemsize - RECORD.size:
+                    break
+                count -= 1
+    finally:
+        reader.close()
+    if not count:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(file_path, dtype=dtype, mode='r',
+                             offset=first, shape=(count,))
+
+
+class CaptureReader(object):
+    """Reads a binary capture without loading it. The scans are a
+    numpy.memmap, only the pages of the scans and fields that are used are
+    read from disk, so opening a capture takes the same time and memory
+    whatever its size. Scans are picked by index or with time_range, the
+    wavelengths of their spectra with wavelength_range."""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.header, self.scans = open_capture(file_path)
+        self.name = self.header['name'].decode('utf-8')
+        self.mode = int(self.header['mode'])
+        length = int(self.header['spectrum_length'])
+        self.wavelengths = np.array(self.header['wavelengths'][:length])
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __getitem__(self, index):
+        """the scan records at index, a number, slice or array of numbers"""
+        return self.scans[index]
+
+    def spread(self, count):
+        """the indices of up to count scans spread evenly over the capture"""
+        count = min(count, len(self.scans))
+        return np.unique(np.linspace(0, len(self.scans) - 1,
+                                     count).round().astype(int))
+
+    def time_range(self, start, stop):
+        """the slice of scans triggered from start up to and including stop,
+        both time.time() values"""
+        # bisect reads a single timestamp per step, searchsorted would copy
+        # all of them
+        timestamps = self.scans['timestamp']
+        return slice(bisect_left(timestamps, start),
+                     bisect_right(timestamps, stop))
+
+    def wavelength_range(self, low, high):
+        """the slice of the spectra from low up to and including high nm"""
+        return slice(np.searchsorted(self.wavelengths, low, 'left'),
+                     np.searchsorted(self.wavelengths, high, 'right'))
+
+    def spectra(self, scans=slice(None), wavelengths=slice(None)):
+        """copies the spectra of scans, only the wavelengths in the slice
+        wavelengths, in to memory. Raises KeyError if the capture holds raw
+        counts only."""
+        if 'spectrum' not in self.scans.dtype.names:
+            raise KeyError("%s holds no spectra" % self.file_path)
+        return np.array(self.scans['spectrum'][scans, wavelengths])
+
+    def pixels(self, scans=slice(None)):
+        """copies the raw counts of scans in to memory"""
+        return np.array(self.scans['pixels'][scans])
+
+    def close(self):
+        # the file is unmapped once nothing refers to the scans any more
+        self.scans = None
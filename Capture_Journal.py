@@ -0,0 +1,199 @@
+# -*- coding: ascii -*-
+import os
+import struct
+import sys
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+if os.name == 'nt':
+    import ctypes
+
+# a journal starts with MAGIC and the format version
+MAGIC = b'SVJ1'
+HEADER = struct.Struct('<4sI')
+VERSION = 1
+FIRST_RECORD = HEADER.size
+# every record is its length and the crc32 of its payload, then the payload
+RECORD = struct.Struct('<II')
+# the index footer is the number of records, the crc32 of their offsets and
+# the offsets, followed by the offset of the index and INDEX_MAGIC
+INDEX = struct.Struct('<II')
+TRAILER = struct.Struct('<Q4s')
+INDEX_MAGIC = b'SVIX'
+# MoveFileExW replaces the destination and returns once the move is on disk
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
+
+class JournalError(Exception):
+    """This exception is thrown when a file is not a journal."""
+
+
+def crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+def replace_file(source, destination):
+    """renames source over destination in a single step. os.rename does not
+    replace an existing file on windows, MoveFileEx does"""
+    if os.name != 'nt':
+        os.rename(source, destination)
+        return
+    paths = [path.decode(sys.getfilesystemencoding())
+             if isinstance(path, str) else path
+             for path in (source, destination)]
+    if not ctypes.windll.kernel32.MoveFileExW(
+            paths[0], paths[1],
+            MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
+
+
+@contextmanager
+def atomic_write(file_path, mode='w'):
+    """opens a temporary file next to file_path for writing and renames it
+    over file_path once it is on disk, so a crash leaves either the old or
+    the new file and never part of one. Nothing is replaced if writing
+    fails."""
+    temp_path = file_path + '.tmp'
+    try:
+        with open(temp_path, mode) as temp_file:
+            yield temp_file
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    replace_file(temp_path, file_path)
+
+
+class JournalWriter(object):
+    """Writes an append only journal of records. Each record is written with
+    its length and checksum in a single write, so after a crash every record
+    that was written completely can be told apart from the one that was not.
+    close adds an index of where every record starts, JournalReader rebuilds
+    it if the file was never closed."""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.offsets = []
+        self.position = HEADER.size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, payload):
+        self.file.write(RECORD.pack(len(payload), crc(payload)) + payload)
+        self.offsets.append(self.position)
+        self.position += RECORD.size + len(payload)
+
+    def flush(self, sync=False):
+        """hands the records written to the operating system, and waits for
+        it to put them on the disk if sync is True"""
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        offsets = struct.pack('<%dQ' % len(self.offsets), *self.offsets)
+        self.file.write(INDEX.pack(len(self.offsets), crc(offsets)) + offsets +
+                        TRAILER.pack(self.position, INDEX_MAGIC))
+        self.file.close()
+
+
+class JournalReader(object):
+    """Reads the records of a journal by number. The index footer is used if
+    the journal was closed, otherwise the first time the index is needed the
+    records are walked from the start and it is rebuilt from every record
+    whose checksum matches, up to the first one that was cut short.
+    read_record reads a record at a known offset without the index.
+
+    A record read raises JournalError if it was cut short or does not match
+    its checksum."""
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        header = self.file.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+            raise JournalError("%s is not a capture journal" % file_path)
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        # None until it is needed if the journal was never closed
+        self.index = self.read_index()
+        self.indexed = self.index is not None
+
+    @property
+    def offsets(self):
+        if self.index is None:
+            self.index = self.rebuild_index()
+        return self.index
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        return self.read_record(int(self.offsets[i]))[0]
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def read_record(self, offset):
+        """returns the payload of the record at offset and the offset of the
+        record after it"""
+        self.file.seek(offset)
+        header = self.file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            raise JournalError("The record at %d of %s was cut short"
+                               % (offset, self.file_path))
+        length, checksum = RECORD.unpack(header)
+        end = offset + RECORD.size + length
+        if end > self.size:
+            raise JournalError("The record at %d of %s was cut short"
+                               % (offset, self.file_path))
+        payload = self.file.read(length)
+        if crc(payload) != checksum:
+            raise JournalError("The record at %d of %s is damaged"
+                               % (offset, self.file_path))
+        return payload, end
+
+    def read_index(self):
+        """returns the offsets in the index footer or None if there is no
+        valid one. they are kept as an array, a long capture has hundreds of
+        thousands"""
+        size = self.size
+        if size < HEADER.size + INDEX.size + TRAILER.size:
+            return None
+        self.file.seek(size - TRAILER.size)
+        start, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+        if magic != INDEX_MAGIC or \
+           not HEADER.size <= start <= size - INDEX.size - TRAILER.size:
+            return None
+        self.file.seek(start)
+        count, checksum = INDEX.unpack(self.file.read(INDEX.size))
+        if start + INDEX.size + 8 * count + TRAILER.size != size:
+            return None
+        offsets = self.file.read(8 * count)
+        if crc(offsets) != checksum:
+            return None
+        return np.frombuffer(offsets, dtype='<u8')
+
+    def rebuild_index(self):
+        offsets = []
+        position = FIRST_RECORD
+        while True:
+            try:
+                end = self.read_record(position)[1]
+            except JournalError:
+                break
+            offsets.append(position)
+            position = end
+        return offsets
+
+    def close(self):
+        self.file.close()
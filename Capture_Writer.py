@@ -0,0 +1,331 @@
+# -*- coding: ascii -*-
+import datetime
+import os
+import time
+from collections import namedtuple
+from threading import Thread, Timer
+
+import numpy as np
+
+from constants import ENERGY_FLUX, ILLUMINANCE, MODE_TO_UNITS, UNITS_TO_STR
+from Capture_Format import encode_scan, open_capture, scan_dtype
+from Capture_Journal import JournalWriter, atomic_write
+from Pipeline import BLOCK, BoundedQueue, QueueClosed
+
+# column data files hold a timestamp and units row, at least this many rows of
+# spectral data and TRAILING_ROWS rows of integration time, totals, the sensor
+# temperature and the time it was read at
+LEGACY_DATA_ROWS = 481
+TRAILING_ROWS = 9
+# files written before the read time was kept end in the temperature row
+TEMP_LABEL = 'Sensor Temp'
+TEMP_TIME_LABEL = 'Sensor Temp Time'
+# cells of a capture held in memory at once while it is exported to the
+# column format, about 200 MB at most
+EXPORT_CELLS = 4000000
+
+# when WriterThread has the operating system put written scans on the disk
+FSYNC_NEVER = 'never'           # whenever the operating system likes
+FSYNC_BATCH = 'per batch'       # after every batch of scans
+FSYNC_SCAN = 'per scan'         # after every scan
+FSYNC_POLICIES = [FSYNC_NEVER, FSYNC_BATCH, FSYNC_SCAN]
+
+# scans queued for writing at most, the capture waits beyond that
+WRITER_QUEUE_SIZE = 1000
+# scans written are flushed after this many or this many seconds
+BATCH_SCANS = 50
+BATCH_INTERVAL = 1.0
+
+# queued is the number of scans waiting to be written, the latencies are the
+# seconds it took to write, flush and sync the last and the slowest batch
+WriterStats = namedtuple('WriterStats',
+                         'queued max_queued written batches latency '
+                         'max_latency')
+
+
+def capture_path(file_path):
+    """the binary capture kept next to the column data file file_path"""
+    return '%s.capture' % os.path.splitext(file_path)[0]
+
+
+def timestamp_label(timestamp, name):
+    """the first row of a data column. timestamp is the time.time() the data
+    was taken at, now if None"""
+    if timestamp is None:
+        taken = datetime.datetime.now()
+    else:
+        taken = datetime.datetime.fromtimestamp(timestamp)
+    return '%s %s' % (taken.strftime("%H:%M:%S %Y/%m/%d"), name)
+
+
+def units_label(mode, unit):
+    """the second row of a data column"""
+    if mode == 4: #lux or fc
+        return MODE_TO_UNITS[mode] % UNITS_TO_STR[unit]
+    return MODE_TO_UNITS[mode]
+
+
+def column_layout(spectrum_length, extra_count, mode):
+    """where every row of a data column comes from: 'timestamp', 'units',
+    ('spectrum', i), ('extras', i), 'temperature', 'temp_time' or None for a
+    '-'. extras are the integration time and totals that follow the
+    spectrum"""
+    data_rows = max(LEGACY_DATA_ROWS, spectrum_length)
+    layout = ['timestamp', 'units']
+    layout += [('spectrum', i) for i in range(spectrum_length)]
+    # pad shorter grids so the trailing rows line up
+    layout += [None] * (data_rows - spectrum_length)
+    layout += [('extras', i) for i in range(extra_count)]
+    if mode == ENERGY_FLUX:
+        layout[-2:-2] = [None] * 3
+    elif mode == ILLUMINANCE:
+        layout[-1:-1] = [None] * 3
+    layout += [None] * (data_rows + 11 - len(layout))
+    layout[-2:] = ['temperature', 'temp_time']
+    return layout
+
+
+def align_rows(lines, rows):
+    """pads a column oriented data file (or column) with '-' rows before
+    its TRAILING_ROWS trailing rows until it has the given number of rows. A
+    file that ends in the temperature row gets a row for its read time"""
+    columns = ("%s" % lines[0]).count(',') + 1
+    if ("%s" % lines[-1]).split(',')[0] == TEMP_LABEL:
+        lines = lines + [','.join([TEMP_TIME_LABEL] + ['-'] * (columns - 1))]
+    if len(lines) >= rows:
+        return lines
+    filler = ','.join(['-'] * columns)
+    return lines[:-TRAILING_ROWS] + [filler] * (rows - len(lines)) + \
+        lines[-TRAILING_ROWS:]
+
+
+class CaptureWriter(object):
+    """Writes a data capture in the binary format of Capture_Format, the
+    header and then one record of a Capture_Journal per scan. Every scan is a
+    single append to the end of the file, so a scan takes as long to save at
+    the end of a long capture as at the start and a crash loses no more than
+    the scan being written.
+
+    Scans are buffered until flush, see WriterThread."""
+    def __init__(self, file_path, header):
+        self.file_path = file_path
+        self.journal = JournalWriter(file_path)
+        self.journal.append(header.tostring())
+        self.dtype = scan_dtype(int(header['spectrum_length']))
+        self.scans = 0
+        self.flush()
+
+    def append(self, scan):
+        """appends a Capture_Format.CapturedScan"""
+        self.journal.append(encode_scan(scan, self.dtype))
+        self.scans += 1
+
+    def flush(self, sync=False):
+        """hands the scans written to the operating system, and waits for it
+        to put them on the disk if sync is True"""
+        self.journal.flush(sync)
+
+    def close(self):
+        self.journal.close()
+
+
+class WriterThread(object):
+    """Writes the scans of a data capture on a thread of its own, so a slow
+    disk or network share does not hold up the next scan. Scans are queued in
+    a BoundedQueue of size scans and only when that is full does append wait.
+
+    Rows are written as they arrive and flushed after batch_scans of them or
+    batch_interval seconds after the first one, whichever comes first. fsync
+    is one of FSYNC_POLICIES. If writing fails the scans that follow are
+    dropped and close returns the error."""
+    def __init__(self, size=WRITER_QUEUE_SIZE, batch_scans=BATCH_SCANS,
+                 batch_interval=BATCH_INTERVAL, fsync=FSYNC_BATCH):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %s" % fsync)
+        self.queue = BoundedQueue(size, BLOCK)
+        self.batch_scans = max(1, batch_scans)
+        self.batch_interval = batch_interval
+        self.fsync = fsync
+        # writers with rows that were not flushed yet, how many rows and the
+        # seconds spent writing them
+        self.pending = set()
+        self.batch = 0
+        self.batch_time = 0.0
+        # puts a flush in the queue batch_interval after a batch started
+        self.timer = None
+        self.error = None
+        self.written = 0
+        self.batches = 0
+        self.max_queued = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.thread = Thread(target=self.run, name="Capture Writer Thread")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def append(self, writer, row):
+        """queues row to be appended by the CaptureWriter writer. Returns
+        False once the thread was closed."""
+        if not self.queue.put((writer, row)):
+            return False
+        with self.queue.condition:
+            self.max_queued = max(self.max_queued, len(self.queue.items))
+        return True
+
+    def close(self):
+        """writes and flushes the scans queued and returns the IOError or
+        OSError writing failed with, or None"""
+        self.queue.close()
+        self.thread.join()
+        return self.error
+
+    def stats(self):
+        return WriterStats(len(self.queue.items), self.max_queued,
+                           self.written, self.batches, self.latency,
+                           self.max_latency)
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get()
+                except QueueClosed:
+                    break
+                if item is None:
+                    # the batch interval is up
+                    self.flush()
+                elif self.error is None:
+                    self.write(*item)
+        finally:
+            # append must not wait for a thread that is gone
+            self.queue.close()
+            self.flush()
+
+    def write(self, writer, row):
+        start = time.time()
+        try:
+            writer.append(row)
+        except (IOError, OSError), data:
+            self.error = data
+            return
+        finally:
+            self.batch_time += time.time() - start
+        self.pending.add(writer)
+        self.batch += 1
+        self.written += 1
+        if self.batch >= self.batch_scans or self.fsync == FSYNC_SCAN:
+            self.flush()
+        elif self.timer is None and self.batch_interval is not None:
+            self.timer = Timer(self.batch_interval, self.queue.put, [None])
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        start = time.time()
+        try:
+            for writer in self.pending:
+                writer.flush(self.fsync != FSYNC_NEVER)
+        except (IOError, OSError), data:
+            if self.error is None:
+                self.error = data
+        self.latency = self.batch_time + time.time() - start
+        self.max_latency = max(self.max_latency, self.latency)
+        self.batches += 1
+        self.pending = set()
+        self.batch = 0
+        self.batch_time = 0.0
+
+
+def export_columns(capture_path, file_path, labels=None):
+    """writes the binary capture in capture_path to file_path in the column
+    format, one column per scan, after the column labels if given. If
+    file_path holds data already, the scans are added to it as new columns.
+
+    Row i of file_path holds field i of every scan. The spectra are copied
+    out of the capture for EXPORT_CELLS values at a time, so a capture of any
+    length is exported in bounded memory. A capture that was cut short by a
+    crash is exported up to its last complete scan."""
+    header, scans = open_capture(capture_path)
+    if not len(scans):
+        return
+    name = header['name'].decode('utf-8')
+    units = units_label(int(header['mode']), int(header['unit']))
+    layout = column_layout(int(header['spectrum_length']),
+                           int(scans['extra_count'][0]), int(header['mode']))
+    previous = []
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as data_file:
+            previous = [line for line in data_file.read().split('\n')
+                        if line]
+    rows = max(len(layout), len(previous))
+    if previous:
+        previous = align_rows(previous, rows)
+        rows = len(previous)
+    # shorter grids are padded before their trailing rows
+    padding = rows - len(layout)
+    layout = layout[:-TRAILING_ROWS] + [None] * padding + \
+        layout[-TRAILING_ROWS:]
+    if labels is not None:
+        labels = labels[:-TRAILING_ROWS] + ['-'] * padding + \
+            labels[-TRAILING_ROWS:]
+    step = max(1, EXPORT_CELLS // len(scans))
+    with atomic_write(file_path) as data_file:
+        for start in range(0, rows, step):
+            block = layout[start:start + step]
+            wanted = [source[1] for source in block
+                      if isinstance(source, tuple) and
+                      source[0] == 'spectrum']
+            if wanted:
+                first = min(wanted)
+                spectra = np.array(scans['spectrum'][:, first:max(wanted) + 1])
+            for i, source in enumerate(block, start):
+                if source is None:
+                    column = ['-'] * len(scans)
+                elif source == 'timestamp':
+                    column = [timestamp_label(timestamp, name)
+                              for timestamp in scans['timestamp']]
+                elif source == 'units':
+                    column = [units] * len(scans)
+                elif source == 'temperature':
+                    column = [temperature_label(temperature)
+                              for temperature in scans['temperature']]
+                elif source == 'temp_time':
+                    column = [temp_time_label(temp_time)
+                              for temp_time in scans['temp_time']]
+                elif source[0] == 'spectrum':
+                    column = ['%s' % float(value)
+                              for value in spectra[:, source[1] - first]]
+                else:
+                    column = ['%s' % float(value)
+                              for value in scans['extras'][:, source[1]]]
+                if labels is not None:
+                    column.insert(0, "%s" % labels[i])
+                if previous:
+                    column.insert(0, previous[i])
+                data_file.write(','.join(column))
+                if i < rows - 1:
+                    data_file.write('\n')
+
+
+def temperature_label(temperature):
+    """the sensor temperature row of a data column, '-' if it was not
+    logged"""
+    if np.isnan(temperature):
+        return '-'
+    return '%s' % float(temperature)
+
+
+def temp_time_label(temp_time):
+    """the last row of a data column, the time the sensor temperature was
+    read at"""
+    if np.isnan(temp_time):
+        return '-'
+    return datetime.datetime.fromtimestamp(temp_time).strftime(
+        "%H:%M:%S %Y/%m/%d")
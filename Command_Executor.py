@@ -0,0 +1,113 @@
+# -*- coding: ascii -*-
+import sys
+from Queue import Queue
+from threading import Thread, Event, current_thread, local
+
+
+class CommandTimeout(Exception):
+    """This exception is thrown when a Future is not done in time."""
+
+
+class Future(object):
+    """The pending result of a command submitted to a CommandExecutor."""
+    def __init__(self):
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        """exc_info is the sys.exc_info() tuple of the failure"""
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """waits up to timeout seconds, returns True if the command is done"""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def exception(self):
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def result(self, timeout=None):
+        """returns the result of the command, re-raising anything it raised.
+        Raises CommandTimeout if it is not done within timeout seconds."""
+        if not self.wait(timeout):
+            raise CommandTimeout("Command did not complete in %s s" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class CommandExecutor(object):
+    """Runs the commands for one device on a thread of its own in the order
+    they were submitted, so any number of threads can share the device. A
+    command submitted from the executor thread itself runs straight away.
+
+    Commands that have no reply can be submitted with pipelined=True and not
+    waited on. Their Futures are kept for the thread that submitted them and
+    raise_failure, which callers waiting on a later command use, raises the
+    first of them that failed. A failure is never handed to another
+    thread."""
+    def __init__(self, name):
+        self.queue = Queue()
+        self.submitted = local()
+        self.thread = Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """queues func(*args) and returns its Future"""
+        future = Future()
+        if kwargs.get('pipelined', False):
+            pipelined = self.pipelined()
+            # the commands that succeeded need not be kept
+            while pipelined and pipelined[0].done() and \
+                  pipelined[0].exception() is None:
+                pipelined.pop(0)
+            pipelined.append(future)
+        job = (future, func, args)
+        if current_thread() is self.thread:
+            self.execute(*job)
+        else:
+            self.queue.put(job)
+        return future
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            self.execute(*job)
+
+    def execute(self, future, func, args):
+        try:
+            future.set_result(func(*args))
+        except Exception:
+            future.set_exception(sys.exc_info())
+
+    def pipelined(self):
+        """the Futures of the pipelined commands the calling thread submitted
+        that raise_failure has not checked yet"""
+        if not hasattr(self.submitted, 'futures'):
+            self.submitted.futures = []
+        return self.submitted.futures
+
+    def raise_failure(self):
+        """re-raises the first failure of the pipelined commands the calling
+        thread submitted since its last call. Commands still running are
+        checked by the next call."""
+        pipelined = self.pipelined()
+        while pipelined and pipelined[0].done():
+            pipelined.pop(0).result()
+
+    def shutdown(self):
+        """stops the thread once the commands already queued have run"""
+        self.queue.put(None)
@@ -0,0 +1,125 @@
+# -*- coding: ascii -*-
+import numpy as np
+
+CONVERSION_FACTOR = 1.0 / (6.02214150e23 * 6.6260930e-34 * 299792458.0 * 1000)
+
+# temperature coefficients
+AT = 0.00389122
+BT = -0.05766351
+CT = -0.62085660
+
+# every pixel on the detector carries a constant 1500 count offset
+DARK_OFFSET = 1500
+
+
+def temperature_compensation(temp):
+    """returns the number of counts to subtract from every pixel for the given
+    internal sensor temperature"""
+    return AT * temp ** 3 + BT * temp ** 2 + CT * temp
+
+
+class CorrectionEngine(object):
+    """Holds the per-device arrays needed to correct a raw scan so that a scan
+    can be corrected with a handful of array operations instead of a python
+    loop per pixel. The order of every operation matches the original list
+    implementation so the corrected values are identical."""
+    def __init__(self):
+        self.resampler = None
+        self.x_data = np.zeros(0)
+        self.dark_reference = None
+        self.rt_denominator = None
+        self.irradiance = None
+        self.calibration_x = None
+        self._irradiance_gain = None
+        self.light_reference = None
+        self._scaled_dark = None
+        self._scaled_dark_key = None
+
+    def set_resampler(self, resampler):
+        """stores the resampling operator that maps pixels on to x_data"""
+        self.resampler = resampler
+        self.x_data = np.asarray(resampler.x_data, dtype=np.float64)
+        self._irradiance_gain = None
+
+    def set_calibration_wavelengths(self, calibration_x):
+        """the 1 nm wavelengths the irradiance calibration is stored on"""
+        self.calibration_x = np.asarray(calibration_x, dtype=np.float64)
+        self._irradiance_gain = None
+
+    def set_dark_reference(self, dark_reference):
+        if dark_reference:
+            self.dark_reference = np.array(dark_reference, dtype=np.float64)
+        else:
+            self.dark_reference = None
+        self._scaled_dark = None
+        self._scaled_dark_key = None
+        self._update_rt_denominator()
+
+    def set_light_reference(self, light_reference):
+        if light_reference:
+            self.light_reference = np.array(light_reference, dtype=np.float64)
+        else:
+            self.light_reference = None
+        self._update_rt_denominator()
+
+    def set_irradiance(self, irradiance_data):
+        if irradiance_data:
+            self.irradiance = np.array(irradiance_data, dtype=np.float64)
+        else:
+            self.irradiance = None
+        self._irradiance_gain = None
+
+    def irradiance_gain(self):
+        """irradiance calibration on the output grid. The calibration is used
+        as is on the 1 nm grid it was taken on and linearly interpolated on to
+        any other grid."""
+        if self._irradiance_gain is None:
+            x = self.x_data
+            cal_x = self.calibration_x
+            if cal_x is None or (len(x) == len(cal_x) and (x == cal_x).all()):
+                self._irradiance_gain = self.irradiance[:len(x)]
+            else:
+                self._irradiance_gain = np.interp(
+                    x, cal_x, self.irradiance[:len(cal_x)])
+        return self._irradiance_gain
+
+    def _update_rt_denominator(self):
+        """light minus dark is clamped to at least one count to avoid dividing
+        by zero on dead pixels"""
+        if self.dark_reference is None or self.light_reference is None:
+            self.rt_denominator = None
+            return
+        self.rt_denominator = np.maximum(
+            1, self.light_reference - self.dark_reference)
+
+    def scaled_dark(self, integ, dark_integ):
+        """dark reference scaled to the given integration time. The result is
+        cached until either integration time changes."""
+        key = (integ, dark_integ)
+        if self._scaled_dark_key != key:
+            self._scaled_dark = self.dark_reference * integ / dark_integ
+            self._scaled_dark_key = key
+        return self._scaled_dark
+
+    def remove_offset(self, data, temp_compensation):
+        """removes the constant 1500 count dark scan and temperature drift"""
+        return np.asarray(data, dtype=np.float64) - DARK_OFFSET - \
+            temp_compensation
+
+    def reflectance(self, data):
+        return 100 * (data - self.dark_reference) / self.rt_denominator
+
+    def subtract_dark(self, data, integ, dark_integ):
+        return data - self.scaled_dark(integ, dark_integ)
+
+    def interpolate(self, data):
+        """maps the pixel data on to the wavelengths in x_data. Also accepts a
+        2D array with one scan per row."""
+        return self.resampler.apply(data)
+
+    def apply_irradiance(self, data, integ, irrad_unit):
+        ratio = self.irradiance[-1] / integ
+        data = data * self.irradiance_gain() * ratio
+        if irrad_unit == 2:
+            data = data * self.x_data * CONVERSION_FACTOR
+        return data
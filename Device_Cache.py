@@ -0,0 +1,64 @@
+# -*- coding: ascii -*-
+import hashlib
+import json
+from threading import Lock
+
+# bump when the layout of an entry changes so old entries are ignored
+CACHE_VERSION = 1
+
+
+def entry_checksum(entry):
+    """md5 of everything in an entry except its checksum"""
+    content = dict((k, v) for k, v in entry.items() if k != 'checksum')
+    return hashlib.md5(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+class DeviceCache(object):
+    """Metadata that rarely changes on a device (calibration coefficients, hot
+    pixels, irradiance calibration and sensor type) stored in a JSON file keyed
+    by device serial, so connecting does not have to read all of it over USB.
+    Every entry carries a checksum and entries that fail it are ignored."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as cache_file:
+                json.dump(self.entries, cache_file)
+        except IOError, data:
+            print data
+
+    def get(self, serial):
+        """returns the entry for serial or None if there is no valid one"""
+        with self.lock:
+            entry = self.entries.get(serial)
+        if not isinstance(entry, dict) or \
+           entry.get('version') != CACHE_VERSION or \
+           entry.get('checksum') != entry_checksum(entry):
+            return None
+        return entry
+
+    def put(self, serial, **metadata):
+        """stores the given metadata as the entry for serial"""
+        entry = dict(metadata, version=CACHE_VERSION)
+        entry['checksum'] = entry_checksum(entry)
+        with self.lock:
+            self.entries[serial] = entry
+            self.save()
+
+    def invalidate(self, serial):
+        with self.lock:
+            if self.entries.pop(serial, None) is not None:
+                self.save()
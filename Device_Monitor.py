@@ -0,0 +1,58 @@
+# -*- coding: ascii -*-
+from threading import Thread, Event
+
+from USB_Instrument import find_devices
+
+# seconds between two looks at the bus
+POLL_INTERVAL = 1.0
+
+
+def device_key(dev):
+    return (dev.bus, dev.address)
+
+
+class DeviceMonitor(object):
+    """Watches for STS spectroradiometers being attached and removed. pyusb
+    has no hotplug callbacks, so the bus is enumerated every POLL_INTERVAL
+    seconds instead. That only reads the descriptors libusb already holds and
+    does not talk to the devices.
+
+    on_attach(dev) is called from the monitor thread for every device that
+    appears after start is called. It returns False to be called again for
+    the same device on the next poll. on_detach(dev) is called for every
+    device that disappears."""
+    def __init__(self, on_attach, on_detach, interval=POLL_INTERVAL):
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.interval = interval
+        self.known = {}
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        """devices that are attached already are not reported"""
+        self.known = dict((device_key(dev), dev) for dev in find_devices())
+        self.stop_event.clear()
+        self.thread = Thread(target=self.run, name="Device Monitor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception, data:
+                print data
+
+    def poll(self):
+        current = dict((device_key(dev), dev) for dev in find_devices())
+        for key, dev in self.known.items():
+            if key not in current:
+                del self.known[key]
+                self.on_detach(dev)
+        for key, dev in current.items():
+            if key not in self.known and self.on_attach(dev):
+                self.known[key] = dev
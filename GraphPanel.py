@@ -7,15 +7,29 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg, \
      NavigationToolbar2WxAgg
 from matplotlib.figure import Figure
 from matplotlib.widgets import Cursor
+import numpy as np
 
 from constants import IS_MAC, LUX, FOOTCANDLE, RQE, SIGMA_R, SIGMA_FR, \
      CIE_1931, LUX_TO_FOOTCANDLES, PHOTON_FLUX, LUX_MULTIPLIER, ENERGY_FLUX, \
      ILLUMINANCE, X_LABEL
+from Resampling import bin_widths
 
 matplotlib.rcParams['mathtext.default'] = 'regular'
 
 custom_event, CUSTOM_EVT = wx.lib.newevent.NewEvent()
 
+def nearest_index(x_data, x):
+    """index of the point in x_data closest to x. Raises ValueError if x is
+    more than half a bin outside of x_data"""
+    x_data = np.asarray(x_data, dtype=np.float64)
+    if not len(x_data):
+        raise ValueError('empty line')
+    index = int(np.abs(x_data - x).argmin())
+    half_bin = bin_widths(x_data)[index] / 2.0
+    if abs(x_data[index] - x) > max(half_bin, 0.5):
+        raise ValueError('%s is not on the line' % x)
+    return index
+
 def add_toolbar(sizer, canvas):
     """adds the pan and zoom tools (and a few others) to a toolbar at the
     base of the plot panel"""
@@ -98,7 +112,7 @@ class GraphPanel(wx.Panel):
         sizer = wx.BoxSizer(wx.VERTICAL)
         self.axes = figure.add_subplot(111)
         self.x_data = range(340, 821)
-        self.axes.plot(self.x_data, [0] * 481, label='Scan 0')
+        self.axes.plot(self.x_data, [0] * len(self.x_data), label='Scan 0')
         self.axes.legend(loc=1)
         self.canvas = FigureCanvasWxAgg(self, -1, figure)
         figure.tight_layout(pad=2.0)
@@ -203,7 +217,6 @@ class GraphPanel(wx.Panel):
                                    transform=self.axes.transAxes)
             self.canvas.draw()
             return
-        x = round(event.xdata)
         text_lists = []
         ymin, ymax = self.axes.get_ylim()
         xmin, xmax = self.axes.get_xlim()
@@ -214,7 +227,7 @@ class GraphPanel(wx.Panel):
             for line in self.axes.get_lines():
                 try:
                     # make sure line has data where mouse was clicked
-                    index = list(line.get_xdata()).index(x)
+                    index = nearest_index(line.get_xdata(), event.xdata)
                 except ValueError:
                     continue
                 # if label starts with '_' we don't display it. this is what lets
@@ -222,14 +235,15 @@ class GraphPanel(wx.Panel):
                 if line.get_label().startswith('_'):
                     continue
                 # get y coordinate corresponding to the x value
+                x = list(line.get_xdata())[index]
                 y = list(line.get_ydata())[index]
                 while(abs(y) - spacer < 0):
                     if y >= 0:
                         y += spacer/5
                     else:
                         y -= spacer/5
-                text = line.get_label() + ': (%s, %.2f)'
-                text = text % (int(x), y)
+                text = line.get_label() + ': (%g, %.2f)'
+                text = text % (x, y)
                 color = line.get_color()
                 text_lists.append([x, y, text, color])
                 line.set_marker('o')
@@ -347,23 +361,22 @@ class GraphPanel(wx.Panel):
             for p in paired:
                 new_dict = {}
                 new_dict['labels'] = [p[0] + ' and ' + p[1]]
-                new_dict['x_data'] = range(340, 1101)
-                new_dict['y_data'] = [[0] * 761]
+                # keyed by wavelength so sensors on any grid can be merged.
+                # points measured by both sensors are averaged
+                merged = {}
                 scans = scan_data[:]
                 for data in scans:
                     if data['labels'][0] not in p:
                         continue
                     y = data['y_data'][0]
-                    i = data['x_data'][0] - 340
-                    j = 0
-                    while i <= data['x_data'][-1] - 340:
-                        if new_dict['y_data'][0][i] == 0:
-                            new_dict['y_data'][0][i] = y[j]
+                    for j, x in enumerate(data['x_data']):
+                        if merged.get(x, 0) == 0:
+                            merged[x] = y[j]
                         else:
-                            new_dict['y_data'][0][i] = (y[j] + new_dict['y_data'][0][i])/2
-                        i += 1
-                        j += 1
+                            merged[x] = (y[j] + merged[x])/2
                     scan_data.remove(data)
+                new_dict['x_data'] = sorted(merged)
+                new_dict['y_data'] = [[merged[x] for x in new_dict['x_data']]]
                 if active_device in new_dict['labels'][0]:
                     if self.plot_mode == PHOTON_FLUX:
                         new_dict['y_data'][0] = self.calculate_ypf(new_dict['x_data'], new_dict['y_data'][0])
@@ -451,9 +464,9 @@ class GraphPanel(wx.Panel):
         for x in self.x_data:
             if i >= len(self.x_data) - 1:
                 continue
-            self.axes.fill_between([x, x + 1],
+            self.axes.fill_between([x, self.x_data[i+1]],
                                    [y_data[i], y_data[i+1]],
-                                   color=COLOR_MAP[x-340])
+                                   color=COLOR_MAP[int(x)-340])
             i += 1
 
     def apply_text(self, text):
@@ -503,20 +516,23 @@ class GraphPanel(wx.Panel):
         self.canvas.draw()
 
     def integrate_range(self, x_range, y):
-        """calculates an integrated total"""
+        """calculates an integrated total. each point is weighted by the width
+        of the wavelength bin it represents"""
         total = fraction = i = r = fr = 0
+        widths = bin_widths(x_range)
         integ_range = self.integ_lines
         fractional_range = self.fractional_lines
         red, far_red = RED_FARRED
         for x in x_range:
+            area = y[i] * widths[i]
             if integ_range[0] <= x <= integ_range[1]:
-                total += y[i]
+                total += area
             if fractional_range[0] <= x <= fractional_range[1]:
-                fraction += y[i]
+                fraction += area
             if red[0] <= x <= red[1]:
-                r += y[i]
+                r += area
             if far_red[0] <= x <= far_red[1]:
-                fr += y[i]
+                fr += area
             i += 1
         return y + [total, fraction/total, r/fr]
 
@@ -525,27 +541,29 @@ class GraphPanel(wx.Panel):
         if not y:
             return
         total = fraction = ypf = ppf = ppe_r = ppe_fr = i = r = fr = 0
+        widths = bin_widths(x_range)
         integ_range = self.integ_lines
         fractional_range = self.fractional_lines
         red, far_red = RED_FARRED
         for x in x_range:
             x = int(x)
             yp = 0
+            area = y[i] * widths[i]
             if 300 <= x <= 800:
-                yp = y[i] * RQE[x - 300]
+                yp = area * RQE[x - 300]
                 ypf += yp
-                ppe_r += y[i] * SIGMA_R[x - 300]
-                ppe_fr += y[i] * SIGMA_FR[x - 300]
+                ppe_r += area * SIGMA_R[x - 300]
+                ppe_fr += area * SIGMA_FR[x - 300]
             if 400 <= x <= 700:
-                ppf += y[i]
+                ppf += area
             if integ_range[0] <= x <= integ_range[1]:
-                total += y[i]
+                total += area
             if fractional_range[0] <= x <= fractional_range[1]:
-                fraction += y[i]
+                fraction += area
             if red[0] <= x <= red[1]:
-                r += y[i]
+                r += area
             if far_red[0] <= x <= far_red[1]:
-                fr += y[i]
+                fr += area
             i += 1
         if ppe_r:
             ppe = ppe_r/(ppe_r + ppe_fr)
@@ -0,0 +1,254 @@
+# -*- coding: ascii -*-
+from collections import deque
+from threading import Condition, Thread, Timer
+
+from USB_Instrument import DeviceCommunicationError
+
+# what put does when the queue is full
+BLOCK = 'block'                 # wait for the consumer to take an item
+DROP_OLDEST = 'drop oldest'     # discard the oldest item to make room
+KEEP_LATEST = 'keep latest'     # discard everything queued, keep the new item
+POLICIES = [BLOCK, DROP_OLDEST, KEEP_LATEST]
+
+# seconds a frame waits for its last members after the first one arrived
+FRAME_TIMEOUT = 1.0
+
+
+class QueueClosed(Exception):
+    """This exception is thrown by BoundedQueue.get once the queue is closed
+    and empty."""
+
+
+class BoundedQueue(object):
+    """Queue between two stages of a pipeline holding at most maxsize items.
+    The policy decides what happens when the consumer falls behind. Waits
+    have no timeout, python 2 polls timed waits in steps of up to 50 ms, so
+    close is used to wake everybody up instead.
+
+    Several queues can share one condition so a consumer can wait on all of
+    them at once, see FrameAssembler."""
+    def __init__(self, maxsize=2, policy=BLOCK, condition=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %s" % policy)
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.items = deque()
+        if condition is None:
+            condition = Condition()
+        self.condition = condition
+        self.closed = False
+        self.error = None
+        self.dropped = 0
+
+    def put(self, item):
+        """queues item according to the policy. Returns False if the queue
+        was closed, the item is dropped then."""
+        with self.condition:
+            if self.policy == BLOCK:
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.condition.wait()
+            elif self.policy == KEEP_LATEST:
+                self.dropped += len(self.items)
+                self.items.clear()
+            elif len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """returns the oldest item, waiting for one if needed. Once the queue
+        is closed and empty, raises the error it was closed with or
+        QueueClosed."""
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if self.items:
+                item = self.items.popleft()
+                self.condition.notify_all()
+                return item
+            if self.error is not None:
+                raise self.error
+            raise QueueClosed()
+
+    def close(self, error=None):
+        """stops the queue taking items. Items already queued can still be
+        taken, after them get raises error if one is given."""
+        with self.condition:
+            self.closed = True
+            if error is not None and self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+
+class FrameAssembler(object):
+    """Gathers the scans of several devices into frames for the plot thread.
+    Every member has a BoundedQueue of its own and they all share one
+    condition, so get wakes up the moment the last member of a frame arrives
+    rather than on the next poll. Members that are more than timeout seconds
+    behind the first one are left out of the frame, one slow or unplugged
+    device does not hold the others up.
+
+    Members can be anything hashable, they are the keys of the frames get
+    returns."""
+    def __init__(self, members, timeout=FRAME_TIMEOUT, policy=BLOCK, depth=1):
+        self.condition = Condition()
+        self.timeout = timeout
+        self.policy = policy
+        self.depth = depth
+        self.queues = {}
+        for member in members:
+            self.add(member)
+        self.closed = False
+        # the timer of the frame being gathered, its generation tells a timer
+        # that fired too late to cancel apart from the current one
+        self.timer = None
+        self.generation = 0
+        self.expired = False
+        self.incomplete = 0
+
+    def add(self, member):
+        with self.condition:
+            if member not in self.queues:
+                self.queues[member] = BoundedQueue(self.depth, self.policy,
+                                                   self.condition)
+
+    def remove(self, member):
+        """stops waiting for member, anything it has queued is dropped"""
+        with self.condition:
+            queue = self.queues.pop(member, None)
+            if queue is not None:
+                queue.close()
+                self.condition.notify_all()
+
+    def put(self, member, item):
+        """queues item for member according to the policy. Returns False if
+        the assembler was closed or member is not part of it."""
+        with self.condition:
+            queue = self.queues.get(member)
+            if queue is None or not queue.put(item):
+                return False
+            if self.timer is None:
+                self.start_timer()
+            return True
+
+    def get(self):
+        """returns the next frame as a dictionary from member to item, once
+        every member has an item queued or the frame timed out. Raises
+        QueueClosed once closed."""
+        with self.condition:
+            while not self.closed:
+                queued = [queue.items for queue in self.queues.values()]
+                if queued and all(queued):
+                    break
+                if self.expired and any(queued):
+                    break
+                self.condition.wait()
+            else:
+                raise QueueClosed()
+            frame = dict((member, queue.items.popleft())
+                         for member, queue in self.queues.items()
+                         if queue.items)
+            if len(frame) < len(self.queues):
+                self.incomplete += 1
+            self.cancel_timer()
+            if any(queue.items for queue in self.queues.values()):
+                # the next frame has started arriving already
+                self.start_timer()
+            self.condition.notify_all()
+            return frame
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.cancel_timer()
+            for queue in self.queues.values():
+                queue.close()
+            self.condition.notify_all()
+
+    @property
+    def dropped(self):
+        with self.condition:
+            return sum(queue.dropped for queue in self.queues.values())
+
+    def start_timer(self):
+        if self.timeout is None:
+            return
+        self.timer = Timer(self.timeout, self.expire, [self.generation])
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.generation += 1
+        self.expired = False
+
+    def expire(self, generation):
+        with self.condition:
+            if generation == self.generation:
+                self.expired = True
+                self.condition.notify_all()
+
+
+class AcquisitionPipeline(object):
+    """Continuous readings from one device with the USB transfers overlapping
+    the processing. A thread of its own requests the next spectrum as soon as
+    the previous one has arrived and queues every scan, copied out of the
+    device's buffer, in a BoundedQueue. The consumer takes them with get and
+    corrects, analyses and outputs them meanwhile.
+
+    prepare is called on the acquisition thread before every request, to send
+    changed settings to the device."""
+    def __init__(self, device, prepare=None, policy=KEEP_LATEST, depth=2):
+        self.device = device
+        self.prepare = prepare
+        self.queue = BoundedQueue(depth, policy)
+        self.acquired = 0
+        self.thread = Thread(target=self.run,
+                             name="Acquisition Thread %s" % device.name)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def stop(self):
+        """stops acquiring, the spectrum being waited for is abandoned"""
+        self.queue.close()
+        self.device.cancel()
+
+    def get(self):
+        """returns the next Scan. Raises the DeviceCommunicationError the
+        acquisition stopped with, or QueueClosed once stopped."""
+        return self.queue.get()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def run(self):
+        device = self.device
+        try:
+            if self.prepare is not None:
+                self.prepare()
+            device.request_spectrum(copy=True)
+            while not self.queue.closed:
+                scan = device.wait_for_scan()
+                usable = device.settle_exposure(scan)
+                if self.prepare is not None:
+                    self.prepare()
+                device.request_spectrum(copy=True)
+                self.acquired += 1
+                if usable and not self.queue.put(scan):
+                    break
+        except DeviceCommunicationError, data:
+            self.queue.close(data)
+        else:
+            self.queue.close()
@@ -0,0 +1,186 @@
+# -*- coding: ascii -*-
+import numpy as np
+
+NUM_PIXELS = 1024
+
+# wavelength range reported for each sensor type in 1 nm steps. Irradiance
+# calibrations stored on the sensor are defined on this grid.
+SENSOR_RANGES = {'VIS': (340, 820), 'NIR': (635, 1100)}
+
+# selectable output grids as (label, step in nm). A step of None means one
+# output point per (good) detector pixel.
+NATIVE_GRID = 'Native pixels'
+DEFAULT_GRID = '1 nm'
+WAVELENGTH_GRIDS = [(NATIVE_GRID, None), ('0.5 nm', 0.5), ('1 nm', 1),
+                    ('5 nm', 5), ('10 nm', 10)]
+GRID_STEPS = dict(WAVELENGTH_GRIDS)
+
+# grids with steps at least this wide average every pixel inside the bin
+# instead of interpolating between the two nearest pixels
+MIN_BIN_STEP = 2
+
+
+def pixel_wavelengths(calib_coeff, pixels):
+    """evaluates the calibration polynomial stored on the spectroradiometer for
+    an array of pixel indices"""
+    pixels = np.asarray(pixels, dtype=np.int64)
+    return calib_coeff[0] + \
+        calib_coeff[1] * pixels + \
+        calib_coeff[2] * pixels ** 2 + \
+        calib_coeff[3] * pixels ** 3
+
+
+def calibration_wavelengths(sensor_type):
+    """the 1 nm grid the sensor's irradiance calibration is defined on"""
+    start, stop = SENSOR_RANGES[sensor_type]
+    return range(start, stop + 1)
+
+
+def grid_wavelengths(sensor_type, grid):
+    """returns the output wavelengths of a grid with a fixed step. The 1 nm
+    grid is returned as a list of integers as it always has been."""
+    step = GRID_STEPS[grid]
+    start, stop = SENSOR_RANGES[sensor_type]
+    if step == int(step):
+        return range(start, stop + 1, int(step))
+    return np.arange(start, stop + step / 2.0, step).tolist()
+
+
+def bin_widths(x_data):
+    """width in nm represented by each point of the grid. Sums over the grid
+    are weighted by these so integrated totals do not depend on the grid.
+    Returns a list of floats."""
+    x = np.asarray(x_data, dtype=np.float64)
+    if len(x) < 2:
+        return [1.0] * len(x)
+    return np.gradient(x).tolist()
+
+
+class ResamplingOperator(object):
+    """Sparse linear operator that maps the 1024 detector pixels on to an
+    output wavelength grid. Each output point is a weighted sum of a few
+    pixels. The pixel indices and weights are stored as two (points x taps)
+    arrays so a single scan or a 2D batch of scans (one scan per row) is
+    resampled with one gather and one multiply."""
+    def __init__(self, indices, weights, x_data, wavelengths):
+        self.indices = indices
+        self.weights = weights
+        self.x_data = x_data
+        # wavelength of every pixel on the detector
+        self.wavelengths = wavelengths
+
+    @classmethod
+    def build(cls, calib_coeff, hot_pixels, x_data):
+        """Compiles the calibration polynomial and hot pixel list into the
+        operator. Every output wavelength is interpolated between the first
+        pixel with a greater wavelength and the pixel before it. Hot pixels
+        are skipped by moving to the next good pixel (or the previous one at
+        the end of the detector)."""
+        x = np.asarray(x_data, dtype=np.float64)
+        # wavelengths for pixels -1 through 1024, offset by one
+        extended = pixel_wavelengths(calib_coeff,
+                                     np.arange(-1, NUM_PIXELS + 1))
+        wavelengths = extended[1:-1]
+        good = np.ones(NUM_PIXELS, dtype=bool)
+        hot = [p for p in hot_pixels if 0 <= p < NUM_PIXELS]
+        good[hot] = False
+        pixel = np.arange(NUM_PIXELS)
+        next_good = np.minimum.accumulate(
+            np.where(good, pixel, NUM_PIXELS)[::-1])[::-1]
+        prev_good = np.maximum.accumulate(np.where(good, pixel, -1))
+
+        upper = np.searchsorted(wavelengths, x, side='right')
+        upper = np.minimum(upper, NUM_PIXELS - 1)
+        prev = extended[upper]
+        is_hot = ~good[upper]
+        last = is_hot & (upper == NUM_PIXELS - 1)
+        upper = np.where(is_hot, next_good[upper], upper)
+        upper = np.where(last, prev_good[NUM_PIXELS - 1], upper)
+        upper = np.clip(upper, 0, NUM_PIXELS - 1)
+        prev = np.where(last, extended[upper], prev)
+        wavelen = extended[upper + 1]
+        mu = (x - wavelen) / (prev - wavelen)
+
+        indices = np.column_stack((upper - 1, upper)).astype(np.intp)
+        weights = np.column_stack((1 - mu, mu))
+        return cls(indices, weights, x, wavelengths)
+
+    @classmethod
+    def build_for_grid(cls, calib_coeff, hot_pixels, sensor_type, grid):
+        """builds the operator for one of the grids in WAVELENGTH_GRIDS"""
+        step = GRID_STEPS[grid]
+        if step is None:
+            return cls.build_native(calib_coeff, hot_pixels, sensor_type)
+        x_data = grid_wavelengths(sensor_type, grid)
+        if step >= MIN_BIN_STEP:
+            return cls.build_binned(calib_coeff, hot_pixels, x_data, step)
+        operator = cls.build(calib_coeff, hot_pixels, x_data)
+        operator.x_data = x_data
+        return operator
+
+    @classmethod
+    def build_native(cls, calib_coeff, hot_pixels, sensor_type):
+        """one output point per good pixel inside the sensor's range, at the
+        pixel's own wavelength"""
+        wavelengths = pixel_wavelengths(calib_coeff, np.arange(NUM_PIXELS))
+        start, stop = SENSOR_RANGES[sensor_type]
+        keep = (wavelengths >= start) & (wavelengths <= stop)
+        keep[[p for p in hot_pixels if 0 <= p < NUM_PIXELS]] = False
+        pixels = np.flatnonzero(keep)
+        indices = pixels.reshape(-1, 1).astype(np.intp)
+        weights = np.ones((len(pixels), 1))
+        return cls(indices, weights, wavelengths[pixels].tolist(),
+                   wavelengths)
+
+    @classmethod
+    def build_binned(cls, calib_coeff, hot_pixels, x_data, step):
+        """each output point is the mean of the good pixels whose wavelength
+        falls within half a step of it. Bins that contain no good pixel fall
+        back to interpolation at the bin center."""
+        wavelengths = pixel_wavelengths(calib_coeff, np.arange(NUM_PIXELS))
+        good = np.ones(NUM_PIXELS, dtype=bool)
+        good[[p for p in hot_pixels if 0 <= p < NUM_PIXELS]] = False
+        x = np.asarray(x_data, dtype=np.float64)
+        lower = np.searchsorted(wavelengths, x - step / 2.0, side='left')
+        upper = np.searchsorted(wavelengths, x + step / 2.0, side='left')
+        interpolated = cls.build(calib_coeff, hot_pixels, x_data)
+        taps = max(int((upper - lower).max()), interpolated.indices.shape[1])
+        indices = np.zeros((len(x), taps), dtype=np.intp)
+        weights = np.zeros((len(x), taps))
+        for i in range(len(x)):
+            pixels = np.arange(lower[i], upper[i])
+            pixels = pixels[good[pixels]]
+            if len(pixels):
+                indices[i, :len(pixels)] = pixels
+                weights[i, :len(pixels)] = 1.0 / len(pixels)
+            else:
+                width = interpolated.indices.shape[1]
+                indices[i, :width] = interpolated.indices[i]
+                weights[i, :width] = interpolated.weights[i]
+        return cls(indices, weights, x_data, wavelengths)
+
+    def __len__(self):
+        return len(self.x_data)
+
+    def apply(self, scans):
+        """resamples a single scan or an array of scans with one scan per
+        row. Returns a numpy array of the same dimension."""
+        scans = np.asarray(scans)
+        return (scans[..., self.indices] * self.weights).sum(axis=-1)
+
+    def to_matrix(self):
+        """returns the operator as a dense (points x 1024) matrix so stored raw
+        scans can be reprocessed with numpy.dot"""
+        matrix = np.zeros((len(self.x_data), NUM_PIXELS))
+        rows = np.repeat(np.arange(len(self.x_data)), self.indices.shape[1])
+        np.add.at(matrix, (rows, self.indices.ravel() % NUM_PIXELS),
+                  self.weights.ravel())
+        return matrix
+
+    def wavelength_to_pixel(self, wavelength):
+        """returns the first pixel with a wavelength greater than the one given
+        or None if it is beyond the end of the detector"""
+        pixel = int(np.searchsorted(self.wavelengths, wavelength, side='right'))
+        if pixel >= NUM_PIXELS:
+            return None
+        return pixel
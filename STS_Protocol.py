@@ -0,0 +1,272 @@
+# -*- coding: ascii -*-
+"""Encoder and decoder for the binary protocol spoken by the STS.
+
+Every message is a 44 byte header, an optional payload and a 20 byte footer:
+
+HEADER:
+Start Bytes[0:1]         Always the same
+Protocol Version[2:3]    Always the same
+Flags[4:5]               Zero in requests, NACK and exception bits in replies
+Error Number[6:7]        Set in replies to failed requests
+Message Type[8:11]       Identifies the command, see COMMANDS
+Regarding[12:15]         Echoed back by the spec in the reply
+Reserved[16:21]
+Checksum Type[22]        0 for none, 1 for MD5
+Immediate Length[23]     Used for small cmds with payload less than 16 bytes
+Immediate Data[24:39]    Ditto
+Bytes Remaining[40:43]   Number of bytes following header (payload and footer)
+
+FOOTER:
+Checksum[0:15]           MD5 of the header and payload if enabled
+End Bytes[16:19]
+"""
+import struct
+import hashlib
+from collections import namedtuple
+
+HEADER = struct.Struct('<2sHHH4sI6xBB16sI')
+FOOTER = struct.Struct('<16s4s')
+HEADER_SIZE = HEADER.size
+FOOTER_SIZE = FOOTER.size
+# the regarding field of the header, see Codec.encode
+REGARDING = struct.Struct('<I')
+REGARDING_OFFSET = 12
+MAX_IMMEDIATE = 16
+
+START_BYTES = '\xc1\xc0'
+END_BYTES = '\xc5\xc4\xc3\xc2'
+PROTOCOL_VERSION = 0x1000
+DEFAULT_REGARDING = 0xefbeadde
+
+# reply flags
+FLAG_RESPONSE = 0x0001
+FLAG_ACK = 0x0002
+FLAG_ACK_REQUESTED = 0x0004
+FLAG_NACK = 0x0008
+FLAG_EXCEPTION = 0x0010
+
+CHECKSUM_NONE = 0
+CHECKSUM_MD5 = 1
+
+# request formats that are not a struct format. BYTES is a string sent as
+# immediate data when it fits and as payload otherwise, PAYLOAD is a string
+# that is always sent as payload.
+BYTES = 'bytes'
+PAYLOAD = 'payload'
+
+# a get_spectrum reply always carries 2 bytes for every pixel
+SPECTRUM_BYTES = 2048
+
+# name: (message type, request format, reply format). A request format of
+# None means the command takes no parameters and its frame is built once. A
+# reply format of None means the reply has no fixed layout.
+COMMANDS = {
+    'get_spectrum':              ('\x00\x10\x10\x00', None, None),
+    'set_integ':                 ('\x10\x00\x11\x00', '<I', None),
+    'get_avg_scans':             ('\x00\x00\x12\x00', None, '<H'),
+    'set_avg_scans':             ('\x10\x00\x12\x00', '<H', None),
+    'get_wavelen_coeff':         ('\x01\x01\x18\x00', '<B', '<f'),
+    'set_wavelen_coeff':         ('\x11\x01\x18\x00', '<Bf', None),
+    'get_irrad_calib':           ('\x01\x20\x18\x00', None, None),
+    'set_irrad_calib':           ('\x11\x20\x18\x00', PAYLOAD, None),
+    'get_hot_pixels':            ('\x00\x60\x18\x00', None, None),
+    'set_hot_pixels':            ('\x10\x60\x18\x00', BYTES, None),
+    'read_temperature':          ('\x01\x00\x40\x00', '<B', '<f'),
+    'get_dev_alias':             ('\x00\x02\x00\x00', None, None),
+    'set_dev_alias':             ('\x10\x02\x00\x00', BYTES, None),
+    'reset_spec':                ('\x00\x00\x00\x00', None, None),
+    'reset_to_default_settings': ('\x01\x00\x00\x00', None, None),
+    'set_dev_serial':            ('\x10\x03\x00\x00', BYTES, None),
+    'get_dev_serial':            ('\x02\x03\x00\x00', '<B', None),
+    'set_rs232_baudrate':        ('\x10\x08\x00\x00', '<I', None),
+    'get_rs232_baudrate':        ('\x00\x08\x00\x00', None, '<I'),
+    'save_rs232_defaults':       ('\xf0\x08\x00\x00', None, None),
+}
+
+Reply = namedtuple('Reply', 'message_type flags error regarding data')
+
+
+class ProtocolError(Exception):
+    """This exception is thrown when a reply is malformed or was not
+    acknowledged by the spec."""
+
+
+def build_frame(message_type, immediate='', payload='',
+                regarding=DEFAULT_REGARDING, checksum_type=CHECKSUM_NONE):
+    """assembles a complete message from its parts"""
+    header = HEADER.pack(START_BYTES, PROTOCOL_VERSION, 0, 0, message_type,
+                         regarding, checksum_type, len(immediate), immediate,
+                         len(payload) + FOOTER_SIZE)
+    checksum = ''
+    if checksum_type == CHECKSUM_MD5:
+        checksum = hashlib.md5(header + payload).digest()
+    return header + payload + FOOTER.pack(checksum, END_BYTES)
+
+
+def decode_reply(frame, count=None, payload_size=None):
+    """validates the first count bytes of frame (an array, string or numpy
+    uint8 array) as a reply and returns it as a Reply. data is a slice of
+    frame holding the payload, or the immediate data if there is no payload,
+    so it does not copy if frame is a numpy array. Raises ProtocolError if
+    the reply is incomplete, corrupt, has a payload other than payload_size
+    or was not acknowledged."""
+    if count is None:
+        count = len(frame)
+    if count < HEADER_SIZE + FOOTER_SIZE:
+        raise ProtocolError('Short reply of %s bytes' % count)
+    (start, version, flags, error, message_type, regarding, checksum_type,
+     immediate_length, immediate, remaining) = HEADER.unpack_from(frame)
+    if start != START_BYTES:
+        raise ProtocolError('Reply is missing start bytes')
+    if flags & (FLAG_NACK | FLAG_EXCEPTION):
+        raise ProtocolError('Request was not acknowledged, flags %#06x '
+                            'error %s' % (flags, error))
+    total = HEADER_SIZE + remaining
+    payload_length = remaining - FOOTER_SIZE
+    if total > count or payload_length < 0:
+        raise ProtocolError('Unexpected reply length %s' % total)
+    if payload_size is not None and payload_length != payload_size:
+        raise ProtocolError('Expected %s bytes of payload, got %s' %
+                            (payload_size, payload_length))
+    checksum, end = FOOTER.unpack_from(frame, total - FOOTER_SIZE)
+    if end != END_BYTES:
+        raise ProtocolError('Reply is missing end bytes')
+    if checksum_type == CHECKSUM_MD5 and \
+       checksum != hashlib.md5(frame[:total - FOOTER_SIZE]).digest():
+        raise ProtocolError('Reply checksum mismatch')
+    if payload_length:
+        data = frame[HEADER_SIZE:HEADER_SIZE + payload_length]
+    elif immediate_length:
+        data = frame[24:24 + min(immediate_length, MAX_IMMEDIATE)]
+    else:
+        data = None
+    return Reply(message_type, flags, error, regarding, data)
+
+
+class Codec(object):
+    """Encodes the commands in COMMANDS. Frames of commands without parameters
+    are built once and reused, a tagged one gets its regarding field patched
+    in. Commands with struct parameters keep the frame around their immediate
+    data and a struct.Struct that packs and pads the parameters, so encoding
+    them is one pack and two concatenations."""
+    def __init__(self, checksum=False):
+        if checksum:
+            self.checksum_type = CHECKSUM_MD5
+        else:
+            self.checksum_type = CHECKSUM_NONE
+        self.frames = {}
+        # the frames split around their regarding field, if they have no
+        # checksum over it
+        self.tagged = {}
+        self.packers = {}
+        self.templates = {}
+        self.reply_packers = {}
+        for name, (message_type, request, reply) in COMMANDS.items():
+            if request is None:
+                frame = build_frame(message_type,
+                                    checksum_type=self.checksum_type)
+                self.frames[name] = frame
+                if not checksum:
+                    self.tagged[name] = (
+                        frame[:REGARDING_OFFSET],
+                        frame[REGARDING_OFFSET + REGARDING.size:])
+            elif request not in (BYTES, PAYLOAD):
+                packer = struct.Struct(request)
+                self.packers[name] = packer
+                if not checksum:
+                    frame = build_frame(message_type, '\x00' * packer.size)
+                    self.templates[name] = (
+                        frame[:24],
+                        struct.Struct('%s%dx' % (
+                            request, MAX_IMMEDIATE - packer.size)),
+                        frame[24 + MAX_IMMEDIATE:])
+            if reply is not None:
+                self.reply_packers[name] = struct.Struct(reply)
+
+    def encode(self, name, *args, **kwargs):
+        """returns the message for the named command with the given parameters.
+        Pass regarding=<int> to tag the request, the spec echoes the tag in
+        its reply."""
+        regarding = kwargs.get('regarding')
+        if regarding is None:
+            if name in self.frames:
+                return self.frames[name]
+            if name in self.templates:
+                prefix, packer, suffix = self.templates[name]
+                return prefix + packer.pack(*args) + suffix
+            regarding = DEFAULT_REGARDING
+        elif name in self.tagged:
+            prefix, suffix = self.tagged[name]
+            return prefix + REGARDING.pack(regarding) + suffix
+        message_type, request, reply = COMMANDS[name]
+        immediate = payload = ''
+        if request is None:
+            pass
+        elif request == PAYLOAD:
+            payload = args[0]
+        elif request == BYTES:
+            if len(args[0]) <= MAX_IMMEDIATE:
+                immediate = args[0]
+            else:
+                payload = args[0]
+        else:
+            immediate = self.packers[name].pack(*args)
+        return build_frame(message_type, immediate, payload, regarding,
+                           self.checksum_type)
+
+    def unpack(self, name, data):
+        """unpacks the data of a reply to the named command. Raises
+        struct.error if the data has the wrong size."""
+        return self.reply_packers[name].unpack(data)
+
+
+if __name__ == '__main__':
+    # compares the codec with the list based assembly it replaced
+    import timeit
+
+    def legacy_header():
+        return ['\xc1\xc0', '\x00\x10', '\x00\x00', '\x00\x00',
+                '\x00\x00\x00\x00', '\xde\xad\xbe\xef',
+                '\x00\x00\x00\x00\x00\x00', '\x00', '\x00', '\x00' * 16,
+                '\x14\x00\x00\x00']
+
+    def legacy_footer():
+        return ['\x00' * 16, '\xc5\xc4\xc3\xc2']
+
+    def legacy_get_spectrum():
+        msg = legacy_header()
+        msg[4] = '\x00\x10\x10\x00'
+        msg = msg + legacy_footer()
+        return ''.join(msg)
+
+    def legacy_set_integ(integ=10000):
+        msg = legacy_header()
+        msg[4] = '\x10\x00\x11\x00'
+        msg[8] = '\x04'
+        msg[9] = struct.pack('<I', integ) + ''.join(['\x00'] * 12)
+        msg += legacy_footer()
+        return ''.join(msg)
+
+    codec = Codec()
+    assert codec.encode('get_spectrum') == legacy_get_spectrum()
+    assert codec.encode('set_integ', 10000) == legacy_set_integ()
+    assert codec.encode('set_integ', 10000, regarding=DEFAULT_REGARDING) == \
+        legacy_set_integ()
+    message_type = COMMANDS['get_spectrum'][0]
+    assert codec.encode('get_spectrum', regarding=7) == \
+        build_frame(message_type, regarding=7)
+    reply = build_frame(COMMANDS['get_spectrum'][0], payload='\x00' * 2048)
+    cases = [
+        ('get_spectrum legacy', legacy_get_spectrum),
+        ('get_spectrum codec', lambda: codec.encode('get_spectrum')),
+        ('get_spectrum built', lambda: build_frame(message_type,
+                                                   regarding=7)),
+        ('get_spectrum tagged', lambda: codec.encode('get_spectrum',
+                                                     regarding=7)),
+        ('set_integ legacy', legacy_set_integ),
+        ('set_integ codec', lambda: codec.encode('set_integ', 10000)),
+        ('decode spectrum', lambda: decode_reply(reply, None, SPECTRUM_BYTES)),
+    ]
+    for label, func in cases:
+        best = min(timeit.repeat(func, number=100000, repeat=3))
+        print '%-22s %6.2f us' % (label, best * 10)
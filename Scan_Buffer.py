@@ -0,0 +1,83 @@
+# -*- coding: ascii -*-
+import datetime
+from collections import namedtuple
+from threading import Lock
+
+import numpy as np
+
+from Resampling import NUM_PIXELS
+
+# scans kept per device, about 6 MB at 2 kB of raw counts a scan
+SCAN_BUFFER_SIZE = 3000
+
+# copies of buffered scans, oldest first. one row of pixels per scan, the
+# other fields hold one value per scan
+BufferedScans = namedtuple('BufferedScans',
+                           'pixels trigger_time complete_time integ '
+                           'temperature')
+
+
+class ScanBuffer(object):
+    """The last size raw scans of one device with the time they were triggered
+    and received at, their integration time and the sensor temperature, so a
+    stretch of readings can still be saved after it was plotted. Everything
+    is allocated up front and every scan is copied over the oldest one, the
+    memory used never grows."""
+    def __init__(self, size=SCAN_BUFFER_SIZE):
+        self.lock = Lock()
+        self.allocate(size)
+
+    def allocate(self, size):
+        with self.lock:
+            self.size = max(1, int(size))
+            self.pixels = np.zeros((self.size, NUM_PIXELS), dtype=np.uint16)
+            self.trigger_time = np.zeros(self.size, dtype=np.float64)
+            self.complete_time = np.zeros(self.size, dtype=np.float64)
+            self.integ = np.zeros(self.size, dtype=np.uint32)
+            self.temperature = np.zeros(self.size, dtype=np.float32)
+            # slot the next scan is copied in to and how many are held
+            self.next = 0
+            self.count = 0
+
+    def resize(self, size):
+        """holds size scans from now on, the scans held are dropped"""
+        if int(size) != self.size:
+            self.allocate(size)
+
+    def append(self, scan, temperature):
+        """copies a Scan in to the buffer"""
+        with self.lock:
+            i = self.next
+            self.pixels[i] = scan.pixels
+            self.trigger_time[i] = scan.trigger_time
+            self.complete_time[i] = scan.complete_time
+            self.integ[i] = scan.integ
+            self.temperature[i] = temperature
+            self.next = (i + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def since(self, start):
+        """returns BufferedScans of the scans triggered at or after start, a
+        time.time() value"""
+        with self.lock:
+            order = (np.arange(self.count) + self.next - self.count) % \
+                self.size
+            keep = order[self.trigger_time[order] >= start]
+            return BufferedScans(self.pixels[keep], self.trigger_time[keep],
+                                 self.complete_time[keep], self.integ[keep],
+                                 self.temperature[keep])
+
+
+def write_scans(file_path, name, wavelengths, scans):
+    """writes BufferedScans to a csv file, one row of raw counts per scan
+    under a row of the wavelength of every pixel"""
+    with open(file_path, 'w') as capture_file:
+        capture_file.write(','.join(
+            ['Timestamp %s' % name, 'Integration Time (us)', 'Sensor Temp'] +
+            ['%.2f' % wavelength for wavelength in wavelengths]) + '\n')
+        for i in range(len(scans.trigger_time)):
+            taken = datetime.datetime.fromtimestamp(scans.trigger_time[i])
+            row = [taken.strftime("%H:%M:%S.%f %Y/%m/%d"),
+                   str(scans.integ[i]), '%.2f' % scans.temperature[i]]
+            capture_file.write(','.join(row + map(str, scans.pixels[i])) +
+                               '\n')
@@ -1,105 +1,93 @@
 # -*- coding: ascii -*-
+import errno
+import os
 import struct
+import sys
+from array import array
+from collections import namedtuple
 from math import ceil
-from time import sleep
-from threading import Event, BoundedSemaphore
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+from threading import Event, Lock, Thread
 
 import usb.core
 import usb.util
 import usb.backend.libusb1 as libusb1
+import numpy as np
 
-from constants import *
-
-
-class Commands(object):
-    def __init__(self):
-        pass
-    @property
-    def HEADER(self):
-        """
-        HEADER:
-        0 Start Bytes[0:1]       Always the same
-        1 Protocol Version[2:3]  Always the same
-        2 Flags[4:5]             Always the same
-        3 Error Number[6:7]      Always the same
-        4 Message Type[8:11]     Changes based on STS_CMD
-        5 Regarding[12:15]       Always the same
-        6 Reserved[16:21]        Always the same
-        7 Checksum Type[22]      Always the same (not using checksum)
-        8 Immediate Length[23]   Used for small cmds with payload less than 16 bytes
-        9 Immediate Data[24:39]  Ditto
-        10 Bytes Remaining[40:43] Number of bytes following header (payload and footer)
-        """
-        return [
-            '\xc1\xc0',
-            '\x00\x10',
-            '\x00\x00',
-            '\x00\x00',
-            '\x00\x00\x00\x00',
-            '\xde\xad\xbe\xef',
-            '\x00\x00\x00\x00\x00\x00',
-            '\x00',
-            '\x00',
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00',
-            '\x14\x00\x00\x00'
-        ]
-    @property
-    def FOOTER(self):
-        """
-        FOOTER:
-        Checksum[0:15]
-        End Bytes[16:19]
-        """
-        return [
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00',
-            '\xc5\xc4\xc3\xc2'
-        ]
+from Resampling import ResamplingOperator, calibration_wavelengths, \
+     DEFAULT_GRID, NUM_PIXELS
+from Correction_Engine import CorrectionEngine, temperature_compensation
+from STS_Protocol import Codec, ProtocolError, decode_reply, HEADER_SIZE, \
+     FOOTER_SIZE, SPECTRUM_BYTES
+from Command_Executor import CommandExecutor
+from Auto_Exposure import AutoExposure
+from Scan_Buffer import ScanBuffer
 
 
 class DeviceCommunicationError(Exception):
     """This exception is thrown whenever there is a problem communicating."""
 
 
-TARGET_HIGH = 16000
-TARGET = 14500
-TARGET_LOW = 13000
-MAX_AUTO_INTEG = 2000000
-MIN_AUTO_INTEG = 5000
-
-CONVERSION_FACTOR = 1.0 / (6.02214150e23 * 6.6260930e-34 * 299792458.0 * 1000)
-
-# temperature coefficients
-AT = 0.00389122
-BT = -0.05766351
-CT = -0.62085660
-
-STS_CMD = {
-    'get_spectrum':              '\x00\x10\x10\x00',
-    'set_integ':                 '\x10\x00\x11\x00',
-    'get_avg_scans':             '\x00\x00\x12\x00',
-    'set_avg_scans':             '\x10\x00\x12\x00',
-    'get_wavelen_coeff':         '\x01\x01\x18\x00',
-    'set_wavelen_coeff':         '\x11\x01\x18\x00',
-    'get_irrad_calib':           '\x01\x20\x18\x00',
-    'set_irrad_calib':           '\x11\x20\x18\x00',
-    'get_hot_pixels':            '\x00\x60\x18\x00',
-    'set_hot_pixels':            '\x10\x60\x18\x00',
-    'read_temperature':          '\x01\x00\x40\x00',
-    'get_dev_alias':             '\x00\x02\x00\x00',
-    'set_dev_alias':             '\x10\x02\x00\x00',
-    'reset_spec':                '\x00\x00\x00\x00',
-    'reset_to_default_settings': '\x01\x00\x00\x00',
-    "set_dev_serial":            '\x10\x03\x00\x00',
-    "get_dev_serial":            '\x02\x03\x00\x00',
-    'set_rs232_baudrate':        '\x10\x08\x00\x00',
-    'get_rs232_baudrate':        '\x00\x08\x00\x00',
-    'save_rs232_defaults':       '\xf0\x08\x00\x00'
-}
-
-ALIAS = '\xc1\xc0\x00\x10\x00\x00\x00\x00\x00\x02\x00\x00\xde\xad\xbe\xef' \
-    '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
-    '\x00\x00\x00\x00\x00\x00\x00\x14\x00\x00\x00\x00\x00\x00\x00\x00\x00' \
-    '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc5\xc4\xc3\xc2'
+class AcquisitionCancelled(DeviceCommunicationError):
+    """This exception is thrown when Instrument.cancel is called while waiting
+    for a spectrum."""
+
+
+# raw pixel counts of one spectrum with the integration time (microseconds)
+# it was taken at and the time.time() it was triggered and received at
+Scan = namedtuple('Scan', 'pixels integ trigger_time complete_time')
+# a device configured and asked for its alias by probe_device, endpoints are
+# its (out, in) bulk endpoints
+ProbedDevice = namedtuple('ProbedDevice', 'dev alias endpoints')
+
+# scans retaken at a new integration time before one is used regardless
+MAX_RESCANS = 3
+
+# replies are waited for in slices of this many seconds so that a waiting
+# acquisition can be cancelled and idle_callback called in between
+READ_SLICE = 0.1
+# allowance per averaged scan for readout on top of the integration time
+SCAN_OVERHEAD = 0.01
+# how long past the expected completion we wait for a reply before giving up
+REPLY_MARGIN = 1.0
+# the rest of a reply follows its first packet immediately
+REST_TIMEOUT_MS = 1000
+PACKET_SIZE = 64
+# libusb's LIBUSB_ERROR_TIMEOUT
+LIBUSB_ERROR_TIMEOUT = -7
+# how long a command may take to be answered, on top of the time the spectra
+# queued ahead of it take, see Instrument.queued_work
+COMMAND_TIMEOUT = 5.0
+# the spec does not answer while it resets
+RESET_DELAY = 5
+# the spec finishes a spectrum before it answers anything else, so one that
+# was abandoned but is due later than this is cut short by resetting the spec
+RESYNC_WAIT = RESET_DELAY
+# the sensor temperature drifts over minutes, by default it is read again
+# after this many scans or seconds, whichever comes first
+TEMP_SAMPLE_SCANS = 100
+TEMP_SAMPLE_SECONDS = 10.0
+
+
+def is_timeout(error):
+    """True if a usb.core.USBError is a timeout rather than a failure"""
+    return getattr(error, 'backend_error_code', None) == LIBUSB_ERROR_TIMEOUT \
+        or error.errno == errno.ETIMEDOUT
+
+# shared by every device, the codec holds no per-device state
+CODEC = Codec()
+
+STS_VENDOR_ID = 0x2457
+STS_PRODUCT_ID = 0x4000
+
+# the libusb library is shipped next to the executable
+if sys.platform != 'darwin':
+    backend = libusb1.get_backend(
+        find_library=lambda x: (os.path.join(os.getcwd(), 'libusb-1.0.dll')))
+else:
+    backend = libusb1.get_backend(
+        find_library=lambda x: (os.path.join(os.getcwd(), 'libusb-1.0.dylib')))
 
 DARK_REFERENCE = []
 EF_DARK_REFERENCE = []
@@ -109,99 +97,347 @@ EF_DARK_INTEG = 1
 PF_DARK_INTEG = 1
 
 
+def find_devices():
+    """returns every STS spectroradiometer attached over USB"""
+    return list(usb.core.find(find_all=True, idVendor=STS_VENDOR_ID,
+                              idProduct=STS_PRODUCT_ID, backend=backend))
+
+
+def open_endpoints(dev):
+    """configures the device and returns its (out, in) bulk endpoints"""
+    dev.set_configuration()
+    cfg = dev.get_active_configuration()
+    intf = cfg[(0, 0)]
+    endpoint_out = usb.util.find_descriptor(
+        intf, custom_match= \
+        lambda e: \
+        usb.util.endpoint_direction(e.bEndpointAddress) == \
+        usb.util.ENDPOINT_OUT)
+    endpoint_in = usb.util.find_descriptor(
+        intf, custom_match= \
+        lambda e: \
+        usb.util.endpoint_direction(e.bEndpointAddress) == \
+        usb.util.ENDPOINT_IN)
+    return endpoint_out, endpoint_in
+
+
+def release_device(dev):
+    """gives up the claim on dev and closes it"""
+    try:
+        usb.util.release_interface(dev, 0)
+        usb.util.dispose_resources(dev)
+    except usb.core.USBError, data:
+        print data
+
+
+def probe_device(dev):
+    """Configures dev and reads its alias with a single query, without
+    opening an Instrument. Returns a ProbedDevice or None if the alias could
+    not be read. The device is left configured, hand it to open_instruments
+    or release_device."""
+    try:
+        endpoint_out, endpoint_in = open_endpoints(dev)
+    except (usb.core.USBError, NotImplementedError), data:
+        print data
+        return None
+    try:
+        try:
+            # flush any reply left over from before
+            endpoint_in.read(3000, 10)
+        except usb.core.USBError:
+            pass
+        endpoint_out.write(CODEC.encode('get_dev_alias'))
+        alias = decode_reply(endpoint_in.read(64)).data.tostring()
+    except (usb.core.USBError, ProtocolError), data:
+        print data
+        release_device(dev)
+        return None
+    return ProbedDevice(dev, alias, (endpoint_out, endpoint_in))
+
+
+def probe_devices(devices):
+    """Probes the given devices at the same time, so the devices to connect
+    can be chosen before any Instrument is opened. Returns a ProbedDevice for
+    every device whose alias could be read."""
+    if not devices:
+        return []
+    pool = ThreadPool(len(devices))
+    try:
+        probed = pool.map(probe_device, devices)
+    finally:
+        pool.close()
+    return [device for device in probed if device is not None]
+
+
+def open_instrument(dev, cache=None, alias=None, endpoints=None):
+    """returns an Instrument for dev or None if it could not be opened"""
+    try:
+        return Instrument(dev, alias, cache, endpoints)
+    except (usb.core.USBError, DeviceCommunicationError,
+            NotImplementedError), data:
+        print data
+
+
+def open_instruments(probed, cache=None):
+    """Opens an Instrument for each of the ProbedDevices given at the same
+    time so that connecting several sensors takes as long as the slowest of
+    them. The Instruments carry on with the alias and endpoints of the probe,
+    the devices are not configured again. Devices that could not be opened
+    are left out."""
+    if not probed:
+        return []
+    pool = ThreadPool(len(probed))
+    try:
+        instruments = pool.map(
+            lambda device: open_instrument(device.dev, cache, device.alias,
+                                           device.endpoints),
+            probed)
+    finally:
+        pool.close()
+    return [instrument for instrument in instruments if instrument is not None]
+
+
+def same_device(a, b):
+    """True if two usb.core.Device objects are the same attached device"""
+    return (a.bus, a.address) == (b.bus, b.address)
+
+
 class Instrument(object):
-    def __init__(self, device):
+    """Driver for a single STS spectroradiometer. Nothing in here depends on
+    wx, a GUI that needs to stay responsive while waiting for a spectrum sets
+    idle_callback.
+
+    The alias is read from the device unless it is given, and the device is
+    configured unless its endpoints are given. With a DeviceCache the
+    calibration is taken from the cache when there is an entry for the
+    device's serial and refreshed from the device in the background."""
+    def __init__(self, device, alias=None, cache=None, endpoints=None):
         self.dev = device
-        self.sts_semaphore = BoundedSemaphore(value=1)
-        self.dev.set_configuration()
-        cfg = self.dev.get_active_configuration()
-        intf = cfg[(0, 0)]
-        self.endpoint_out = usb.util.find_descriptor(
-            intf, custom_match= \
-            lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_OUT)
-        self.endpoint_in = usb.util.find_descriptor(
-            intf, custom_match= \
-            lambda e: \
-            usb.util.endpoint_direction(e.bEndpointAddress) == \
-            usb.util.ENDPOINT_IN)
-        self.cmd = Commands()
-        # these events are checked by the thread assigned to this device and
-        # cleared after each one has been serviced
-        self.update_integ = Event()
-        self.update_integ.set()
-        self.update_average_scans = Event()
-        self.update_average_scans.clear()
-        self.change_units = Event()
-        self.change_units.set()
-        self.data_ready = Event()
-        self.data_ready.clear()
+        self.cache = cache
+        self.serial = 'None'
+        # every transfer to and from the spec runs on this thread, in the
+        # order it was submitted
+        self.executor = CommandExecutor('STS %s' % id(device))
+        if endpoints is None:
+            endpoints = open_endpoints(self.dev)
+        self.endpoint_out, self.endpoint_in = endpoints
+        self.codec = CODEC
+        self.engine = CorrectionEngine()
+        # the AcquisitionSettings last sent to the device and the (mode, unit)
+        # its units were last set for, None to apply them all again
+        self.settings = None
+        self.units = None
         self.prev_integ = 1
         self.dark_integ = 1
         self.prev_temp = 0
+        # time.time() of the reading in prev_temp, 0 until the first one
+        self.temp_time = 0
+        self.temp_compensation = 0.0
+        self.scans_since_temp = 0
+        self.temp_sample_scans = TEMP_SAMPLE_SCANS
+        self.temp_sample_seconds = TEMP_SAMPLE_SECONDS
         self.dark_ref_taken = False
         self.light_reference = []
         self.dark_reference = []
         self.x_data = []
         self.y_data = []
         self.calibration_scan = []
+        # raw counts of the latest scan are decoded in to this buffer, it is
+        # reused for every scan instead of allocating a new one
+        self.pixel_buffer = np.zeros(NUM_PIXELS, dtype=np.uint16)
+        # replies of a known size are read in to this buffer in one transfer
+        self.frame_buffer = array('B')
+        self.frame_view = np.zeros(0, dtype=np.uint8)
+        self.packet_buffer = array('B', '\x00' * PACKET_SIZE)
+        self.rest_buffer = array('B')
+        # set by cancel() to abandon the spectrum currently being waited for
+        self.cancel_event = Event()
+        # time.time() of the last cancel() and how long the spectrum being
+        # waited for took to give up after it
+        self.cancel_time = 0
+        self.stop_latency = None
+        # every get_spectrum is tagged so replies to abandoned ones can be told
+        # apart, abandoned is the time.time() the spec will have finished the
+        # last of those
+        self.spectrum_tag = 0
+        self.abandoned = None
+        # called between slices while waiting for the executor
+        self.idle_callback = None
+        self.reply_deadline = 0
+        # Future of the spectrum requested by request_spectrum
+        self.pending_spectrum = None
+        # seconds the spectra queued on the executor will take at most, a
+        # command queued behind them waits that much longer
+        self.queued_work = 0.0
+        self.work_lock = Lock()
+        # time.time() get_spectrum was sent and its reply received at
+        self.trigger_time = 0
+        self.complete_time = 0
+        # integration time last sent to the spec, prev_integ is updated as soon
+        # as a change is queued
+        self.device_integ = 1
+        self.rescans = 0
+        self.exposure = AutoExposure()
+        # every scan taken is kept here until it is overwritten
+        self.scan_buffer = ScanBuffer()
+        # the Scan received last, its pixels are overwritten by the next one
+        # unless it was copied
+        self.last_scan = None
         self.dark_pixels = []
+        # held while a scan is corrected and while refresh_metadata swaps in
+        # the metadata read from the device
+        self.metadata_lock = Lock()
         self.auto_integration = True
         self.avg_scans = 1
         self.paired = False
+        # cleared while the device is unplugged, see take_over
+        self.attached = Event()
+        self.attached.set()
         try:
             self.read()
         except Exception:
             pass
-        self.name = self.get_device_alias()
+        if alias is None:
+            alias = self.get_device_alias()
+        self.name = alias
         self.file_path = ''
         self.calib_coeff = []
-        self.wavelength_indices = []
+        self.resampler = None
+        self.grid = DEFAULT_GRID
         self.irradiance_data = []
         self.irrad_unit = 0
-        self.get_hot_pixel_indices()
-        self.build_wavelength_indices()
-        self.get_irradiance_calibration()
+        if not self.load_metadata():
+            self.read_metadata()
+            self.store_metadata()
         # initialized to 10 ms integration period
         self.set_integration_period(10000)
 
-    def build_wavelength_indices(self):
-        """constructs a list of tuples containing the pixel index and its
-        corresponding actual wavelengths. These values are used for interpolation
-        in the correct_data method"""
-        self.calib_coeff = self.get_calibration_coefficients()
-        self.wavelength_indices = []
+    def build_wavelength_indices(self, calib_coeff=None):
+        """reads the calibration coefficients from the spectroradiometer (unless
+        they are given), determines the sensor type and builds the resampling
+        operator used for interpolation in the correct_data method"""
+        if calib_coeff is None:
+            calib_coeff = self.get_calibration_coefficients()
+        self.calib_coeff = calib_coeff
         if self.calib_coeff[0] > 600:
-            self.x_data = range(635, 1101)
             self.sensor_type = 'NIR'
         else:
-            self.x_data = range(340, 821)
             self.sensor_type = 'VIS'
-        i = 0
-        for pixel_index in range(1024):
-            wavelen = self.pixel_to_wavelength(pixel_index)
-            if self.x_data[i] >= wavelen:
-                continue
-            prev = self.pixel_to_wavelength(pixel_index - 1)
-            if pixel_index in self.dark_pixels:
-                if pixel_index < 1023:
-                    while pixel_index in self.dark_pixels:
-                        pixel_index += 1
-                    wavelen = self.pixel_to_wavelength(pixel_index)
-                else:
-                    while pixel_index in self.dark_pixels:
-                        pixel_index -= 1
-                    wavelen = self.pixel_to_wavelength(pixel_index)
-                    prev = self.pixel_to_wavelength(pixel_index - 1)
-            self.wavelength_indices.append(
-                (pixel_index, (self.x_data[i] - wavelen) / (prev - wavelen)))
-            i += 1
-            if i >= len(self.x_data):
-                break
-            if pixel_index == 1023:
-                self.wavelength_indices.append(
-                    (pixel_index, (self.x_data[i] - wavelen) / (prev - wavelen)))
+        self.engine.set_calibration_wavelengths(
+            calibration_wavelengths(self.sensor_type))
+        self.build_resampler()
+
+    def read_metadata(self):
+        """reads the hot pixels, calibration coefficients and irradiance
+        calibration from the spectroradiometer"""
+        self.get_hot_pixel_indices()
+        self.build_wavelength_indices()
+        self.get_irradiance_calibration()
+
+    def metadata(self):
+        return dict(calib_coeff=self.calib_coeff, hot_pixels=self.dark_pixels,
+                    irradiance=self.irradiance_data,
+                    sensor_type=self.sensor_type)
+
+    def load_metadata(self):
+        """Uses the cached metadata for this device's serial if there is any,
+        which costs a single query instead of one per coefficient, and starts
+        refreshing it in the background. Returns False if there is no cache
+        entry."""
+        if self.cache is None:
+            return False
+        serial = self.get_device_serial()
+        entry = self.cache.get(serial)
+        if serial == 'None' or entry is None:
+            return False
+        self.dark_pixels = list(entry['hot_pixels'])
+        self.build_wavelength_indices(list(entry['calib_coeff']))
+        self.irradiance_data = list(entry['irradiance'])
+        refresh = Thread(target=self.refresh_metadata,
+                         name='Refresh %s' % serial)
+        refresh.daemon = True
+        refresh.start()
+        return True
+
+    def store_metadata(self):
+        """writes the current metadata to the cache"""
+        if self.cache is None:
+            return
+        if self.serial == 'None':
+            self.get_device_serial()
+        if self.serial != 'None':
+            self.cache.put(self.serial, **self.metadata())
+
+    def invalidate_metadata(self):
+        """drops the cache entry after the metadata on the device is changed,
+        it is read from the device on the next connect"""
+        if self.cache is not None:
+            self.cache.invalidate(self.serial)
+
+    def refresh_metadata(self):
+        """Reads the metadata from the device again and replaces the cached
+        copy in use if it differs"""
+        try:
+            hot_pixels = self.read_hot_pixel_indices()
+            calib_coeff = self.get_calibration_coefficients()
+            irradiance = self.read_irradiance_calibration()
+        except Exception, data:
+            print data
+            return
+        if hot_pixels is None:
+            hot_pixels = self.dark_pixels
+        if irradiance is None:
+            irradiance = self.irradiance_data
+        if (hot_pixels, calib_coeff, irradiance) == \
+           (self.dark_pixels, self.calib_coeff, self.irradiance_data):
+            return
+        print 'Cached metadata of %s is out of date' % self.serial
+        with self.metadata_lock:
+            self.dark_pixels = hot_pixels
+            self.build_wavelength_indices(calib_coeff)
+            self.irradiance_data = irradiance
+        self.store_metadata()
+
+    def build_resampler(self):
+        """compiles the current calibration coefficients, hot pixels and output
+        grid into the resampling operator. Call this whenever any of them
+        change."""
+        self.resampler = ResamplingOperator.build_for_grid(
+            self.calib_coeff, self.dark_pixels, self.sensor_type, self.grid)
+        self.x_data = self.resampler.x_data
+        self.engine.set_resampler(self.resampler)
+
+    def set_wavelength_grid(self, grid):
+        """changes the output wavelength grid to one of WAVELENGTH_GRIDS"""
+        self.grid = grid
+        self.build_resampler()
+
+    @property
+    def dark_reference(self):
+        return self._dark_reference
+
+    @dark_reference.setter
+    def dark_reference(self, dark_reference):
+        self._dark_reference = dark_reference
+        self.engine.set_dark_reference(dark_reference)
+
+    @property
+    def light_reference(self):
+        return self._light_reference
+
+    @light_reference.setter
+    def light_reference(self, light_reference):
+        self._light_reference = light_reference
+        self.engine.set_light_reference(light_reference)
+
+    @property
+    def irradiance_data(self):
+        return self._irradiance_data
+
+    @irradiance_data.setter
+    def irradiance_data(self, irradiance_data):
+        self._irradiance_data = irradiance_data
+        self.engine.set_irradiance(irradiance_data)
 
     def pixel_to_wavelength(self, pixel):
         """converts a pixel index to it's corresponding wavelengths based on the
@@ -231,86 +467,131 @@ class Instrument(object):
             data = self.get_pixel_data()
         if data is not None:
             self.y_data = self.correct_data(data, rt) + [self.prev_integ]
-        self.data_ready.set()
 
     def auto_integrate(self, pixel_data):
         """This computes the integration period based on recieved values from
         the spec. We do this before any interpolation so we are comparing
-        raw digital counts."""
-        new_integ = 0
-        peak = max(pixel_data)
-        num_max_values = sum(i > 16383 for i in pixel_data)
-        if peak > TARGET_HIGH:
-            if num_max_values >= 600:
-                new_integ = 3000;
-            elif num_max_values >= 100:
-                new_integ = int(self.prev_integ * 0.25)
-            else:
-                new_integ = int(self.prev_integ * 0.8)
-        elif peak < TARGET_LOW and self.prev_integ != MAX_AUTO_INTEG:
-            new_integ = self.prev_integ * TARGET/peak
-            new_integ = min(new_integ, MAX_AUTO_INTEG)
-            if new_integ < MIN_AUTO_INTEG:
-                new_integ = MIN_AUTO_INTEG * 4
-        if new_integ:
+        raw digital counts. See AutoExposure."""
+        new_integ = self.exposure.next_integration(pixel_data, self.prev_integ)
+        if new_integ is not None and new_integ != self.prev_integ:
             self.set_integration_period(new_integ)
-            self.prev_integ = new_integ
+
+    def seed_exposure(self):
+        """starts auto integration from the integration time that was last
+        stable rather than the one set by hand"""
+        seed = self.exposure.last_stable
+        if seed is not None and seed != self.prev_integ:
+            self.set_integration_period(seed)
 
     def flush_buffer(self):
+        self.run(self._flush)
+
+    def _flush(self):
         try:
             self.endpoint_in.read(3000, 10)
         except usb.core.USBError:
             pass
 
-    def correct_data(self, data, rt):
+    def correct_data(self, data, rt, integ=None):
         """Removes the constant 1500 darkscan, interpolates data, applies
         irradiance calibration if it's a calibrated sensor and returns a list
-        of corrected data."""
-        self.prev_temp = self.get_internal_temp()
-        temperature_compensation = AT * self.prev_temp ** 3 + \
-            BT * self.prev_temp ** 2 + CT * self.prev_temp
+        of corrected data. integ is the integration time the data was taken
+        at, prev_integ if not given."""
+        return self.correct_data_array(data, rt, integ).tolist()
+
+    def correct_data_array(self, data, rt, integ=None):
+        """Same as correct_data but returns the numpy array produced by the
+        correction engine."""
+        if integ is None:
+            integ = self.prev_integ
+        compensation = self.update_temperature()
         # constant 1500 darkscan
         if len(data) < 400:
             self.flush_buffer()
             raise DeviceCommunicationError(
                 "Bad Scan of Length %s" % len(data))
-        data = [x - 1500 - temperature_compensation for x in data]
-        # reflectance/transmittance correction
-        if rt:
-            if self.dark_ref_taken and self.light_reference:
-                data = [100 * (data[i] - self.dark_reference[i]) / \
-                        max(1,(self.light_reference[i] - self.dark_reference[i]))\
-                        for i in range(len(data))]
-        # regular dark reference
-        elif self.dark_ref_taken:
-            if len(data) != len(self.dark_reference):
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Dark reference/Scan length mismatch.\n"
-                    " Try retaking the dark reference.")
-            data = [data[i] - \
-                    (self.dark_reference[i] * self.prev_integ/self.dark_integ) \
-                    for i in range(len(data))]
-        corrected_data = []
-        #interpolate
-        for i in range(len(self.x_data)):
-            # get predetermined pixel index and mu for interpolation
-            pixel_index, mu = self.wavelength_indices[i]
-            f = data[pixel_index - 1] * (1 - mu) + data[pixel_index] * mu
-            corrected_data.append(f)
-        if self.irradiance_data and self.irrad_unit:
-            ratio = self.irradiance_data[-1]/self.prev_integ
-            corrected_data = [corrected_data[i] * self.irradiance_data[i] *\
-                              ratio for i in range(len(corrected_data))]
-            if self.irrad_unit == 2:
-                corrected_data = [corrected_data[i] * self.x_data[i] * CONVERSION_FACTOR \
-                                  for i in range(len(corrected_data))]
+        with self.metadata_lock:
+            data = self.engine.remove_offset(data, compensation)
+            # reflectance/transmittance correction
+            if rt:
+                if self.dark_ref_taken and self.light_reference:
+                    data = self.engine.reflectance(data)
+            # regular dark reference
+            elif self.dark_ref_taken:
+                if len(data) != len(self.dark_reference):
+                    self.flush_buffer()
+                    raise DeviceCommunicationError(
+                        "Dark reference/Scan length mismatch.\n"
+                        " Try retaking the dark reference.")
+                data = self.engine.subtract_dark(data, integ, self.dark_integ)
+            corrected_data = self.engine.interpolate(data)
+            if self.irradiance_data and self.irrad_unit:
+                corrected_data = self.engine.apply_irradiance(
+                    corrected_data, integ, self.irrad_unit)
         return corrected_data
 
+    def decode_pixels(self, ret):
+        """decodes the little endian 2 byte pixel counts of a spectrum reply in
+        to pixel_buffer without going through python ints. Returns a view of
+        the buffer which is overwritten by the next scan, copy it to keep
+        it."""
+        count = len(ret) // 2
+        if count > len(self.pixel_buffer):
+            self.pixel_buffer = np.zeros(count, dtype=np.uint16)
+        pixels = self.pixel_buffer[:count]
+        pixels[:] = np.frombuffer(ret, dtype='<u2', count=count)
+        return pixels
+
+    def run(self, func, *args, **kwargs):
+        """Runs func(*args) on the executor after every command submitted
+        before it and returns its result. Raises DeviceCommunicationError if
+        it does not finish within timeout seconds or if a pipelined command
+        failed."""
+        future = self.executor.submit(func, *args)
+        timeout = kwargs.get('timeout', COMMAND_TIMEOUT) + self.queued_work
+        if self.abandoned is not None:
+            # it may have to wait for a resync first
+            timeout += RESYNC_WAIT + REPLY_MARGIN
+        return self.wait(future, timeout)
+
+    def wait(self, future, timeout):
+        """Waits for a Future of the executor in slices of READ_SLICE, calling
+        idle_callback in between, and returns its result."""
+        deadline = time() + timeout
+        while not future.wait(READ_SLICE):
+            if time() > deadline:
+                raise DeviceCommunicationError(
+                    "Device did not respond within %s seconds." % timeout)
+            if self.idle_callback is not None:
+                self.idle_callback()
+        self.executor.raise_failure()
+        return future.result()
+
     def write(self, msg):
-        """Sends the given command over USB to the spec."""
-        if not self.sts_semaphore.acquire(blocking=False):
-            return 'Semaphore Locked'
+        """Queues the given command to be sent over USB to the spec and returns
+        without waiting for it. A failure is raised by the next command the
+        calling thread waits for."""
+        return self.executor.submit(self._write, msg, pipelined=True)
+
+    def read(self):
+        """Reads and parses data from the spectrometer. Returns only the data
+        bits and leaves out the header and footer bytes. This is so that any
+        function can send a command and then read a command and get the data
+        back that they expect."""
+        return self.run(self._read)
+
+    def query(self, msg):
+        """Sends a command and returns the data of its reply. Nothing else is
+        sent to the spec in between."""
+        return self.run(self._query, msg)
+
+    def _query(self, msg):
+        # the reply to an abandoned spectrum must not be taken for this one's
+        self._resync()
+        self._write(msg)
+        return self._read()
+
+    def _write(self, msg):
         try:
             written = self.endpoint_out.write(msg)
             if written:
@@ -322,54 +603,230 @@ class Instrument(object):
                     '\nPlease disconnect and reconnect the Spectroradiometer.')
         except (usb.core.USBError), data:
             print data
-        finally:
-            self.sts_semaphore.release()
 
-    def read(self):
-        """Reads and parses data from the spectrometer. Returns only the data
-        bits and leaves out the header and footer bytes. This is so that any
-        function can send a command and then read a command and get the data
-        back that they expect."""
-        if not self.sts_semaphore.acquire(blocking=False):
-            return 'Semaphore Locked'
+    def _read(self):
+        # a query is answered as soon as the spec gets to it, however long
+        # the integration time is
+        deadline = time() + COMMAND_TIMEOUT
         try:
-            msg = self.endpoint_in.read(64)
-            ret = None
-            if msg[23]:
-                # we have some immediate data
-                ret = msg[24:24+msg[23]]
+            count = self.wait_for_packet(deadline, cancellable=False)
+            if count is None:
+                return None
+            msg = self.packet_buffer[:count]
             remaining = msg[40] + (msg[41] << 8) + (msg[42] << 16) + (msg[43] << 24) - 20
-            if remaining:
+            if remaining > 0:
                 remaining = int(ceil(remaining/64.0) * 64) # round remaing to nearest multiple of 64
-                msg += self.endpoint_in.read(remaining, self.prev_integ/1000)
-                ret = msg[44:-20]
-            return ret
-        except (usb.core.USBError), data:
+                msg += self.endpoint_in.read(remaining, REST_TIMEOUT_MS)
+            return decode_reply(msg).data
+        except (usb.core.USBError, ProtocolError), data:
             print data
+
+    def _read_frame(self, payload_size, deadline=None, regarding=None,
+                    cancellable=True):
+        """Reads a reply whose payload size is known up front, such as a
+        spectrum, in to frame_buffer. Blocks until the reply arrives, the
+        deadline (a time.time() value) passes or, if cancellable, cancel() is
+        called. Returns a uint8 view of the validated payload, which is
+        overwritten by the next call, or None if no valid reply was received.
+        If regarding is given replies carrying another tag are dropped and
+        waiting goes on."""
+        if deadline is None:
+            deadline = time() + REPLY_MARGIN
+        try:
+            size = HEADER_SIZE + payload_size + FOOTER_SIZE
+            size = int(ceil(size/64.0) * 64) # whole number of 64 byte packets
+            if len(self.frame_buffer) != size:
+                self.frame_buffer = array('B', '\x00' * size)
+                self.frame_view = np.frombuffer(self.frame_buffer,
+                                                dtype=np.uint8)
+                self.rest_buffer = array('B', '\x00' * (size - PACKET_SIZE))
+            while True:
+                count = self.wait_for_packet(deadline, cancellable)
+                if count is None:
+                    return None
+                self.frame_view[:count] = np.frombuffer(
+                    self.packet_buffer, dtype=np.uint8, count=count)
+                if count == PACKET_SIZE and len(self.rest_buffer):
+                    rest = self.endpoint_in.read(self.rest_buffer,
+                                                 REST_TIMEOUT_MS)
+                    self.frame_view[count:count + rest] = np.frombuffer(
+                        self.rest_buffer, dtype=np.uint8, count=rest)
+                    count += rest
+                reply = decode_reply(self.frame_view, count, payload_size)
+                if regarding is None or reply.regarding == regarding:
+                    return reply.data
+                print 'Dropped reply to an abandoned request'
+        except (usb.core.USBError, ProtocolError), data:
+            print data
+
+    def wait_for_packet(self, deadline, cancellable=True):
+        """Waits for the first packet of a reply in slices of READ_SLICE.
+        A packet is never split so a slice that times out loses no data.
+        Returns the number of bytes in packet_buffer or None if the deadline
+        passed. Raises AcquisitionCancelled if cancel() is called, unless
+        cancellable is False."""
+        while not (cancellable and self.cancel_event.is_set()):
+            remaining = deadline - time()
+            if remaining <= 0:
+                print 'Timed out waiting for reply'
+                return None
+            timeout = max(1, int(min(remaining, READ_SLICE) * 1000))
+            try:
+                return self.endpoint_in.read(self.packet_buffer, timeout)
+            except usb.core.USBError, data:
+                if not is_timeout(data):
+                    raise
+        raise AcquisitionCancelled("Measurement cancelled.")
+
+    def cancel(self):
+        """Abandons the spectrum currently being waited for. Safe to call from
+        any thread. The spec is brought back in step before the next spectrum,
+        see _resync."""
+        self.cancel_time = time()
+        self.stop_latency = None
+        self.cancel_event.set()
+
+    def scan_time(self):
+        """seconds the spec needs for a spectrum at the current integration
+        time and number of scans to average"""
+        return self.avg_scans * (self.prev_integ/1000000.0 + SCAN_OVERHEAD)
+
+    def request_spectrum(self, start=None, copy=False):
+        """Queues get_spectrum and the read of its reply on the executor and
+        returns straight away. Collect the spectrum with wait_for_spectrum.
+        If start is given get_spectrum is only sent once the Event is set, so
+        several devices can be triggered at the same moment. The device waits
+        for it indefinitely, it must be set. With copy the pixels are copied
+        out of pixel_buffer, needed if another spectrum is requested before
+        this one is used."""
+        self.cancel_event.clear()
+        work = self.scan_time() + REPLY_MARGIN
+        with self.work_lock:
+            self.queued_work += work
+        self.pending_spectrum = self.executor.submit(self._acquire_spectrum,
+                                                     start, copy, work)
+
+    def _acquire_spectrum(self, start=None, copy=False, work=0.0):
+        try:
+            return self._take_spectrum(start, copy)
+        finally:
+            with self.work_lock:
+                self.queued_work -= work
+
+    def _take_spectrum(self, start, copy):
+        self._resync()
+        if start is not None:
+            # no timeout, python 2 polls timed waits in steps of up to 50 ms
+            start.wait()
+        self.spectrum_tag = tag = (self.spectrum_tag + 1) & 0xffffffff
+        self._write(self.codec.encode('get_spectrum', regarding=tag))
+        integ = self.device_integ
+        self.trigger_time = trigger_time = time()
+        due = trigger_time + self.scan_time()
+        self.reply_deadline = due + REPLY_MARGIN
+        try:
+            ret = self._read_frame(SPECTRUM_BYTES, self.reply_deadline, tag)
+            if ret is None:
+                ret = self._read_frame(SPECTRUM_BYTES, regarding=tag)
+        except AcquisitionCancelled:
+            # the spec carries on with it regardless
+            self.abandoned = due
+            raise
+        if ret is None:
+            self._flush()
+            raise DeviceCommunicationError(
+                "Could not read from device."
+                "\nPlease try again. If this problem persists,"
+                "\ntry resetting your Spectroradiometer.")
+        self.complete_time = time()
+        pixels = self.decode_pixels(ret)
+        if copy:
+            pixels = pixels.copy()
+        scan = Scan(pixels, integ, trigger_time, self.complete_time)
+        self.scan_buffer.append(scan, self.prev_temp)
+        self.last_scan = scan
+        return scan
+
+    def _resync(self):
+        """Brings the spec back in step after a spectrum was abandoned. One
+        that is due within RESYNC_WAIT seconds is waited for and dropped, a
+        longer one is cut short by resetting the spec and sending the
+        integration time and number of scans to average again. The cancel()
+        that abandoned it may still be in effect, so the wait for it is not
+        cut short by one."""
+        if self.abandoned is None:
+            return
+        try:
+            if self.abandoned - time() > RESYNC_WAIT:
+                self._write(self.codec.encode('reset_spec'))
+                sleep(RESET_DELAY)
+                self._write(self.codec.encode('set_integ', self.device_integ))
+                self._write(self.codec.encode('set_avg_scans',
+                                              self.avg_scans & 0xffff))
+            else:
+                self._read_frame(SPECTRUM_BYTES, self.abandoned + REPLY_MARGIN,
+                                 cancellable=False)
+            self._flush()
         finally:
-            self.sts_semaphore.release()
+            # a resync that failed is not tried again by every command after
+            self.abandoned = None
+
+    def wait_for_spectrum(self):
+        """Waits for the spectrum requested by request_spectrum and returns its
+        raw pixel counts. Raises AcquisitionCancelled if cancel() is called
+        meanwhile."""
+        return self.wait_for_scan().pixels
+
+    def wait_for_scan(self):
+        """Same as wait_for_spectrum but returns the whole Scan"""
+        future, self.pending_spectrum = self.pending_spectrum, None
+        if future is None:
+            raise DeviceCommunicationError("No spectrum has been requested.")
+        # allow for the spectra and commands queued ahead of it, a resync and
+        # one retry
+        try:
+            return self.wait(future, COMMAND_TIMEOUT + REPLY_MARGIN +
+                             RESYNC_WAIT + self.queued_work)
+        except AcquisitionCancelled:
+            self.stop_latency = time() - self.cancel_time
+            raise
 
     def set_integration_period(self, new_integ):
         """Input is 4 bytes for time in microseconds. Order is LSB, ..., MSB No
         reply. The minimum is 10."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_integ']
-        msg[8] = '\x04'
-        msg[9] = struct.pack('1I', int(new_integ)) + ''.join(['\x00'] * 12)
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
+        self.executor.submit(self._set_integ, int(new_integ), pipelined=True)
         self.prev_integ = int(new_integ)
 
+    def _set_integ(self, integ):
+        self._write(self.codec.encode('set_integ', integ))
+        self.device_integ = integ
+
+    def settle_exposure(self, scan):
+        """Auto integration for scans taken back to back, the counterpart of
+        the rescans in get_spectrum. Adjusts the integration time for the next
+        scan and returns False if this one should be discarded because it was
+        taken at the wrong one. After MAX_RESCANS discarded scans in a row the
+        next one is used regardless."""
+        if not self.auto_integration:
+            return True
+        prev = self.prev_integ
+        if scan.integ == prev:
+            self.auto_integrate(scan.pixels)
+            if prev == self.prev_integ:
+                self.rescans = 0
+                return True
+        if self.rescans >= MAX_RESCANS:
+            self.rescans = 0
+            return True
+        self.rescans += 1
+        return False
+
     def get_scans_to_avg(self):
         """Gets the number of scans (1-5000) to average together before
         returning the spectrum."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_avg_scans']
-        msg = msg + self.cmd.FOOTER
-        self.write(''.join(msg))
-        ret = self.read()
+        ret = self.query(self.codec.encode('get_avg_scans'))
         if ret is not None:
-            ret = ret[0] + (ret[1] << 8)
+            ret = self.codec.unpack('get_avg_scans', ret)[0]
         else:
             self.flush_buffer()
             raise DeviceCommunicationError(
@@ -384,82 +841,32 @@ class Instrument(object):
         per pixel. The average will round to the nearest integer, with any exact
         half being rounded up."""
         self.avg_scans = num_scans
-        msg = self.cmd.HEADER
-        # set cmd
-        msg[4] = STS_CMD['set_avg_scans']
-        # set immediate data length
-        msg[8] = '\x02'
-        # split into bytes, LSB first
-        num_scans = chr(num_scans & 0xff) + chr((num_scans >> 8) & 0xff)
-        # set immediate data
-        msg[9] = num_scans + '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        msg = msg + self.cmd.FOOTER
-        self.write(''.join(msg))
+        self.write(self.codec.encode('set_avg_scans', num_scans & 0xffff))
 
     def get_pixel_data(self):
         """This returns the intensity of every pixel on the detector as LSB, MSB
         as soon as it is available. There is no payload in the request. The
         reply has 2048 bytes of payload. The pixel intensities are corrected for
         temperature drift and fixed-pattern noise."""
-        msg = self.cmd.HEADER
-        # set cmd
-        msg[4] = STS_CMD['get_spectrum']
-        msg = msg + self.cmd.FOOTER
-        self.write(''.join(msg))
-        inc = ((self.prev_integ/1000000.0 + 0.01) * self.avg_scans)/10
-        for i in range(10):
-            sleep(inc)
-            wx.YieldIfNeeded()
-        ret = self.read()
-        if ret is None:
-            ret = self.read()
-            if ret is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        return [ret[i] + (ret[i+1] << 8) for i in range(0, len(ret), 2)]
+        self.request_spectrum()
+        return self.wait_for_spectrum()
 
-    def start_measurement(self):
+    def start_measurement(self, start=None):
         """Starts the measurement command but does not retrieve the data. Used
         when multiple sensors are connected. This allows us to start all
         sensor measurements simultaneously rather than waiting for each one to
-        finish before acquiring the next set of data."""
+        finish before acquiring the next set of data. See request_spectrum for
+        start."""
         if self.auto_integration and self.prev_integ > 2000000:
             self.set_integration_period(2000000)
-        msg = self.cmd.HEADER
-        # set cmd
-        msg[4] = STS_CMD['get_spectrum']
-        msg = msg + self.cmd.FOOTER
-        self.write(''.join(msg))
+        self.request_spectrum(start)
 
     def acquire_measurement(self, rt=False):
         """Acquires data from the previously sent start_measurement command. Be
         aware that this method will not do anything unless data has already
         been requested. Lag times can be significant for auto-integration if
         integration time needs to be updated."""
-        ret = self.read()
-        if ret is None:
-            ret = self.read()
-            if ret is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        i = 0
-        while ret == 'Semphore Locked' and i < 50:
-            sleep(0.1)
-            ret = self.read()
-            i += 1
-        if ret is None:
-            self.flush_buffer()
-            raise DeviceCommunicationError(
-                "Could not read from device."
-                "\nPlease try again. If this problem persists,"
-                "\ntry resetting your Spectroradiometer.")
-        data = [ret[i] + (ret[i+1] << 8) for i in range(0, len(ret), 2)]
+        data = self.wait_for_spectrum()
         prev = self.prev_integ
         if self.auto_integration:
             i = 0
@@ -480,124 +887,101 @@ class Instrument(object):
         """Request has 1-byte input data for coefficient index starting with
         wavelength intercept at index 0. Reply has 4-byte float (LSB first).
         This method returns all 4 calibration coefficients."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_wavelen_coeff']
-        msg[8] = '\x01'
-        msg[9] = '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        msg = msg + self.cmd.FOOTER
-        self.write(''.join(msg))
         coeffs = []
-        c = self.read()
-        if c is None:
-            c = self.read()
+        for index in range(4):
+            c = self.query(self.codec.encode('get_wavelen_coeff', index))
             if c is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        try:
-            coeffs.append(struct.unpack('<f', ''.join([chr(i) for i in c]))[0])
-        except struct.error:
-            try:
                 c = self.read()
-                coeffs.append(struct.unpack('<f', ''.join([chr(i) for i in c]))[0])
-            except Exception, data:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Communication Error", "%s" % data)
-        msg[9] = '\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
-        c = self.read()
-        if c is None:
-            c = self.read()
-            if c is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        coeffs.append(struct.unpack('<f', ''.join([chr(i) for i in c]))[0])
-        msg[9] = '\x02\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
-        c = self.read()
-        if c is None:
-            c = self.read()
-            if c is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        coeffs.append(struct.unpack('<f', ''.join([chr(i) for i in c]))[0])
-        msg[9] = '\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
-        c = self.read()
-        if c is None:
-            c = self.read()
-            if c is None:
-                self.flush_buffer()
-                raise DeviceCommunicationError(
-                    "Could not read from device."
-                    "\nPlease try again. If this problem persists,"
-                    "\ntry resetting your Spectroradiometer.")
-        coeffs.append(struct.unpack('<f', ''.join([chr(i) for i in c]))[0])
+                if c is None:
+                    self.flush_buffer()
+                    raise DeviceCommunicationError(
+                        "Could not read from device."
+                        "\nPlease try again. If this problem persists,"
+                        "\ntry resetting your Spectroradiometer.")
+            try:
+                coeffs.append(self.codec.unpack('get_wavelen_coeff', c)[0])
+            except struct.error:
+                try:
+                    c = self.read()
+                    coeffs.append(self.codec.unpack('get_wavelen_coeff', c)[0])
+                except Exception, data:
+                    self.flush_buffer()
+                    raise DeviceCommunicationError(
+                        "Communication Error", "%s" % data)
         return coeffs
 
     def set_calibration_coefficients(self, new_coeff):
         """Input is the order of the coefficient to set (indexing starts with
         wavelength intercept at index 0), followed by an IEEE single-precision
         float. No reply."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_wavelen_coeff']
-        msg[8] = '\x05'
-        msg[9] = '\x00' + struct.pack('1f', new_coeff[0]) + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        msg[9] = '\x01' + struct.pack('1f', new_coeff[1]) + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
-        msg[9] = '\x02' + struct.pack('1f', new_coeff[2]) + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
-        msg[9] = '\x03' + struct.pack('1f', new_coeff[3]) + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        self.write(''.join(msg))
+        for index in range(4):
+            self.write(self.codec.encode('set_wavelen_coeff', index,
+                                         new_coeff[index]))
         self.calib_coeff = new_coeff
+        self.build_resampler()
+        self.invalidate_metadata()
 
     def get_internal_temp(self):
         """Provides the temperature in C (if calibrated) or raw counts for the
         sensor (if uncalibrated). Input is 1 byte for the index of the sensor to
         read. Reply: output is a 4-byte float (LSB first) of temperature in C."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['read_temperature']
-        msg[8] = '\x01'
-        msg[9] = '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        msg += self.cmd.FOOTER
-        # since the index we want is zero, we won't change msg[9]
-        self.write(''.join(msg))
-        temp = self.read()
+        temp = self.query(self.codec.encode('read_temperature', 0))
         try:
-            return struct.unpack('<f', ''.join([chr(i) for i in temp]))[0]
+            return self.codec.unpack('read_temperature', temp)[0]
         except struct.error:
             return -99.0
 
+    def set_temperature_policy(self, every_scans, every_seconds):
+        """The temperature is read again once every_scans scans have been
+        corrected or every_seconds seconds have passed since the last reading.
+        Either can be 0 to disable it, with both 0 the temperature is only read
+        when sample_temperature is called."""
+        self.temp_sample_scans = every_scans
+        self.temp_sample_seconds = every_seconds
+
+    def temperature_due(self):
+        """True if the temperature policy calls for a new reading"""
+        if not self.temp_time:
+            return True
+        if self.temp_sample_scans and \
+           self.scans_since_temp >= self.temp_sample_scans:
+            return True
+        return bool(self.temp_sample_seconds) and \
+            time() - self.temp_time >= self.temp_sample_seconds
+
+    def sample_temperature(self):
+        """Reads the temperature now and caches its compensation. Returns the
+        temperature."""
+        self.prev_temp = self.get_internal_temp()
+        self.temp_time = time()
+        self.temp_compensation = temperature_compensation(self.prev_temp)
+        self.scans_since_temp = 0
+        return self.prev_temp
+
+    def update_temperature(self):
+        """Called once per scan. Reads the temperature if it is due and returns
+        the compensation for the latest reading."""
+        if self.temperature_due():
+            self.sample_temperature()
+        self.scans_since_temp += 1
+        return self.temp_compensation
+
     def get_irradiance_calibration(self):
         """Request has no payload. Reply has up to 4096 bytes (whatever has been
         stored previously), intended for 1024 x 4-byte floats. If nothing has
         been stored, the reply will have NACK bit set in flags."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_irrad_calib']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        irrad_data = self.read()
+        irrad_data = self.read_irradiance_calibration()
+        if irrad_data is not None:
+            self.irradiance_data = irrad_data
+
+    def read_irradiance_calibration(self):
+        """returns the irradiance calibration stored on the device as a list of
+        floats or None if there is none"""
+        irrad_data = self.query(self.codec.encode('get_irrad_calib'))
         if irrad_data is None:
             return
-        irrad_data = ''.join([chr(i) for i in irrad_data])
-        self.irradiance_data = [struct.unpack('<f', j)[0] \
-                                for j in [irrad_data[i:i+4]\
-                                          for i in range(0, len(irrad_data), 4)]]
+        return np.frombuffer(
+            irrad_data, dtype='<f4', count=len(irrad_data) // 4).tolist()
 
     def set_irradiance_calibration(self, calibration_data):
         """Request has up to 4096 bytes in payload. Sending a zero-length buffer
@@ -605,91 +989,63 @@ class Instrument(object):
         # calibration comes in as a list of floats. need to convert to char
         # array before sending data
         self.irradiance_data = calibration_data
-        calibration_data = ''.join(
-            [struct.pack('1f', ratio) for ratio in calibration_data])
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_irrad_calib']
-        length = 20 + len(calibration_data)
-        msg[10] = struct.pack('1I', length)
-        msg += calibration_data
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
+        calibration_data = np.asarray(calibration_data, dtype='<f4').tostring()
+        self.write(self.codec.encode('set_irrad_calib', calibration_data))
+        self.invalidate_metadata()
 
     def get_device_alias(self):
         """User-defined name for the device (e.g., station number)"""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_dev_alias']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        alias = self.read()
+        alias = self.query(self.codec.encode('get_dev_alias'))
         if alias is None:
             alias = 'None'
         else:
-            alias = ''.join([chr(i) for i in alias])
+            alias = alias.tostring()
         return alias
 
     def set_device_alias(self, new_name):
         """If string length is 0, alias will be deleted"""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_dev_alias']
-        msg[8] = chr(len(new_name))
-        msg[9] = str(new_name) + ''.join(['\x00'] * (16 - len(new_name)))
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
+        self.write(self.codec.encode('set_dev_alias', str(new_name)))
 
     def get_device_serial(self):
         """This is a really a user defined string. We could potentially over-
         write the current serial number but that will elimnate a useful audit
         trail in the event something happens to the device."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_dev_serial']
-        msg[8] = '\x01' # I guess these user strings are indexed?
-        msg[9] = '\x01' + ''.join(['\x00'] * 15)
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        serial = self.read()
+        # I guess these user strings are indexed?
+        serial = self.query(self.codec.encode('get_dev_serial', 1))
         if serial is None:
             serial = 'None'
         else:
-            serial = ''.join([chr(i) for i in serial])
+            serial = serial.tostring()
         self.serial = serial
         return serial
 
     def set_device_serial(self, new_serial):
         """Set serial number of device"""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_dev_serial']
-        msg[8] = chr(len(new_serial) + 1)
-        msg[9] = '\x01' + str(new_serial) + ''.join(['\x00'] * (16 - len(new_serial) -1))
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
+        self.write(self.codec.encode('set_dev_serial',
+                                     '\x01' + str(new_serial)))
         self.serial = new_serial
+        self.invalidate_metadata()
 
     def get_hot_pixel_indices(self):
         """Request has no data. Reply has up to 58 x 2-byte integers (1 integer
         per pixel index). If nothing has been stored, the reply will have NACK
         bit set in flags."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_hot_pixels']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        ret = self.read()
+        hot_pixels = self.read_hot_pixel_indices()
+        if hot_pixels is not None:
+            self.dark_pixels = hot_pixels
+
+    def read_hot_pixel_indices(self):
+        """returns the hot pixels stored on the device as a list or None if
+        there are none"""
+        ret = self.query(self.codec.encode('get_hot_pixels'))
         if ret is None:
             ret = self.read()
             if ret is None:
                 return
-        self.dark_pixels = [ret[i] + (ret[i+1] << 8) for i in range(0, len(ret), 2)]
+        return np.frombuffer(ret, dtype='<u2', count=len(ret) // 2).tolist()
 
     def wavelength_to_pixel(self, wavelength):
-        for pixel in range(1024):
-            estimated_wavelength = self.calib_coeff[0] + \
-               self.calib_coeff[1] * pixel + \
-               self.calib_coeff[2] * pixel ** 2 + \
-               self.calib_coeff[3] * pixel ** 3
-            if wavelength >= estimated_wavelength:
-                continue
-            else:
-                return pixel
+        return self.resampler.wavelength_to_pixel(wavelength)
 
     def add_hot_pixel_at_wavelength(self, wavelength, add_one=False):
         pixel = self.wavelength_to_pixel(wavelength)
@@ -699,68 +1055,80 @@ class Instrument(object):
             self.dark_pixels.append(pixel)
             self.dark_pixels.sort()
             self.set_hot_pixel_indices(self.dark_pixels)
-            # rebuild the wavelength indices with new dark pixels
+            # rebuild the resampling operator with new dark pixels
             # to get rid of the errent wavelength
-            self.build_wavelength_indices()
+            self.build_resampler()
             return True
         return False
 
     def set_hot_pixel_indices(self, new_indices):
         """Request has up to 58 x 2-byte integers for pixel indices. No reply."""
-        new_indices = ''.join(
-            [struct.pack('1H', new_indices[i]) for i in range(len(new_indices))])
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_hot_pixels']
-        if len(new_indices) <= 16:
-            msg[8] = chr(len(new_indices))
-            msg[9] = new_indices + ''.join(['\x00'] * (16 - len(new_indices)))
-        else:
-            msg[10] = struct.pack('1I', len(new_indices) + 20)
-            msg += new_indices
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
+        # sent as immediate data if there are 8 or less, as payload otherwise
+        new_indices = np.asarray(new_indices, dtype='<u2').tostring()
+        self.write(self.codec.encode('set_hot_pixels', new_indices))
+        self.invalidate_metadata()
 
     def reset_default_settings(self):
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['reset_to_default_settings']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        sleep(5)
+        self.write(self.codec.encode('reset_to_default_settings'))
+        self.invalidate_metadata()
+        self.settings = None
+        # the pause runs on the executor so nothing is sent meanwhile
+        self.run(sleep, RESET_DELAY, timeout=RESET_DELAY + COMMAND_TIMEOUT)
 
     def change_rs232_baudrate(self, baudrate):
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['set_rs232_baudrate']
-        baudrate_str = struct.pack('1L', baudrate)
-        msg += self.cmd.FOOTER
-        msg[8] = chr(4)
-        msg[9] = baudrate_str + ''.join(['\x00'] * (16 - len(baudrate_str)))
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['get_rs232_baudrate']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        returned_baudrate = self.read()
-        returned_baudrate = returned_baudrate[0] + (returned_baudrate[1] << 8) \
-            + (returned_baudrate[2] << 16) + (returned_baudrate[3] << 24)
+        self.write(self.codec.encode('set_rs232_baudrate', baudrate))
+        returned_baudrate = self.query(self.codec.encode('get_rs232_baudrate'))
+        returned_baudrate = self.codec.unpack('get_rs232_baudrate',
+                                              returned_baudrate)[0]
         if baudrate == returned_baudrate:
-            msg = self.cmd.HEADER
-            msg[4] = STS_CMD['save_rs232_defaults']
-            msg += self.cmd.FOOTER
-            self.write(''.join(msg))
+            self.write(self.codec.encode('save_rs232_defaults'))
 
     def reset_spec(self):
         """Reset the spectroradiometer. Used to help clear errors on the spec."""
-        msg = self.cmd.HEADER
-        msg[4] = STS_CMD['reset_spec']
-        msg += self.cmd.FOOTER
-        self.write(''.join(msg))
-        sleep(5)
+        self.write(self.codec.encode('reset_spec'))
+        self.settings = None
+        self.run(sleep, RESET_DELAY, timeout=RESET_DELAY + COMMAND_TIMEOUT)
 
     def disconnect_spec(self):
-        """Release the spec from control"""
+        """Release the spec from control once the commands already queued have
+        run and stop its executor"""
+        self.cancel()
+        try:
+            self.run(self._release)
+        except Exception, data:
+            pass
+        self.executor.shutdown()
+
+    def _release(self):
+        usb.util.release_interface(self.dev, 0)
+        usb.util.dispose_resources(self.dev)
+
+    def is_attached(self):
+        """True if the device is still on the bus"""
+        return any(same_device(dev, self.dev) for dev in find_devices())
+
+    def take_over(self, other):
+        """Continues on the connection of other, an Instrument opened for the
+        same sensor after it was unplugged and attached again. Everything set
+        on this one is kept and the integration time and number of scans to
+        average are sent to the sensor again."""
+        lost = self.dev
+        # the commands still queued fail on the lost connection, they must
+        # not run on the new one. one of them may be a resync
+        self.executor.shutdown()
+        self.executor.thread.join(RESYNC_WAIT + COMMAND_TIMEOUT)
+        self.dev = other.dev
+        self.endpoint_out, self.endpoint_in = other.endpoint_out, \
+            other.endpoint_in
+        self.executor = other.executor
         try:
-            usb.util.release_interface(self.dev, 0)
-            usb.util.dispose_resources(self.dev)
+            usb.util.dispose_resources(lost)
         except Exception, data:
             pass
+        # the sensor was plugged in afresh, it has no abandoned spectrum to
+        # get back in step with
+        self.abandoned = None
+        self.cancel_event.clear()
+        self.set_integration_period(self.prev_integ)
+        self.set_scans_to_avg(self.avg_scans)
+        self.attached.set()
@@ -433,6 +433,9 @@ View
 
 Each option in this menu will switch the current plot mode to the one specified in the drop down menu. If continuous measurement mode is active, the next measurement taken will take on the new plot mode. Otherwise, a single measurement will be taken and plotted to the screen in the new plot mode.
 
+Wavelength Grid:
+Selects the wavelengths measurements are reported on. The 1 nm grid is the default and is always used for calibration. Finer grids interpolate between detector pixels, coarser grids average every pixel within each bin and Native pixels reports each good detector pixel at its own wavelength. Integrated totals are weighted by the width of each bin so they do not depend on the grid.
+
 Help
 
 Jump to the help tab of the chosen subject.